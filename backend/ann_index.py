@@ -0,0 +1,167 @@
+# ann_index.py (全科目マップノードの近似最近傍インデックス)
+#
+# 埋め込みストア (embedding_store.py) の全ノードを対象にした IVF (転置ファイル) 型のインデックス。
+# 球面k-meansで求めた重心ごとにノードを振り分け、クエリ時は重心との類似度が高い
+# nprobe 個のリストだけを走査する。学年での絞り込みにも対応し、科目数に比例せずに
+# 「入力埋め込みに近い上位Nノード」を求め、部分木抽出の接続点候補として使う。
+import os
+import json
+import logging
+import threading
+import numpy as np
+import pandas as pd
+
+import embedding_store
+
+META_FILE = "ann_index.json"
+CENTROIDS_FILE = "ann_centroids.npy"
+VECTORS_FILE = "ann_vectors.npy"
+ROWS_FILE = "ann_rows.npy"
+LIST_INDPTR_FILE = "ann_list_indptr.npy"
+YEARS_FILE = "ann_years.npy"
+FORMAT_VERSION = 1
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms != 0)
+
+def _spherical_kmeans(vectors: np.ndarray, n_lists: int, n_iter: int, seed: int, max_train: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    train = vectors[rng.choice(len(vectors), size=min(len(vectors), max_train), replace=False)]
+    centroids = train[rng.choice(len(train), size=n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = np.argmax(train @ centroids.T, axis=1)
+        for c in range(n_lists):
+            members = train[assignment == c]
+            # 空のリストはランダムな点で再初期化する
+            centroids[c] = members.sum(axis=0) if len(members) else train[rng.integers(len(train))]
+        centroids = _normalize_rows(centroids)
+    return centroids
+
+# =============================================================================
+# 1. ビルド (オフライン処理)
+# =============================================================================
+
+def build_ann_index(store_dir: str, database_dir: str, out_dir: str | None = None, id_col: str = 'id', year_col: str = 'year',
+                    n_lists: int | None = None, n_iter: int = 10, seed: int = 0) -> dict:
+    """
+    ビルド済み埋め込みストアから IVF インデックスを構築して store_dir (または out_dir) に保存する。
+    リスト数は省略時に sqrt(ノード数) 程度とする。
+    """
+    out_dir = out_dir or store_dir
+    store = embedding_store.EmbeddingStore(store_dir, database_dir)
+    if store.rows == 0 or store.dim == 0:
+        raise ValueError("埋め込みストアが空のため、ANNインデックスを構築できません。")
+
+    # ノードごとの学年 (ストアの行順に揃える)
+    years = np.full(store.rows, -1, dtype=np.int16)
+    for subject_name in store.subjects:
+        path = os.path.join(database_dir, f"{embedding_store.NODES_FILE_PREFIX}{subject_name}{embedding_store.NODES_FILE_SUFFIX}")
+        try:
+            df = pd.read_csv(path, usecols=[id_col, year_col])
+        except Exception as e:
+            logging.warning(f"ANNインデックス構築: 学年を読み込めません ({path}): {e}")
+            continue
+        year_by_id = dict(zip(df[id_col].astype(str), pd.to_numeric(df[year_col], errors='coerce').fillna(-1).astype(int)))
+        window = store.subject_slice(subject_name)
+        years[window] = [year_by_id.get(node_id, -1) for node_id in store.subject_node_ids(subject_name)]
+
+    vectors = np.asarray(store.matrix)  # ストアの行は正規化済み
+    valid_rows = np.flatnonzero(np.asarray(store.norms) > 0)
+    n_lists = max(1, min(n_lists or int(np.sqrt(len(valid_rows))), len(valid_rows)))
+    centroids = _spherical_kmeans(vectors[valid_rows], n_lists, n_iter, seed, max_train=max(256 * n_lists, 10000)).astype(np.float32)
+
+    assignment = np.argmax(vectors[valid_rows] @ centroids.T, axis=1)
+    order = np.argsort(assignment, kind='stable')
+    rows = valid_rows[order].astype(np.int64)
+    list_indptr = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_indptr[1:])
+
+    os.makedirs(out_dir, exist_ok=True)
+    for file_name, payload in ((CENTROIDS_FILE, centroids), (VECTORS_FILE, vectors[rows]), (ROWS_FILE, rows),
+                               (LIST_INDPTR_FILE, list_indptr), (YEARS_FILE, years[rows])):
+        tmp_path = os.path.join(out_dir, file_name + ".tmp.npy")
+        np.save(tmp_path, payload)
+        os.replace(tmp_path, os.path.join(out_dir, file_name))
+    meta = {"format_version": FORMAT_VERSION, "n_lists": n_lists, "rows": int(len(rows)), "dim": store.dim,
+            "store_rows": store.rows, "store_build": store.build_name}
+    with open(os.path.join(out_dir, META_FILE + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(out_dir, META_FILE + ".tmp"), os.path.join(out_dir, META_FILE))
+
+    logging.info(f"ANNインデックスを構築しました: {len(rows)}ノード, {n_lists}リスト -> {out_dir}")
+    return meta
+
+# =============================================================================
+# 2. 実行時の検索
+# =============================================================================
+
+class AnnIndex:
+    """IVF インデックス。ベクトルはリスト順に並べ替えた正規化済み float32 行列を memmap で保持する。"""
+
+    def __init__(self, index_dir: str, store: embedding_store.EmbeddingStore):
+        with open(os.path.join(index_dir, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != FORMAT_VERSION or meta.get("store_rows") != store.rows or meta.get("store_build") != store.build_name:
+            raise ValueError("ANNインデックスが埋め込みストアと一致しません。build_data.py ann を再実行してください。")
+        self.store = store
+        self.n_lists = meta["n_lists"]
+        load = lambda name: np.load(os.path.join(index_dir, name), mmap_mode='r')
+        self.centroids = np.asarray(load(CENTROIDS_FILE))
+        self.vectors, self.rows, self.years = load(VECTORS_FILE), load(ROWS_FILE), load(YEARS_FILE)
+        self.list_indptr = np.asarray(load(LIST_INDPTR_FILE))
+
+    def search(self, embedding: np.ndarray, top_n: int, nprobe: int = 8, year_filter=None) -> list[tuple[str, str, float]]:
+        """
+        入力埋め込みに近いノードを最大 top_n 件返す。
+
+        Args:
+            year_filter: ノードの学年配列を受け取り、真偽値配列を返す関数 (例: lambda y: y > 3)
+        Returns:
+            - (科目名, ノードID, コサイン類似度) のリスト (類似度の降順)
+        """
+        if embedding is None or top_n <= 0: return []
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if query.shape != (self.vectors.shape[1],) or norm == 0: return []
+        query = query / norm
+
+        list_order = np.argsort(-(self.centroids @ query))
+        probe = min(nprobe, self.n_lists)
+        while True:
+            # 近い重心のリストから順に走査し、絞り込み後の件数が足りなければ走査範囲を広げる
+            lists = list_order[:probe]
+            positions = np.concatenate([np.arange(self.list_indptr[c], self.list_indptr[c + 1]) for c in lists])
+            if year_filter is not None and len(positions):
+                positions = positions[year_filter(self.years[positions])]
+            if len(positions) >= top_n or probe >= self.n_lists: break
+            probe = min(probe * 2, self.n_lists)
+
+        if len(positions) == 0: return []
+        scores = self.vectors[positions] @ query
+        top = np.argpartition(-scores, min(top_n, len(scores)) - 1)[:top_n]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(*self.store.locate(int(self.rows[positions[i]])), float(scores[i])) for i in top]
+
+_index_lock = threading.Lock()
+_index_cache: dict = {}
+
+def get_ann_index(index_dir: str, database_dir: str | None = None) -> AnnIndex | None:
+    """ビルド済みインデックスをプロセス内で一度だけ開いて返す。未ビルドの場合は None。"""
+    key = (os.path.abspath(index_dir), database_dir)
+    if key in _index_cache: return _index_cache[key]
+    with _index_lock:
+        if key not in _index_cache:
+            index = None
+            store = embedding_store.get_embedding_store(index_dir, database_dir)
+            if store is not None and os.path.exists(os.path.join(index_dir, META_FILE)):
+                try:
+                    index = AnnIndex(index_dir, store)
+                    logging.info(f"ANNインデックスを開きました: {index.n_lists}リスト ({index_dir})")
+                except Exception as e:
+                    logging.error(f"ANNインデックスを開けませんでした ({index_dir}): {e}")
+            _index_cache[key] = index
+        return _index_cache[key]
+
+def reset_ann_index_cache():
+    with _index_lock: _index_cache.clear()
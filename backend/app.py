@@ -3,25 +3,34 @@ import os
 import json
 import logging
 from datetime import datetime, timedelta, timezone
-from flask import Flask, request, jsonify, g, make_response,send_from_directory
+from flask import Flask, request, jsonify, g, make_response,send_from_directory, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import openai
 import time_relation_logic
+import stage_timing
+import json_encoding
+import map_delta
 from functools import wraps
-import pandas as pd
+from lazy_imports import lazy_import
 import jwt
-from sqlalchemy import func, distinct, and_
+from sqlalchemy import func, distinct, and_, inspect as sa_inspect, text
 import uuid  # この行を追加
 from gevent import monkey
 monkey.patch_all()  # geventのパッチを適用
 
+# openai (提案・マップ生成) と pandas (CSVエクスポート) は一部のエンドポイントでしか使わないため、
+# ワーカー起動時ではなく最初に使われた時点で読み込む
+openai = lazy_import("openai")
+pd = lazy_import("pandas")
+
 # =============================================================================
 # 1. Flask App Setup
 # =============================================================================
 
 # Flaskアプリケーションのインスタンスを作成
 app = Flask(__name__)
+# jsonify のエンコードを orjson で行う (大きな知識マップのレスポンスの直列化を速くする)
+app.json = json_encoding.FastJSONProvider(app)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- アプリケーションの設定 ---
@@ -69,6 +78,8 @@ else:
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['ADMIN_USERNAME'] = os.getenv('ADMIN_USERNAME', 'admin')
+# マップ履歴は前の版との差分で保存し、この版数ごとにマップ全体 (キーフレーム) を保存する
+app.config['MAP_HISTORY_KEYFRAME_INTERVAL'] = int(os.getenv('MAP_HISTORY_KEYFRAME_INTERVAL', 20))
 
 frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:5173')
 CORS(app, 
@@ -205,12 +216,25 @@ class Memo(db.Model):
     history_entries = db.relationship('MapHistory', backref='memo', lazy=True, cascade="all, delete-orphan")
 
 class MapHistory(db.Model):
+    # 各行はキーフレーム (マップ全体) か、base_id の版に対する差分 (JSON Patch) のどちらかを map_data 列に保存する。
+    # 復元した版のマップは map_data プロパティで読む (新しい版の行は new_map_history で作る)
     __tablename__ = 'map_history'
     id = db.Column(db.Integer, primary_key=True)
     memo_id = db.Column(db.Integer, db.ForeignKey('memos.id'), nullable=False, index=True)
-    map_data = db.Column(db.JSON, nullable=False)
+    stored_data = db.Column('map_data', db.JSON, nullable=False)
+    base_id = db.Column(db.Integer, nullable=True)      # 差分の適用先の版の履歴ID (キーフレームは NULL)
+    keyframe_id = db.Column(db.Integer, nullable=True)  # 差分の連鎖の起点のキーフレームの履歴ID (キーフレームは NULL)
+    chain_depth = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # キーフレームからの差分の数
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
 
+    @property
+    def is_keyframe(self) -> bool:
+        return self.base_id is None
+
+    @property
+    def map_data(self) -> dict:
+        return load_map_histories([self])[self.id]
+
 class UserActivityLog(db.Model):
     __tablename__ = 'user_activity_logs'
     id = db.Column(db.Integer, primary_key=True)
@@ -239,6 +263,67 @@ def get_current_user():
             return None
     return None
 
+# --- マップ履歴の差分保存 ---
+# 版を保存するたびにマップ全体を書く代わりに、直前の版との差分 (map_delta.diff) を書く。キーフレームから
+# base_id をたどって差分を順に適用すると、各版のマップが復元できる。以下の場合はキーフレームを書く。
+#   - メモの最初の版、または直前の版がキーフレームから MAP_HISTORY_KEYFRAME_INTERVAL - 1 個目の差分の場合
+#   - 差分の大きさがマップ全体の MAP_HISTORY_MAX_DELTA_RATIO 倍以上の場合 (大きく変わった版は差分にしない)
+MAP_HISTORY_MAX_DELTA_RATIO = 0.5
+
+def load_map_histories(histories: list) -> dict:
+    """
+    履歴の各版のマップを復元し、{履歴ID: マップ} で返す。
+    差分の連鎖に必要な行は、メモごとに1回のクエリでまとめて読み込む。
+    """
+    rows = {h.id: h for h in histories}
+    ranges = {}
+    for h in histories:
+        row = h
+        while not row.is_keyframe and row.base_id in rows: row = rows[row.base_id]
+        if row.is_keyframe: continue  # 連鎖の行がすべて渡された中にある
+        low, high = ranges.get(h.memo_id, (h.keyframe_id, h.id))
+        ranges[h.memo_id] = (min(low, h.keyframe_id), max(high, h.id))
+    for memo_id, (low, high) in ranges.items():
+        for row in MapHistory.query.filter(MapHistory.memo_id == memo_id, MapHistory.id >= low, MapHistory.id <= high):
+            rows.setdefault(row.id, row)
+
+    # 差分の適用先は常に自身より前 (IDが小さい) の版なので、ID順に復元すれば適用先は復元済みになる
+    maps = {}
+    for row in sorted(rows.values(), key=lambda r: r.id):
+        if row.is_keyframe: maps[row.id] = row.stored_data
+        elif row.base_id in maps: maps[row.id] = map_delta.apply_patch(maps[row.base_id], row.stored_data)
+        else: app.logger.error(f"Map history {row.id} cannot be restored: base revision {row.base_id} is missing")
+    return maps
+
+def new_map_history(memo_id, map_data: dict) -> 'MapHistory':
+    """
+    メモの新しい版の履歴行を作る (セッションへの追加は呼び出し側で行う)。
+    直前の版との差分が小さければ差分の行、そうでなければキーフレームの行になる。memo_id が None (新規メモ) の場合はキーフレーム。
+    """
+    latest = None
+    if memo_id is not None:
+        latest = MapHistory.query.filter_by(memo_id=memo_id).order_by(MapHistory.created_at.desc(), MapHistory.id.desc()).first()
+    if latest is not None and latest.chain_depth + 1 < app.config['MAP_HISTORY_KEYFRAME_INTERVAL']:
+        patch = map_delta.diff(latest.map_data, map_data)
+        if len(json_encoding.dumps(patch)) < len(json_encoding.dumps(map_data)) * MAP_HISTORY_MAX_DELTA_RATIO:
+            return MapHistory(memo_id=memo_id, stored_data=patch, base_id=latest.id,
+                              keyframe_id=latest.keyframe_id or latest.id, chain_depth=latest.chain_depth + 1)
+    return MapHistory(memo_id=memo_id, stored_data=map_data, chain_depth=0)
+
+def migrate_map_history_columns():
+    """差分保存の列が無い既存の map_history テーブルに列を追加する (既存の行はすべてキーフレームになる)。"""
+    existing = {column['name'] for column in sa_inspect(db.engine).get_columns('map_history')}
+    missing = [(name, ddl) for name, ddl in (
+        ('base_id', 'INTEGER'), ('keyframe_id', 'INTEGER'), ('chain_depth', 'INTEGER NOT NULL DEFAULT 0'),
+    ) if name not in existing]
+    for name, ddl in missing:
+        try:
+            with db.engine.begin() as conn: conn.execute(text(f"ALTER TABLE map_history ADD COLUMN {name} {ddl}"))
+            app.logger.info(f"Added column map_history.{name}")
+        except Exception as e:
+            # 複数のワーカーが同時に起動した場合など、他のプロセスが先に追加していれば失敗する
+            app.logger.warning(f"Could not add column map_history.{name}: {e}")
+
 # ★★★ 未定義だったCORSプリフライトリクエスト用のヘルパー関数を追加 ★★★
 def _build_cors_preflight_response():
     """CORSのプリフライトリクエストに対するレスポンスを構築する"""
@@ -323,11 +408,12 @@ def export_database_csv():
             # マップ履歴テーブル
             history_data = []
             histories = MapHistory.query.all()
+            history_maps = load_map_histories(histories)
             for history in histories:
                 history_data.append({
                     'id': history.id,
                     'memo_id': history.memo_id,
-                    'map_data': json.dumps(history.map_data, ensure_ascii=False) if history.map_data else '',
+                    'map_data': json_encoding.dumps(history_maps[history.id]) if history_maps.get(history.id) else '',
                     'created_at': history.created_at.isoformat() if history.created_at else ''
                 })
             if history_data:
@@ -343,7 +429,7 @@ def export_database_csv():
                     knowledge_maps_data.append({
                         'id': km.id,
                         'memo_id': km.memo_id,
-                        'map_data': json.dumps(km.map_data, ensure_ascii=False) if km.map_data else '',
+                        'map_data': json_encoding.dumps(km.map_data) if km.map_data else '',
                         'generated_at': km.generated_at.isoformat() if km.generated_at else ''
                     })
                 if knowledge_maps_data:
@@ -361,7 +447,7 @@ def export_database_csv():
                     'id': activity.id,
                     'user_id': activity.user_id,
                     'activity_type': activity.activity_type,
-                    'details': json.dumps(activity.details, ensure_ascii=False) if activity.details else '',
+                    'details': json_encoding.dumps(activity.details) if activity.details else '',
                     'timestamp': activity.timestamp.isoformat() if activity.timestamp else ''
                 })
             if activity_data:
@@ -445,14 +531,15 @@ def handle_single_map(memo_id):
     # --- GETリクエストの処理 ---
     if request.method == 'GET':
         app.logger.info(f"Handling GET request for map with memo_id: {memo_id}")
-        latest_history = MapHistory.query.filter_by(memo_id=memo_id).order_by(MapHistory.created_at.desc()).first()
-        print(f"Latest history for memo_id {memo_id}: {latest_history.map_data if latest_history else 'None'}")
+        latest_history = MapHistory.query.filter_by(memo_id=memo_id).order_by(MapHistory.created_at.desc(), MapHistory.id.desc()).first()
         if not latest_history:
             app.logger.warning(f"No map history found for memo_id: {memo_id}")
             return jsonify({"message": "Knowledge map history not found for this memo"}), 404
+        latest_map_data = latest_history.map_data
+        print(f"Latest history for memo_id {memo_id}: {latest_map_data}")
         return jsonify({
             "memo_id": memo_id, 
-            "map_data": latest_history.map_data, 
+            "map_data": latest_map_data, 
             "generated_at": latest_history.created_at.isoformat()
         }), 200
 
@@ -464,7 +551,7 @@ def handle_single_map(memo_id):
         if not new_map_data or 'nodes' not in new_map_data or 'edges' not in new_map_data:
             return jsonify({"message": "Invalid map data format"}), 400
         try:
-            new_history_entry = MapHistory(memo_id=memo_id, map_data=new_map_data)
+            new_history_entry = new_map_history(memo_id, new_map_data)
             db.session.add(new_history_entry)
             db.session.commit()
             return jsonify({"message": "Map history created successfully"}), 200
@@ -592,7 +679,7 @@ def create_memo_with_map():
     # --- データベースへのアトミックな保存 ---
     try:
         new_memo = Memo(user_id=user_id, content=content)
-        new_history_entry = MapHistory(map_data=map_data)
+        new_history_entry = new_map_history(None, map_data)
         new_memo.history_entries.append(new_history_entry)
         
         db.session.add(new_memo)
@@ -678,7 +765,7 @@ def generate_map_for_memo(memo_id):
 
     try:
         # 常に新しい履歴として保存
-        new_history_entry = MapHistory(memo_id=memo_id, map_data=map_data_to_save)
+        new_history_entry = new_map_history(memo_id, map_data_to_save)
         db.session.add(new_history_entry)
         db.session.commit()
         return jsonify({
@@ -800,8 +887,12 @@ def calculate_temporal_related_nodes():
     app.logger.info(f"API: Received request for temporal related nodes for: '{input_node_data.get('label')}'")
 
     try:
-        result = time_relation_logic.find_temporal_relation(input_node_data)
-        return jsonify(result), 200
+        # 段階ごとの処理時間 (JSON化を含む) とキャッシュのヒット/ミス数を Server-Timing ヘッダーで返す
+        with stage_timing.collect() as timings:
+            result = time_relation_logic.find_temporal_relation(input_node_data)
+            with stage_timing.stage("serialization"): response = jsonify(result)
+        response.headers['Server-Timing'] = timings.server_timing()
+        return response, 200
 
     except FileNotFoundError as e:
         app.logger.error(f"API Error: Master data file not found: {e}", exc_info=True)
@@ -810,6 +901,66 @@ def calculate_temporal_related_nodes():
         app.logger.error(f"API Error: Error calculating temporal related nodes for '{input_node_data.get('label')}': {e}", exc_info=True)
         return jsonify({"message": f"時系列関連ノードの算出中に予期せぬエラーが発生しました。"}), 500
 
+@app.route('/api/temporal_related_nodes/stream', methods=['POST'])
+@token_required
+def stream_temporal_related_nodes():
+    """
+    時系列関連ノードの算出結果を段階ごとに逐次返す。
+    既定は NDJSON (1行1イベント)。?format=sse または Accept: text/event-stream の場合は Server-Sent Events。
+    最後のイベントは "complete" (通常のエンドポイントと同じ結果) か "error"。
+    """
+    data = request.get_json()
+    if not data or 'node' not in data:
+        return jsonify({"message": "Request body must be JSON and contain a 'node' object"}), 400
+    input_node_data = data['node']
+    if not input_node_data.get('label'):
+        return jsonify({"message": "Node 'label' is required"}), 400
+
+    use_sse = request.args.get('format') == 'sse' or 'text/event-stream' in request.headers.get('Accept', '')
+    app.logger.info(f"API: Streaming temporal related nodes ({'sse' if use_sse else 'ndjson'}) for: '{input_node_data.get('label')}'")
+
+    def generate():
+        # ヘッダー送信後に計算するため Server-Timing は返さず、段階ごとの処理時間はヒストグラムにのみ加算する
+        with stage_timing.collect():
+            for event in time_relation_logic.stream_temporal_relation(input_node_data):
+                with stage_timing.stage("serialization"): payload = json_encoding.dumps(event)
+                yield f"event: {event['stage']}\ndata: {payload}\n\n" if use_sse else payload + "\n"
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream' if use_sse else 'application/x-ndjson')
+    # プロキシによるバッファリングを無効にし、各イベントをすぐにクライアントへ届ける
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/temporal_related_nodes/jobs', methods=['POST'])
+@token_required
+def submit_temporal_related_nodes_job():
+    """時系列関連ノードの算出をジョブとして投入し、ジョブIDを即座に返す (同じ入力のジョブは共有される)"""
+    data = request.get_json()
+    if not data or 'node' not in data:
+        return jsonify({"message": "Request body must be JSON and contain a 'node' object"}), 400
+    input_node_data = data['node']
+    if not input_node_data.get('label'):
+        return jsonify({"message": "Node 'label' is required"}), 400
+
+    try:
+        job = time_relation_logic.submit_temporal_relation_job(input_node_data)
+        app.logger.info(f"API: Temporal relation job {job['job_id']} ({job['status']}) for: '{input_node_data.get('label')}'")
+        status_code = 200 if job['status'] == 'done' else 202
+        return jsonify({**job, "status_url": f"/api/temporal_related_nodes/jobs/{job['job_id']}"}), status_code
+    except Exception as e:
+        app.logger.error(f"API Error: Failed to submit temporal relation job: {e}", exc_info=True)
+        return jsonify({"message": "ジョブの登録に失敗しました。"}), 500
+
+@app.route('/api/temporal_related_nodes/jobs/<job_id>', methods=['GET'])
+@token_required
+def get_temporal_related_nodes_job(job_id):
+    """ジョブの状態 (queued/running/done/failed) と、完了していれば結果を返す"""
+    job = time_relation_logic.get_temporal_relation_job(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found or expired"}), 404
+    return jsonify(job), 200
+
 @app.route('/api/maps/<int:memo_id>', methods=['PUT'])
 @token_required
 def update_map(memo_id):
@@ -832,7 +983,7 @@ def update_map(memo_id):
 
     try:
         app.logger.info(f"[update_map] Creating new MapHistory entry for memo_id: {memo_id}")
-        new_history_entry = MapHistory(memo_id=memo_id, map_data=new_map_data)
+        new_history_entry = new_map_history(memo_id, new_map_data)
         db.session.add(new_history_entry)
         
         app.logger.info("[update_map] Committing transaction to the database...")
@@ -863,10 +1014,11 @@ def get_user_memos(user_id):
 @app.route('/api/admin/map_history/<int:memo_id>', methods=['GET'])
 @admin_required
 def get_full_map_history(memo_id):
-    history_entries = MapHistory.query.filter_by(memo_id=memo_id).order_by(MapHistory.created_at.asc()).all()
+    history_entries = MapHistory.query.filter_by(memo_id=memo_id).order_by(MapHistory.created_at.asc(), MapHistory.id.asc()).all()
+    maps = load_map_histories(history_entries)
     return jsonify([{
         'history_id': h.id,
-        'map_data': h.map_data,
+        'map_data': maps.get(h.id),
         'created_at': h.created_at.isoformat()
     } for h in history_entries]), 200
 
@@ -900,6 +1052,35 @@ def get_system_stats():
         app.logger.error(f"Error fetching stats: {e}", exc_info=True)
         return jsonify({"message": "Failed to fetch system statistics"}), 500
 
+@app.route('/api/admin/cache_stats', methods=['GET'])
+@admin_required
+def get_cache_stats():
+    """共有キャッシュ (Wikidata検索結果など) のヒット/ミス数と段階ごとの処理時間のヒストグラムを返す (値はこのワーカープロセスでの集計)"""
+    return jsonify({"pid": os.getpid(), "caches": time_relation_logic.get_cache_stats()}), 200
+
+@app.route('/api/admin/result_cache', methods=['DELETE'])
+@admin_required
+def purge_result_cache():
+    """時系列関連ノードの結果キャッシュを全ワーカー分削除する"""
+    try:
+        deleted = time_relation_logic.clear_result_cache()
+        app.logger.info(f"Admin purged temporal relation result cache ({deleted} entries).")
+        return jsonify({"message": "Result cache purged", "deleted": deleted}), 200
+    except Exception as e:
+        app.logger.error(f"Error purging result cache: {e}", exc_info=True)
+        return jsonify({"message": "Failed to purge result cache"}), 500
+
+@app.route('/api/admin/data_reload', methods=['POST'])
+@admin_required
+def reload_data():
+    """科目マップ・マスタCSVの変更を確認し、変更があれば読み込み直す (このワーカーのみ。他のワーカーは定期的な確認で切り替わる)"""
+    try:
+        summary = time_relation_logic.reload_data_snapshot()
+        return jsonify({"pid": os.getpid(), **summary}), 200
+    except Exception as e:
+        app.logger.error(f"Error reloading data: {e}", exc_info=True)
+        return jsonify({"message": "Failed to reload data"}), 500
+
 import uuid # ★ 変更点: UUIDライブラリをインポート
 
 @app.route('/api/nodes/create_manual', methods=['POST'])
@@ -983,7 +1164,7 @@ def rollback_map_history(memo_id):
         return jsonify({"message": "Target history entry not found"}), 404
 
     try:
-        new_history_entry = MapHistory(memo_id=memo_id, map_data=target_history.map_data)
+        new_history_entry = new_map_history(memo_id, target_history.map_data)
         db.session.add(new_history_entry)
         db.session.commit()
         return jsonify({"message": "Rollback successful"}), 201
@@ -1033,7 +1214,7 @@ def backup_database():
                                 values.append('NULL')
                             elif isinstance(value, str):
                                 values.append(f"'{value.replace("'", "''")}'")
-                            elif isinstance(value, dict):
+                            elif isinstance(value, (dict, list)):
                                 values.append(f"'{json.dumps(value).replace("'", "''")}'")
                             else:
                                 values.append(str(value))
@@ -1071,7 +1252,7 @@ def get_combined_map():
         # サブクエリを使って、最新の履歴のみを効率的に取得
         latest_maps = db.session.query(
             User.username,
-            MapHistory.map_data
+            MapHistory
         ).join(
             latest_history_subquery,
             and_(
@@ -1081,10 +1262,11 @@ def get_combined_map():
         ).join(Memo, MapHistory.memo_id == Memo.id)\
          .join(User, Memo.user_id == User.id).all()
 
-        # フロントエンドが扱いやすい形式に整形
+        # 差分で保存された版を復元し、フロントエンドが扱いやすい形式に整形
+        maps = load_map_histories([history for _, history in latest_maps])
         response_data = [
-            {"username": username, "map_data": map_data}
-            for username, map_data in latest_maps
+            {"username": username, "map_data": maps.get(history.id)}
+            for username, history in latest_maps
         ]
         
         return jsonify(response_data), 200
@@ -1096,8 +1278,10 @@ def get_combined_map():
 # ★★★ 修正点: アプリケーション起動時にテーブルを自動作成する処理 ★★★
 with app.app_context():
     db.create_all()
+    migrate_map_history_columns()
     app.logger.info("Database tables checked and created on startup if they didn't exist.")
 
 if __name__ == '__main__':
+    time_relation_logic.start_data_reloader()
     # ローカルでの実行時にもテーブルが作成される
     app.run(debug=True, port=5001)
\ No newline at end of file
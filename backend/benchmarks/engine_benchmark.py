@@ -0,0 +1,271 @@
+# benchmarks/engine_benchmark.py (推薦エンジンの段階別ベンチマーク)
+#
+# 使い方 (backend/ ディレクトリで実行):
+#   python benchmarks/engine_benchmark.py                                   # small 規模の合成データで計測
+#   python benchmarks/engine_benchmark.py --scale medium --compiled --json engine_medium.json
+#   python benchmarks/engine_benchmark.py --subjects 500 --nodes 50000 --data-dir /tmp/engine_bench   # 生成データを再利用
+#   python benchmarks/engine_benchmark.py --compare benchmarks/baselines/engine_small.json            # 基準値と比較 (悪化時は終了コード1)
+#
+# synthetic_data.py で生成した合成データのディレクトリをカレントにして time_relation_logic を読み込み、
+# find_temporal_relation を繰り返し実行して段階ごとの処理時間を集計する。
+#   - OpenAI と Wikidata への通信は、合成データと一緒に生成した応答を返す偽の関数に置き換える (ネットワーク不要)
+#   - 段階の時間は、エンジンの関数をモジュール上で計測用のラッパーに差し替えて測る (処理の流れは本番と同じ)
+#       input_features: 入力ノードの特徴量生成 (偽のAPI応答)   field_match: 最も類似した学問分野の特定
+#       subject_ranking: 全科目のスコア計算と上位科目の選択    subgraph_extraction: 科目マップからの部分木の抽出と結合
+#       serialization: 結果のJSON化 (API と同じ json_encoding の設定)   other: 上記以外 (全体との差)
+#   - 結果キャッシュは無効にし、全クエリを --warmup + --repeat 周実行して最初の --warmup 周は集計しない
+#   - 計測中は WARNING 以下のログを出力しない (ログ出力のコストは含まない)
+#   - --compiled を指定すると build_data.py (embeddings, columnar, field-matrix, --ann 時は ann) を実行してから計測する
+# 規模の目安: small=200科目/1万ノード、medium=1000科目/10万ノード、large=5000科目/100万ノード (既定は1536次元)。
+# 合成CSVの埋め込みは1ノードあたり約14KBになるため、large には約14GBのディスクと長い生成時間が必要。
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+
+import synthetic_data
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCALES = {"small": (200, 10_000), "medium": (1_000, 100_000), "large": (5_000, 1_000_000)}
+# 段階ごとに計測する time_relation_logic の関数 (ジェネレーター関数は next() ごとの時間を合計する)
+STAGE_FUNCTIONS = {
+    "input_features": ("create_input_node_features",),
+    "field_match": ("find_most_similar_academic_field",),
+    "subject_ranking": ("score_subjects", "select_top_subjects"),
+    "subgraph_extraction": ("find_ann_entry_candidates", "iter_subject_subgraphs", "assemble_final_map"),
+    "serialization": (),  # 結果はレコードで組み立て済みのため、計測するのは JSON 化のみ
+}
+# 基準値と比較する際の、データ・設定が同じかを判定するパラメータ
+COMPARABLE_PARAMS = ("subjects", "nodes", "dim", "seed", "queries", "compiled", "ann", "top_k")
+
+class StageTimer:
+    """計測用ラッパーが段階ごとの経過時間を加算する。pop() で1クエリ分を取り出す。"""
+
+    def __init__(self):
+        self.current: dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.current[stage] = self.current.get(stage, 0.0) + seconds
+
+    def pop(self) -> dict[str, float]:
+        current, self.current = self.current, {}
+        return current
+
+    def wrap(self, stage: str, fn):
+        if inspect.isgeneratorfunction(fn):
+            def timed_generator(*args, **kwargs):
+                iterator = fn(*args, **kwargs)
+                while True:
+                    started = time.perf_counter()
+                    try: item = next(iterator)
+                    except StopIteration: self.add(stage, time.perf_counter() - started); return
+                    self.add(stage, time.perf_counter() - started)
+                    yield item
+            return timed_generator
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try: return fn(*args, **kwargs)
+            finally: self.add(stage, time.perf_counter() - started)
+        return timed
+
+    def install(self, module):
+        for stage, names in STAGE_FUNCTIONS.items():
+            for name in names: setattr(module, name, self.wrap(stage, getattr(module, name)))
+
+class FakeOpenAI:
+    """embeddings.create だけを持つ偽のクライアント。登録済みのテキストは指定のベクトル、それ以外はテキストから決まる乱数ベクトルを返す。"""
+
+    def __init__(self, vectors: dict[str, np.ndarray], dim: int):
+        self.vectors, self.dim = vectors, dim
+        self.embeddings = self
+
+    def _vector(self, text: str) -> list[float]:
+        vector = self.vectors.get(text)
+        if vector is None:
+            vector = np.random.default_rng(int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16)).standard_normal(self.dim)
+            vector /= np.linalg.norm(vector)
+        return vector.tolist()
+
+    def create(self, input, model):
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=self._vector(text)) for i, text in enumerate(input)])
+
+def install_stubs(trl, queries: list[dict], query_embeddings: np.ndarray):
+    """OpenAI クライアントと Wikidata への問い合わせを、合成データの応答を返す偽物に置き換える。"""
+    vectors = {trl.normalize_embedding_text(f"{q['label']} {q['sentence']}"): query_embeddings[i] for i, q in enumerate(queries)}
+    trl._openai_client, trl._openai_client_initialized = FakeOpenAI(vectors, query_embeddings.shape[1]), True
+    term_qids = {term: qid for q in queries for term, qid in q["term_qids"].items()}
+    neighbor_qids = {qid: set(neighbors) for q in queries for qid, neighbors in q["neighbor_qids"].items()}
+    trl._request_wikidata_entity_qid = lambda term: term_qids.get(term)
+    trl._request_neighbor_qids = lambda qid: set(neighbor_qids.get(qid, ()))
+    trl._request_neighbor_qids_batch = lambda qids: {qid: set(neighbor_qids.get(qid, ())) for qid in qids}
+
+def configure_environment(data_dir: str, args) -> dict:
+    """time_relation_logic の import 前に設定する環境変数 (出力先・キャッシュは全て合成データのディレクトリ内)。"""
+    return {
+        "COMPILED_DATA_DIR": os.path.join(data_dir, "compiled_data"),
+        "CACHE_DB_PATH": os.path.join(data_dir, "cache", "benchmark_cache.sqlite3"),
+        "RESULT_CACHE_ENABLED": "0", "DATA_RELOAD_INTERVAL": "0", "EMBEDDING_BATCH_WAIT_MS": "0",
+        "USE_ANN_ENTRY_POINTS": "1" if args.ann else "0", "TOP_K_SUBJECTS": str(args.top_k),
+    }
+
+def run_build_steps(data_dir: str, steps: list[str], env: dict) -> dict:
+    """build_data.py の各手順を合成データのディレクトリで実行し、手順ごとの秒数を返す。"""
+    seconds = {}
+    for step in steps:
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, os.path.join(BACKEND_DIR, "build_data.py"), step], cwd=data_dir, env=env, capture_output=True, text=True)
+        if proc.returncode != 0: raise RuntimeError(f"build_data.py {step} に失敗しました:\n{proc.stderr[-2000:]}")
+        seconds[step] = round(time.perf_counter() - started, 2)
+    return seconds
+
+def _summary_ms(values: list[float]) -> dict:
+    ms = np.asarray(values) * 1000
+    return {"count": len(ms), "mean_ms": round(float(ms.mean()), 3), "p50_ms": round(float(np.percentile(ms, 50)), 3),
+            "p95_ms": round(float(np.percentile(ms, 95)), 3), "max_ms": round(float(ms.max()), 3)}
+
+def measure(data_dir: str, args) -> dict:
+    """合成データのディレクトリをカレントにしてエンジンを読み込み、データの読み込みと各クエリの段階別の時間を計測する。"""
+    os.chdir(data_dir)
+    sys.path.insert(0, BACKEND_DIR)
+    logging.disable(logging.WARNING)
+    import time_relation_logic as trl
+    import json_encoding
+
+    queries, query_embeddings = synthetic_data.load_queries(data_dir)
+    install_stubs(trl, queries, query_embeddings)
+
+    load = {}
+    started = time.perf_counter()
+    snapshot = trl.get_data_snapshot()
+    snapshot.master_data
+    load["master_data_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    subject_names = list(snapshot.signatures["subjects"])[:trl.Config.SUBJECT_MAP_CACHE_SIZE]
+    started = time.perf_counter()
+    loaded = sum(snapshot.subject_map(name) is not None for name in subject_names)
+    load["subject_maps"] = loaded
+    load["subject_maps_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    load["per_subject_map_ms"] = round(load["subject_maps_ms"] / max(loaded, 1), 3)
+
+    timer = StageTimer()
+    timer.install(trl)
+    samples = {stage: [] for stage in (*STAGE_FUNCTIONS, "other", "total")}
+    sizes = {"nodes": [], "edges": [], "json_bytes": []}
+    for pass_index in range(args.warmup + args.repeat):
+        for q in queries:
+            started = time.perf_counter()
+            result = trl.find_temporal_relation({"label": q["label"], "sentence": q["sentence"], "year": q["year"], "extend_query": q["extend_query"]})
+            serialize_started = time.perf_counter()
+            body = json_encoding.dumps_bytes(result, sort_keys=True)  # jsonify (FastJSONProvider) と同じ設定
+            timer.add("serialization", time.perf_counter() - serialize_started)
+            total = time.perf_counter() - started
+            stages = timer.pop()
+            if result.get("error"): raise RuntimeError(f"クエリ '{q['label']}' の計算に失敗しました: {result['error']}")
+            if pass_index < args.warmup: continue
+            for stage in STAGE_FUNCTIONS: samples[stage].append(stages.get(stage, 0.0))
+            samples["other"].append(total - sum(stages.values()))
+            samples["total"].append(total)
+            sizes["nodes"].append(sum(len(result[key]["nodes"]) for key in ("future_map", "past_map")))
+            sizes["edges"].append(sum(len(result[key]["edges"]) for key in ("future_map", "past_map")))
+            sizes["json_bytes"].append(len(body))
+    return {
+        "load": load,
+        "stages": {stage: _summary_ms(values) for stage, values in samples.items()},
+        "result_size": {f"{name}_mean": round(float(np.mean(values)), 1) for name, values in sizes.items()},
+        "json_encoder": "orjson" if json_encoding.orjson is not None else "json",
+    }
+
+def compare(report: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> list[str]:
+    """基準値より tolerance 倍以上、かつ min_delta_ms 以上遅くなった項目 (段階の中央値・読み込み時間) を返す。"""
+    mismatched = [key for key in COMPARABLE_PARAMS if report["params"].get(key) != baseline.get("params", {}).get(key)]
+    if mismatched: print(f"警告: 基準値とデータ・設定が異なります ({', '.join(mismatched)})。比較結果は参考値です。", file=sys.stderr)
+    pairs = [(f"stage:{stage}", stats["p50_ms"], report["stages"].get(stage, {}).get("p50_ms")) for stage, stats in baseline.get("stages", {}).items()]
+    pairs += [(f"load:{key}", value, report["load"].get(key)) for key, value in baseline.get("load", {}).items() if key.endswith("_ms")]
+    regressions = []
+    for name, before, after in pairs:
+        if after is None or before is None: continue
+        if after > before * tolerance and after - before >= min_delta_ms:
+            regressions.append(f"{name}: {before:.3f}ms -> {after:.3f}ms (x{after / max(before, 1e-9):.2f})")
+    return regressions
+
+def print_report(report: dict):
+    p = report["params"]
+    print(f"\n== 推薦エンジン: {p['subjects']}科目 / {p['nodes']}ノード / {p['dim']}次元 "
+          f"({'事前コンパイル済み' if p['compiled'] else 'CSV'}{', ANN' if p['ann'] else ''}, K={p['top_k']}), {p['queries']}クエリ x {p['repeat']}周")
+    load = report["load"]
+    print(f"  読み込み: マスタ {load['master_data_ms']}ms, 科目マップ {load['subject_maps']}件 {load['subject_maps_ms']}ms ({load['per_subject_map_ms']}ms/件)")
+    print(f"  {'stage':<22}{'mean':>10}{'p50':>10}{'p95':>10}{'max':>10}  (ms)")
+    for stage, stats in report["stages"].items():
+        print(f"  {stage:<22}{stats['mean_ms']:>10.3f}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}{stats['max_ms']:>10.3f}")
+    size = report["result_size"]
+    print(f"  結果: 平均 {size['nodes_mean']}ノード, {size['edges_mean']}エッジ, {size['json_bytes_mean'] / 1000:.1f}KB")
+
+def main():
+    parser = argparse.ArgumentParser(description="合成データで推薦エンジン (find_temporal_relation) の段階ごとの処理時間を計測する")
+    parser.add_argument("--scale", choices=list(SCALES), default="small", help="科目数・ノード数の既定値")
+    parser.add_argument("--subjects", type=int, help="科目数 (--scale の値を上書き)")
+    parser.add_argument("--nodes", type=int, help="全科目マップの合計ノード数 (--scale の値を上書き)")
+    parser.add_argument("--dim", type=int, default=1536, help="埋め込みの次元")
+    parser.add_argument("--queries", type=int, default=20, help="合成クエリの数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="集計する周回数")
+    parser.add_argument("--warmup", type=int, default=1, help="集計しない最初の周回数")
+    parser.add_argument("--top-k", type=int, default=1, help="TOP_K_SUBJECTS")
+    parser.add_argument("--compiled", action="store_true", help="build_data.py で事前コンパイルしてから計測する")
+    parser.add_argument("--ann", action="store_true", help="ANNインデックスで接続点候補を絞り込む (--compiled と併用)")
+    parser.add_argument("--data-dir", help="合成データの保存先 (指定時は生成済みのデータを再利用し、終了後も残す)")
+    parser.add_argument("--json", help="結果を書き出すJSONファイル (基準値として --compare に渡せる)")
+    parser.add_argument("--compare", help="比較する基準値のJSONファイル")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="悪化とみなす基準値に対する倍率")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5, help="悪化とみなす最小の差 (ミリ秒、短い段階の揺らぎを無視する)")
+    args = parser.parse_args()
+    if args.ann and not args.compiled: parser.error("--ann には --compiled が必要です")
+    subjects, nodes = args.subjects or SCALES[args.scale][0], args.nodes or SCALES[args.scale][1]
+    spec = synthetic_data.make_spec(subjects, nodes, args.dim, args.queries, args.seed)
+
+    data_dir = os.path.abspath(args.data_dir) if args.data_dir else tempfile.mkdtemp(prefix="engine_bench_")
+    original_cwd = os.getcwd()
+    try:
+        build = {"generated": synthetic_data.ensure_dataset(data_dir, spec)}
+        env_overrides = configure_environment(data_dir, args)
+        shutil.rmtree(os.path.dirname(env_overrides["CACHE_DB_PATH"]), ignore_errors=True)  # 前回の実行のキャッシュを使わない
+        shutil.rmtree(env_overrides["COMPILED_DATA_DIR"], ignore_errors=True)
+        os.environ.update(env_overrides)
+        if args.compiled:
+            steps = ["embeddings", "columnar", *(["ann"] if args.ann else []), "field-matrix"]
+            build["steps_seconds"] = run_build_steps(data_dir, steps, dict(os.environ))
+        report = {
+            "benchmark": "engine", "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                            "platform": platform.platform(), "cpu_count": os.cpu_count()},
+            "params": {**{key: spec[key] for key in ("subjects", "nodes", "dim", "seed", "queries")},
+                       "repeat": args.repeat, "warmup": args.warmup, "compiled": args.compiled, "ann": args.ann, "top_k": args.top_k},
+            "build": build, **measure(data_dir, args),
+        }
+    finally:
+        os.chdir(original_cwd)
+        if not args.data_dir: shutil.rmtree(data_dir, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance, args.min_delta_ms)
+        for line in regressions: print(f"  悪化: {line}")
+        if regressions: sys.exit(1)
+        print(f"  基準値 ({args.compare}) からの悪化はありません (許容 x{args.tolerance})。")
+
+if __name__ == "__main__":
+    main()
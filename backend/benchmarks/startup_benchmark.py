@@ -0,0 +1,91 @@
+# benchmarks/startup_benchmark.py (ワーカー起動コストの計測)
+#
+# 使い方 (backend/ ディレクトリで実行):
+#   python benchmarks/startup_benchmark.py                       # app と time_relation_logic を計測
+#   python benchmarks/startup_benchmark.py --module app --repeat 5 --top 20 --json startup.json
+#
+# モジュールごとに新しいPythonプロセスで `python -X importtime -c "import <module>"` を実行し、
+# import 完了までの時間・その時点の常駐メモリ (RSS)・最上位パッケージごとの import 時間 (各モジュールの
+# self 時間の合計なので、全パッケージの合計が全体の import 時間になる) を集計する。
+# gunicorn のワーカー起動や max_requests による再起動で毎回かかるコストの目安になる。
+# app の import はDBのテーブル作成を伴うため、DATABASE_URL 未指定時は一時ディレクトリの SQLite を使う。
+import os
+import re
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+# 子プロセスで実行するコード: import 時間と RSS (KB) を最後の行に JSON で出力する
+PROBE = """
+import json, time, resource
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+rss_kb = None
+try:
+    with open('/proc/self/status') as f:
+        rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+except OSError:
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print('__STARTUP__' + json.dumps({{'seconds': elapsed, 'rss_kb': rss_kb}}))
+"""
+
+def run_once(module: str, env: dict) -> dict:
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(module=module)],
+        cwd=BACKEND_DIR, capture_output=True, text=True, env=env
+    )
+    result = next((json.loads(line[len('__STARTUP__'):]) for line in proc.stdout.splitlines() if line.startswith('__STARTUP__')), None)
+    if proc.returncode != 0 or result is None:
+        raise RuntimeError(f"'{module}' の import に失敗しました:\n{proc.stderr[-2000:]}")
+
+    # 最上位パッケージごとの import 時間 (各モジュールの self 時間の合計)
+    packages: dict[str, float] = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match: continue
+        self_us, _, _, name = match.groups()
+        top_level = name.split('.')[0]
+        packages[top_level] = packages.get(top_level, 0.0) + int(self_us) / 1e6
+    result["packages"] = packages
+    return result
+
+def benchmark(module: str, repeat: int, top: int, env: dict) -> dict:
+    runs = [run_once(module, env) for _ in range(repeat)]
+    names = {name for run in runs for name in run["packages"]}
+    packages = {name: statistics.median(run["packages"].get(name, 0.0) for run in runs) for name in names}
+    return {
+        "module": module, "repeat": repeat,
+        "import_seconds_median": statistics.median(run["seconds"] for run in runs),
+        "rss_mb_median": statistics.median(run["rss_kb"] for run in runs) / 1024,
+        "top_packages": dict(sorted(packages.items(), key=lambda item: -item[1])[:top]),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="モジュールの import 時間とメモリ使用量を計測する")
+    parser.add_argument("--module", action="append", help="計測するモジュール (複数指定可, 既定: time_relation_logic と app)")
+    parser.add_argument("--repeat", type=int, default=3, help="計測回数 (中央値を報告)")
+    parser.add_argument("--top", type=int, default=15, help="表示するパッケージ数")
+    parser.add_argument("--json", help="結果を書き出すJSONファイル")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = {**os.environ, "PYTHONDONTWRITEBYTECODE": "1"}
+        env.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tmp_dir, "startup_benchmark.db"))
+        reports = [benchmark(module, args.repeat, args.top, env) for module in (args.module or ["time_relation_logic", "app"])]
+    for report in reports:
+        print(f"\n== import {report['module']}: {report['import_seconds_median']:.3f}秒, RSS {report['rss_mb_median']:.1f}MB (中央値, {report['repeat']}回)")
+        for name, seconds in report["top_packages"].items():
+            print(f"  {name:<32} {seconds * 1000:8.1f} ms")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# benchmarks/synthetic_data.py (ベンチマーク用の合成データ生成)
+#
+# 使い方 (backend/ ディレクトリで実行, 通常は engine_benchmark.py から呼び出す):
+#   python benchmarks/synthetic_data.py /tmp/engine_bench --subjects 200 --nodes 10000
+#
+# 推薦エンジン (time_relation_logic) が読み込むのと同じ形式のマスタCSVと科目マップCSVを、科目数・総ノード数・
+# 埋め込み次元を指定して生成する。出力先のレイアウトは backend/ と同じ (combined_data_regex.csv, UECsubject_maps11/) で、
+# そのディレクトリをカレントにすれば Config の既定パスのまま読み込める。
+#   - 各科目は埋め込みの中心ベクトルとQIDのクラスタを持ち、ノードはその近傍に生成する (類似度が一様にならないように)
+#   - 各科目マップは "<科目名>_0" をルートとする木で、各ノードの親はそれより前のノードから選ぶ
+#   - 入力クエリ (queries.json, query_embeddings.npy) と、OpenAI・Wikidata の応答の代わりに返す値も合わせて生成する
+#   - 同じパラメータとシードからは同じデータができる。spec.json が一致する生成済みのディレクトリはそのまま再利用する
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+MASTER_FILE = "combined_data_regex.csv"
+MAPS_SUBDIR = "UECsubject_maps11"
+SPEC_FILE = "spec.json"
+QUERIES_FILE = "queries.json"
+QUERY_EMBEDDINGS_FILE = "query_embeddings.npy"
+
+CLUSTER_QIDS = 60        # 科目ごとのQIDクラスタの大きさ
+NODE_QIDS = (2, 9)       # ノードごとの all_node_qids の件数 (下限, 上限+1)
+NODE_NEIGHBORS = (20, 81)
+NEIGHBOR_IN_CLUSTER = 0.7  # 隣接QIDのうち科目のクラスタから選ぶ割合 (残りは全体から)
+SUBJECT_SPREAD = 0.7     # 科目の中心ベクトルの、全科目共通の成分からのばらつき
+NODE_SPREAD = 0.8        # ノードの埋め込みの、科目の中心からのばらつき
+QUERY_SPREAD = 0.3
+
+def _unit_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def _format_embeddings(vectors: np.ndarray) -> list[str]:
+    # ノードCSVと同じ JSON 配列の文字列 (1行ずつ % で整形する方が json.dumps より大幅に速い)
+    fmt = "[" + ",".join(["%.6f"] * vectors.shape[1]) + "]"
+    return [fmt % tuple(row) for row in vectors.tolist()]
+
+def _qids(codes) -> list[str]:
+    return [f"Q{100 + int(code)}" for code in codes]
+
+def make_spec(subjects: int, nodes: int, dim: int = 1536, queries: int = 20, seed: int = 0) -> dict:
+    if subjects < 1 or nodes < subjects: raise ValueError(f"科目数は1以上、ノード数は科目数以上を指定してください (subjects={subjects}, nodes={nodes})。")
+    return {"format_version": FORMAT_VERSION, "subjects": subjects, "nodes": nodes, "dim": dim, "queries": queries, "seed": seed}
+
+def dataset_is_current(out_dir: str, spec: dict) -> bool:
+    try:
+        with open(os.path.join(out_dir, SPEC_FILE), encoding="utf-8") as f:
+            return json.load(f).get("spec") == spec
+    except (OSError, ValueError):
+        return False
+
+def generate_dataset(out_dir: str, spec: dict) -> dict:
+    """spec の規模の合成データを out_dir に書き出し、生成の概要 (秒数・ファイルサイズ) を返す。"""
+    started = time.perf_counter()
+    maps_dir = os.path.join(out_dir, MAPS_SUBDIR)
+    os.makedirs(maps_dir, exist_ok=True)
+    spec_path = os.path.join(out_dir, SPEC_FILE)
+    if os.path.exists(spec_path): os.remove(spec_path)  # 途中で中断した場合に再利用されないよう、最後に書き直す
+    for name in os.listdir(maps_dir): os.remove(os.path.join(maps_dir, name))
+
+    rng = np.random.default_rng(spec["seed"])
+    n_subjects, dim = spec["subjects"], spec["dim"]
+    pool_size = max(2000, spec["nodes"] // 2)
+    # 科目ごとのノード数 (最低1件、残りはばらつきを持たせて配分する)
+    weights = rng.gamma(2.0, 1.0, n_subjects)
+    sizes = 1 + rng.multinomial(spec["nodes"] - n_subjects, weights / weights.sum())
+    query_targets = {}
+    for q, s in enumerate(rng.integers(0, n_subjects, spec["queries"])): query_targets.setdefault(int(s), []).append(q)
+    shared = _unit_rows(rng.standard_normal(dim))
+
+    master_rows, queries, query_embeddings, total_bytes = [], [None] * spec["queries"], np.zeros((spec["queries"], dim), dtype=np.float32), 0
+    for s, n in enumerate(sizes):
+        name, year = f"合成科目{s:05d}", int(rng.integers(1, 5))
+        center = _unit_rows(shared + SUBJECT_SPREAD * _unit_rows(rng.standard_normal(dim)))
+        cluster = rng.choice(pool_size, CLUSTER_QIDS, replace=False)
+        embeddings = _unit_rows(center + NODE_SPREAD * rng.standard_normal((n, dim)) / np.sqrt(dim))
+        parents = [-1] + [int(rng.integers(0, i)) for i in range(1, n)]
+
+        ids = [f"{name}_{i}" for i in range(n)]
+        labels = [name] + [f"{name}の項目{i}" for i in range(1, n)]
+        all_qids, neighbors = [], []
+        for _ in range(n):
+            all_qids.append(_qids(rng.choice(cluster, int(rng.integers(*NODE_QIDS)), replace=False)))
+            m = int(rng.integers(*NODE_NEIGHBORS))
+            in_cluster = int(m * NEIGHBOR_IN_CLUSTER)
+            neighbors.append(sorted(set(_qids(rng.choice(cluster, in_cluster))) | set(_qids(rng.integers(0, pool_size, m - in_cluster)))))
+        nodes_df = pd.DataFrame({
+            "id": ids, "label": labels, "sentence": [f"{label}について学ぶ。" for label in labels],
+            "all_node_qids": [",".join(qids) for qids in all_qids], "representative_qid": [qids[0] for qids in all_qids],
+            "neighboring_qids": [",".join(qids) for qids in neighbors], "embedding_openai": _format_embeddings(embeddings), "year": year,
+        })
+        edges_df = pd.DataFrame({"source": [ids[p] for p in parents[1:]], "target": ids[1:]})
+        for kind, df in (("nodes", nodes_df), ("edges", edges_df)):
+            path = os.path.join(maps_dir, f"subject_map_{name}_{kind}.csv")
+            df.to_csv(path, index=False)
+            total_bytes += os.path.getsize(path)
+
+        master_rows.append({
+            "id": ids[0], "label": name, "sentence": f"{name}の概要。",
+            "all_node_qids": ",".join(_qids(cluster[:8])), "representative_qid": _qids(cluster[:1])[0],
+            "neighboring_qids": ",".join(_qids(cluster[8:48])), "embedding_openai": _format_embeddings(center[None, :])[0], "year": year,
+        })
+        # このノードに近い内容を入力したクエリ (ラベル・追加キーワードのQIDと隣接QIDは科目のクラスタから返す)
+        for q in query_targets.get(s, ()):
+            i = int(rng.integers(0, n))
+            terms = [f"用語{q}_{j}" for j in range(2)]
+            term_qids = {labels[i]: all_qids[i][0], **{term: qid for term, qid in zip(terms, rng.choice(all_qids[i], len(terms)))}}
+            queries[q] = {
+                "label": labels[i], "sentence": f"{labels[i]}に関するメモ", "year": int(rng.integers(1, 5)), "extend_query": terms,
+                "subject": name, "term_qids": term_qids,
+                "neighbor_qids": {qid: _qids(rng.choice(cluster, 15, replace=False)) for qid in set(term_qids.values())},
+            }
+            query_embeddings[q] = _unit_rows(embeddings[i] + QUERY_SPREAD * rng.standard_normal(dim) / np.sqrt(dim))
+
+    master_path = os.path.join(out_dir, MASTER_FILE)
+    pd.DataFrame(master_rows).to_csv(master_path, index=False)
+    with open(os.path.join(out_dir, QUERIES_FILE), "w", encoding="utf-8") as f:
+        json.dump(queries, f, ensure_ascii=False)
+    np.save(os.path.join(out_dir, QUERY_EMBEDDINGS_FILE), query_embeddings)
+
+    summary = {"seconds": round(time.perf_counter() - started, 2), "subject_map_mb": round(total_bytes / 1e6, 1),
+               "master_mb": round(os.path.getsize(master_path) / 1e6, 2), "max_nodes_per_subject": int(sizes.max())}
+    with open(spec_path, "w", encoding="utf-8") as f:
+        json.dump({"spec": spec, "generated": summary}, f, ensure_ascii=False, indent=2)
+    return summary
+
+def ensure_dataset(out_dir: str, spec: dict) -> dict | None:
+    """生成済みのデータが spec と一致すれば何もせず None、そうでなければ生成して概要を返す。"""
+    if dataset_is_current(out_dir, spec): return None
+    return generate_dataset(out_dir, spec)
+
+def load_queries(out_dir: str) -> tuple[list[dict], np.ndarray]:
+    with open(os.path.join(out_dir, QUERIES_FILE), encoding="utf-8") as f:
+        queries = json.load(f)
+    return queries, np.load(os.path.join(out_dir, QUERY_EMBEDDINGS_FILE))
+
+def main():
+    parser = argparse.ArgumentParser(description="推薦エンジンのベンチマーク用の合成データを生成する")
+    parser.add_argument("out_dir", help="出力先ディレクトリ")
+    parser.add_argument("--subjects", type=int, default=200)
+    parser.add_argument("--nodes", type=int, default=10_000, help="全科目マップの合計ノード数")
+    parser.add_argument("--dim", type=int, default=1536, help="埋め込みの次元")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    summary = ensure_dataset(args.out_dir, make_spec(args.subjects, args.nodes, args.dim, args.queries, args.seed))
+    print(f"生成済みのデータを再利用します: {args.out_dir}" if summary is None else f"生成しました: {args.out_dir} {summary}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# benchmarks/worker_memory.py (gunicorn ワーカーごとの固有メモリの計測)
+#
+# 使い方 (backend/ ディレクトリで実行, Linux の /proc を使用):
+#   python benchmarks/worker_memory.py                 # 各ワーカーで読み込む場合と preload の場合を比較
+#   python benchmarks/worker_memory.py --workers 4 --json worker_memory.json
+#
+# gunicorn.conf.py の設定で2通りに起動し、全ワーカーがデータを読み込み終えた時点の各ワーカーのメモリを比較する。
+#   - per-worker: GUNICORN_PRELOAD=0, GUNICORN_WARMUP=1 (各ワーカーが起動時に自分で読み込む)
+#   - preload:    GUNICORN_PRELOAD=1 (マスタープロセスで読み込んでから fork し、gc.freeze する)
+# USS (Private_Clean + Private_Dirty) はそのワーカーだけが持つメモリで、ワーカー数に比例して増える部分にあたる。
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+import threading
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WARMUP_DONE_MARKER = "事前読み込みが完了しました"
+WORKER_BOOT_MARKER = "Booting worker with pid"
+
+MODES = {
+    "per-worker": {"GUNICORN_PRELOAD": "0", "GUNICORN_WARMUP": "1"},
+    "preload": {"GUNICORN_PRELOAD": "1", "GUNICORN_WARMUP": "0"},
+}
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def read_memory_kb(pid: int) -> dict:
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit(): fields[parts[0][:-1]] = int(parts[1])
+    return {"rss": fields.get("Rss", 0), "pss": fields.get("Pss", 0), "uss": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)}
+
+def child_pids(pid: int) -> list[int]:
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(p) for p in f.read().split()]
+
+def measure_mode(mode: str, workers: int, timeout: float, settle: float, db_url: str) -> dict:
+    env = {**os.environ, **MODES[mode], "GUNICORN_WORKERS": str(workers), "DATABASE_URL": db_url}
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{_free_port()}", "app:app"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    counts = {"warmup": 0, "boot": 0}
+    def read_log():
+        for line in proc.stderr:
+            if WARMUP_DONE_MARKER in line: counts["warmup"] += 1
+            if WORKER_BOOT_MARKER in line: counts["boot"] += 1
+    threading.Thread(target=read_log, daemon=True).start()
+
+    expected_warmups = 1 if mode == "preload" else workers
+    started = time.perf_counter()
+    try:
+        while counts["warmup"] < expected_warmups or counts["boot"] < workers or len(child_pids(proc.pid)) < workers:
+            if proc.poll() is not None: raise RuntimeError(f"gunicorn が終了しました (mode={mode}, code={proc.returncode})")
+            if time.perf_counter() - started > timeout: raise TimeoutError(f"ワーカーの起動が {timeout}秒以内に完了しませんでした (mode={mode})")
+            time.sleep(0.5)
+        ready_seconds = time.perf_counter() - started
+        time.sleep(settle)
+        worker_memory = [read_memory_kb(pid) for pid in child_pids(proc.pid)]
+        master_memory = read_memory_kb(proc.pid)
+    finally:
+        proc.terminate()
+        try: proc.wait(timeout=30)
+        except subprocess.TimeoutExpired: proc.kill()
+
+    mb = lambda kb: round(kb / 1024, 1)
+    return {
+        "mode": mode, "workers": len(worker_memory), "ready_seconds": round(ready_seconds, 2),
+        "worker_uss_mb_mean": mb(statistics.mean(m["uss"] for m in worker_memory)),
+        "worker_rss_mb_mean": mb(statistics.mean(m["rss"] for m in worker_memory)),
+        "total_pss_mb": mb(master_memory["pss"] + sum(m["pss"] for m in worker_memory)),
+        "master_rss_mb": mb(master_memory["rss"]),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="preload の有無による gunicorn ワーカーのメモリ使用量を比較する")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--mode", choices=list(MODES), action="append", help="計測するモード (既定: 両方)")
+    parser.add_argument("--timeout", type=float, default=600, help="全ワーカーの読み込み完了を待つ最大秒数")
+    parser.add_argument("--settle", type=float, default=2, help="読み込み完了から計測までの待ち時間 (秒)")
+    parser.add_argument("--json", help="結果を書き出すJSONファイル")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_url = os.environ.get("DATABASE_URL") or "sqlite:///" + os.path.join(tmp_dir, "worker_memory.db")
+        reports = [measure_mode(mode, args.workers, args.timeout, args.settle, db_url) for mode in (args.mode or list(MODES))]
+    for r in reports:
+        print(f"{r['mode']:<11} workers={r['workers']} ready={r['ready_seconds']}s  USS/worker={r['worker_uss_mb_mean']}MB  "
+              f"RSS/worker={r['worker_rss_mb_mean']}MB  total PSS={r['total_pss_mb']}MB")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
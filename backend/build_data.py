@@ -0,0 +1,71 @@
+# build_data.py (事前コンパイル用コマンド)
+#
+# 使い方 (backend/ ディレクトリで実行):
+#   python build_data.py embeddings   # 科目マップの埋め込みを memmap 用の float32 行列に変換
+#   python build_data.py ann          # 上記の行列から全ノード対象の近似最近傍 (IVF) インデックスを構築
+#   python build_data.py field-matrix # 学問分野×科目の類似度行列を事前計算 (マスタCSVを更新したら再実行)
+#   python build_data.py columnar     # 科目マップCSVを列ごとの型付き .npy に変換 (不要な列は除外、IDは辞書コード化)
+#   python build_data.py embedding-cache --texts-file texts.txt
+#                                     # 1行1テキストの埋め込みを取得し、全ワーカー共有の埋め込みキャッシュに登録
+#
+# 出力先は time_relation_logic.Config.COMPILED_DATA_DIR (環境変数 COMPILED_DATA_DIR で変更可)。
+# サーバー稼働中に実行しても、各ファイルは一時ファイル経由で置き換えられる。
+import os
+import argparse
+import logging
+import time
+
+import embedding_store
+import columnar_store
+import ann_index
+import time_relation_logic
+from time_relation_logic import Config
+
+def build_embeddings(args):
+    embedding_store.build_embedding_store(args.database_dir, args.out_dir, id_col=Config.COL_ID, embedding_col=Config.COL_EMBEDDING)
+
+def build_ann(args):
+    ann_index.build_ann_index(args.out_dir, args.database_dir, id_col=Config.COL_ID, year_col=Config.COL_YEAR)
+
+def build_field_matrix(args):
+    time_relation_logic.build_field_subject_matrix(args.out_dir)
+
+def build_columnar(args):
+    columnar_store.build_columnar_store(
+        args.database_dir, os.path.join(args.out_dir, Config.COLUMNAR_SUBDIR),
+        time_relation_logic.SUBJECT_MAP_NODE_COLUMNS, time_relation_logic.SUBJECT_MAP_EDGE_COLUMNS,
+        edge_renames=time_relation_logic.SUBJECT_MAP_EDGE_RENAMES
+    )
+
+def build_embedding_cache(args):
+    if not args.texts_file:
+        logging.info("--texts-file が指定されていないため、埋め込みキャッシュの事前登録をスキップします。"); return
+    with open(args.texts_file, encoding="utf-8") as f:
+        texts = [line for line in f.read().splitlines() if line.strip()]
+    result = time_relation_logic.prefetch_embeddings(texts)
+    logging.info(f"埋め込みキャッシュ: {result}")
+
+BUILD_STEPS = {
+    "embeddings": build_embeddings,
+    "ann": build_ann,
+    "field-matrix": build_field_matrix,
+    "columnar": build_columnar,
+    "embedding-cache": build_embedding_cache,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="科目マップ・マスタデータの事前コンパイル")
+    parser.add_argument("step", choices=[*BUILD_STEPS, "all"], help="実行するビルド手順")
+    parser.add_argument("--database-dir", default=Config.DATABASE_DIR, help="科目マップCSVのディレクトリ")
+    parser.add_argument("--out-dir", default=Config.COMPILED_DATA_DIR, help="出力先ディレクトリ")
+    parser.add_argument("--texts-file", help="embedding-cache で事前取得するテキスト (1行1件)")
+    args = parser.parse_args()
+
+    steps = list(BUILD_STEPS) if args.step == "all" else [args.step]
+    for step in steps:
+        started = time.perf_counter()
+        BUILD_STEPS[step](args)
+        logging.info(f"ビルド手順 '{step}' が完了しました ({time.perf_counter() - started:.2f}秒)。")
+
+if __name__ == "__main__":
+    main()
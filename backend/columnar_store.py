@@ -0,0 +1,310 @@
+# columnar_store.py (科目マップCSVの列指向コンパイル)
+#
+# UECsubject_maps11/ のノード・エッジCSVを、全科目を1つにまとめた列ごとの型付き .npy に変換する。
+# 科目は連続した行範囲として並べ (科目でパーティション分割)、実行時は必要な列のファイルだけを
+# np.load(mmap_mode='r') で開いて該当範囲を切り出すため、CSVの全列を毎回解析する必要がなくなる。
+# 列の種類:
+#   - "id" / "qid": ノードID・QIDを辞書 (ids / qids) の整数コードで格納する (欠損は -1)
+#   - "qid_list": カンマ区切りのQID集合を CSR 形式 (indptr, codes) で格納する
+#   - "text": UTF-8 のバイト列と行ごとのオフセット (欠損は valid=False)
+#   - "number": 数値列をそのままの型で格納する
+# スコア計算・出力に使わない列 (representative_qid_description や embedding_openai など) は格納しない。
+# 埋め込みは embedding_store.py のストアから割り当てる。
+# ビルドは新しいディレクトリに書き出してから CURRENT ファイルを置き換えるため、
+# 実行中のワーカーが書きかけのファイルを開くことはない。
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import numpy as np
+import pandas as pd
+
+import embedding_store
+from qid_sparse import QidSetMatrix, QidVocabulary
+
+INDEX_FILE = "columnar_index.json"
+CURRENT_FILE = "CURRENT"
+FORMAT_VERSION = 1
+COLUMN_KINDS = ("id", "qid", "qid_list", "text", "number")
+DICTIONARY_OF_KIND = {"id": "ids", "qid": "qids", "qid_list": "qids"}
+
+EDGES_FILE_SUFFIX = "_edges.csv"
+
+def edges_path_for(database_dir: str, subject_name: str) -> str:
+    return os.path.join(database_dir, f"{embedding_store.NODES_FILE_PREFIX}{subject_name}{EDGES_FILE_SUFFIX}")
+
+def nodes_path_for(database_dir: str, subject_name: str) -> str:
+    return os.path.join(database_dir, f"{embedding_store.NODES_FILE_PREFIX}{subject_name}{embedding_store.NODES_FILE_SUFFIX}")
+
+def _signature_or_none(path: str) -> dict | None:
+    try: return embedding_store.file_signature(path)
+    except OSError: return None
+
+def _split_qids(x) -> list[str]:
+    """preprocess_master_data の集合化と同じ規則で分割し、出現順を保ったまま重複を除く。"""
+    if not isinstance(x, str) or not x.strip(): return []
+    return list(dict.fromkeys(x.split(',')))
+
+# =============================================================================
+# 1. ビルド (オフライン処理)
+# =============================================================================
+
+class _Dictionary:
+    def __init__(self):
+        self.codes: dict[str, int] = {}
+
+    def code(self, value) -> int:
+        if not isinstance(value, str): return -1
+        code = self.codes.get(value)
+        if code is None: code = self.codes[value] = len(self.codes)
+        return code
+
+def _encode_strings(values) -> tuple[np.ndarray, np.ndarray]:
+    """文字列のリストを (offsets[int64], UTF-8バイト列[uint8]) に変換する。"""
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+class _ColumnBuilder:
+    def __init__(self, kind: str, dictionary: _Dictionary | None):
+        self.kind, self.dictionary = kind, dictionary
+        self.chunks, self.lengths, self.valid = [], [], []
+
+    def extend(self, values):
+        if not values: return
+        if self.kind in ("id", "qid"):
+            self.chunks.append(np.fromiter((self.dictionary.code(v) for v in values), dtype=np.int32, count=len(values)))
+        elif self.kind == "qid_list":
+            for v in values:
+                codes = [self.dictionary.code(q) for q in _split_qids(v)]
+                self.chunks.append(np.asarray(codes, dtype=np.int32)); self.lengths.append(len(codes))
+        elif self.kind == "text":
+            for v in values:
+                self.valid.append(isinstance(v, str)); self.chunks.append(v if isinstance(v, str) else "")
+        else:
+            self.chunks.append(pd.to_numeric(pd.Series(values), errors='coerce').to_numpy())
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        if self.kind in ("id", "qid"):
+            return {"codes": np.concatenate(self.chunks) if self.chunks else np.zeros(0, dtype=np.int32)}
+        if self.kind == "qid_list":
+            indptr = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+            np.cumsum(self.lengths, out=indptr[1:])
+            return {"indptr": indptr, "codes": np.concatenate(self.chunks) if self.chunks else np.zeros(0, dtype=np.int32)}
+        if self.kind == "text":
+            offsets, data = _encode_strings(self.chunks)
+            return {"offsets": offsets, "utf8": data, "valid": np.asarray(self.valid, dtype=bool)}
+        # 科目ごとに型が異なる場合 (整数と欠損を含む実数など) は共通の型に揃える
+        return {"values": np.concatenate(self.chunks) if self.chunks else np.zeros(0)}
+
+def _read_table(path: str, columns: dict, renames: dict | None = None) -> pd.DataFrame:
+    wanted = set(columns) | set(renames or {})
+    df = pd.read_csv(path, usecols=lambda c: c in wanted)
+    if renames: df = df.rename(columns=renames)
+    for col, kind in columns.items():
+        if col not in df.columns: df[col] = np.nan
+        elif kind == "id": df[col] = df[col].astype(str)  # 実行時の astype(str) と同じ値にする
+    return df
+
+def build_columnar_store(database_dir: str, out_dir: str, node_columns: dict, edge_columns: dict,
+                         edge_renames: dict | None = None, keep_builds: int = 1) -> dict:
+    """
+    全科目マップのノード・エッジCSVを列ごとの .npy にコンパイルし、out_dir/CURRENT を新しいビルドに切り替える。
+    node_columns / edge_columns は {列名: 種類} で、ここに含まれない列は格納しない。
+
+    Returns:
+        - 書き出したインデックス (dict)
+    """
+    for col, kind in {**node_columns, **edge_columns}.items():
+        if kind not in COLUMN_KINDS: raise ValueError(f"未対応の列の種類です: {col}={kind}")
+    dictionaries = {"ids": _Dictionary(), "qids": _Dictionary()}
+    tables = {
+        "nodes": {col: _ColumnBuilder(kind, dictionaries.get(DICTIONARY_OF_KIND.get(kind))) for col, kind in node_columns.items()},
+        "edges": {col: _ColumnBuilder(kind, dictionaries.get(DICTIONARY_OF_KIND.get(kind))) for col, kind in edge_columns.items()},
+    }
+    rows = {"nodes": 0, "edges": 0}
+    subjects = {}
+
+    for nodes_path in embedding_store.list_subject_node_files(database_dir):
+        subject_name = embedding_store.subject_name_from_nodes_path(nodes_path)
+        edges_path = edges_path_for(database_dir, subject_name)
+        try:
+            df_nodes = _read_table(nodes_path, node_columns)
+            df_edges = _read_table(edges_path, edge_columns, edge_renames) if os.path.exists(edges_path) else pd.DataFrame({col: [] for col in edge_columns})
+        except Exception as e:
+            logging.error(f"列指向ストア構築: 読み込み失敗のためスキップします ({subject_name}): {e}")
+            continue
+        entry = {"source": {"nodes": _signature_or_none(nodes_path), "edges": _signature_or_none(edges_path)}}
+        for table, df in (("nodes", df_nodes), ("edges", df_edges)):
+            for col, builder in tables[table].items(): builder.extend(list(df[col]))
+            entry[table] = [rows[table], rows[table] + len(df)]
+            rows[table] += len(df)
+        subjects[subject_name] = entry
+
+    build_name = f"build-{time.time_ns()}"
+    build_dir = os.path.join(out_dir, build_name)
+    os.makedirs(build_dir)
+    columns = {}
+    for table, builders in tables.items():
+        for col, builder in builders.items():
+            for part, array in builder.arrays().items(): np.save(os.path.join(build_dir, f"{table}.{col}.{part}.npy"), array)
+        columns[table] = {col: builder.kind for col, builder in builders.items()}
+    for name, dictionary in dictionaries.items():
+        offsets, data = _encode_strings(list(dictionary.codes))
+        np.save(os.path.join(build_dir, f"dict.{name}.offsets.npy"), offsets)
+        np.save(os.path.join(build_dir, f"dict.{name}.utf8.npy"), data)
+
+    index = {
+        "format_version": FORMAT_VERSION, "rows": rows, "columns": columns,
+        "dictionary_sizes": {name: len(d.codes) for name, d in dictionaries.items()},
+        "subjects": subjects,
+    }
+    with open(os.path.join(build_dir, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    tmp_path = os.path.join(out_dir, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(build_name)
+    os.replace(tmp_path, os.path.join(out_dir, CURRENT_FILE))
+
+    # 古いビルドを削除する (実行中のワーカーが開いている memmap は削除後も有効)
+    old_builds = sorted(name for name in os.listdir(out_dir) if name.startswith("build-") and name != build_name)
+    for name in old_builds[:max(0, len(old_builds) - keep_builds)]:
+        shutil.rmtree(os.path.join(out_dir, name), ignore_errors=True)
+
+    logging.info(f"列指向ストアを構築しました: {len(subjects)}科目, ノード{rows['nodes']}行, エッジ{rows['edges']}行 -> {build_dir}")
+    return index
+
+# =============================================================================
+# 2. 実行時の読み取り (列単位の np.load(mmap_mode='r'))
+# =============================================================================
+
+def _decode_strings(offsets: np.ndarray, data: np.ndarray, start: int, end: int) -> list[str]:
+    raw = data[offsets[start]:offsets[end]].tobytes()
+    bounds = (offsets[start:end + 1] - offsets[start]).tolist()
+    return [raw[a:b].decode("utf-8") for a, b in zip(bounds[:-1], bounds[1:])]
+
+class ColumnarStore:
+    """ビルド済みの列ファイルを必要になった列だけ開き、科目単位の行範囲を返す。"""
+
+    def __init__(self, store_dir: str, database_dir: str | None = None):
+        with open(os.path.join(store_dir, CURRENT_FILE), encoding="utf-8") as f:
+            self.build_name = f.read().strip()
+        self.build_dir = os.path.join(store_dir, self.build_name)
+        with open(os.path.join(self.build_dir, INDEX_FILE), encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"未対応の列指向ストア形式です: {index.get('format_version')}")
+        self.store_dir, self.database_dir = store_dir, database_dir
+        self.rows: dict = index["rows"]
+        self.columns: dict = index["columns"]
+        self.subjects: dict = index["subjects"]
+        self._lock = threading.Lock()
+        self._arrays: dict[str, np.ndarray] = {}
+        self._dictionaries: dict[str, np.ndarray] = {}
+        self._qid_id_maps: dict[int, np.ndarray] = {}
+
+    def __contains__(self, subject_name: str) -> bool:
+        return subject_name in self.subjects
+
+    def is_fresh(self, subject_name: str) -> bool:
+        """元のノード・エッジCSVがビルド後に変更されていないかを確認する。"""
+        entry = self.subjects.get(subject_name)
+        if entry is None: return False
+        if self.database_dir is None: return True
+        return (_signature_or_none(nodes_path_for(self.database_dir, subject_name)) == entry["source"]["nodes"]
+                and _signature_or_none(edges_path_for(self.database_dir, subject_name)) == entry["source"]["edges"])
+
+    def _array(self, name: str) -> np.ndarray:
+        array = self._arrays.get(name)
+        if array is None:
+            array = np.load(os.path.join(self.build_dir, f"{name}.npy"), mmap_mode='r')
+            with self._lock: self._arrays[name] = array
+        return array
+
+    def dictionary(self, name: str) -> np.ndarray:
+        """辞書 (ids / qids) のコード→文字列の対応表。初回のみ全体を復号する。"""
+        values = self._dictionaries.get(name)
+        if values is None:
+            offsets = self._array(f"dict.{name}.offsets")
+            decoded = _decode_strings(offsets, self._array(f"dict.{name}.utf8"), 0, len(offsets) - 1)
+            values = np.empty(len(decoded) + 1, dtype=object)
+            values[:-1] = decoded
+            values[-1] = np.nan  # コード -1 (欠損)
+            with self._lock: self._dictionaries[name] = values
+        return values
+
+    def _qid_id_map(self, vocabulary: QidVocabulary) -> np.ndarray:
+        """qids 辞書のコード→vocabulary の整数ID。辞書全体を一度だけ登録する (末尾はコード -1 用の -1)。"""
+        id_map = self._qid_id_maps.get(id(vocabulary))
+        if id_map is None:
+            id_map = vocabulary.encode(self.dictionary("qids").tolist())
+            with self._lock: self._qid_id_maps[id(vocabulary)] = id_map
+        return id_map
+
+    def qid_ids(self, subject_name: str, col: str, vocabulary: QidVocabulary) -> np.ndarray:
+        """qid 列を vocabulary の整数ID (欠損は -1) の配列として返す。"""
+        start, end = self.subjects[subject_name]["nodes"]
+        return self._qid_id_map(vocabulary)[self._array(f"nodes.{col}.codes")[start:end]]
+
+    def qid_matrix(self, subject_name: str, col: str, vocabulary: QidVocabulary) -> QidSetMatrix:
+        """qid_list 列を文字列の set を経由せずに、vocabulary の整数IDによるCSR行列として返す。"""
+        start, end = self.subjects[subject_name]["nodes"]
+        indptr = np.array(self._array(f"nodes.{col}.indptr")[start:end + 1])
+        codes = self._array(f"nodes.{col}.codes")[indptr[0]:indptr[-1]]
+        return QidSetMatrix(indptr - indptr[0], self._qid_id_map(vocabulary)[codes])
+
+    def _column(self, table: str, col: str, start: int, end: int):
+        kind = self.columns[table][col]
+        prefix = f"{table}.{col}"
+        if kind in ("id", "qid"):
+            return self.dictionary(DICTIONARY_OF_KIND[kind])[self._array(f"{prefix}.codes")[start:end]].tolist()
+        if kind == "qid_list":
+            indptr = self._array(f"{prefix}.indptr")[start:end + 1]
+            values = self.dictionary("qids")[self._array(f"{prefix}.codes")[indptr[0]:indptr[-1]]].tolist()
+            bounds = (indptr - indptr[0]).tolist()
+            return [set(values[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+        if kind == "text":
+            values = _decode_strings(self._array(f"{prefix}.offsets"), self._array(f"{prefix}.utf8"), start, end)
+            valid = self._array(f"{prefix}.valid")[start:end]
+            return values if valid.all() else [v if ok else np.nan for v, ok in zip(values, valid)]
+        return np.array(self._array(f"{prefix}.values")[start:end])
+
+    def table(self, subject_name: str, table: str, columns=None) -> pd.DataFrame:
+        """
+        科目の nodes / edges 表を、指定した列 (省略時は格納済みの全列) だけ読み込んで返す。
+        qid_list 列は preprocess_master_data と同じく文字列の set として復元する。
+        """
+        start, end = self.subjects[subject_name][table]
+        columns = list(self.columns[table]) if columns is None else [col for col in columns if col in self.columns[table]]
+        return pd.DataFrame({col: self._column(table, col, start, end) for col in columns}, index=pd.RangeIndex(end - start))
+
+    def nodes(self, subject_name: str, columns=None) -> pd.DataFrame:
+        return self.table(subject_name, "nodes", columns)
+
+    def edges(self, subject_name: str, columns=None) -> pd.DataFrame:
+        return self.table(subject_name, "edges", columns)
+
+_store_lock = threading.Lock()
+_store_cache: dict = {}
+
+def get_columnar_store(store_dir: str, database_dir: str | None = None) -> ColumnarStore | None:
+    """ビルド済みストアをプロセス内で一度だけ開いて返す。未ビルドの場合は None。"""
+    key = (os.path.abspath(store_dir), database_dir)
+    if key in _store_cache: return _store_cache[key]
+    with _store_lock:
+        if key not in _store_cache:
+            store = None
+            if os.path.exists(os.path.join(store_dir, CURRENT_FILE)):
+                try:
+                    store = ColumnarStore(store_dir, database_dir)
+                    logging.info(f"列指向ストアを開きました: {len(store.subjects)}科目 ({store.build_dir})")
+                except Exception as e:
+                    logging.error(f"列指向ストアを開けませんでした ({store_dir}): {e}")
+            _store_cache[key] = store
+        return _store_cache[key]
+
+def reset_columnar_store_cache():
+    with _store_lock: _store_cache.clear()
@@ -0,0 +1,82 @@
+# embedding_service.py (埋め込み取得のマイクロバッチ化)
+#
+# 複数のリクエスト (グリーンレット) が同時に埋め込みを必要とした場合に、数ミリ秒だけ要求を溜めてから
+# 1回の embeddings.create にまとめて送り、結果を各呼び出し元へ振り分ける。
+# 同じテキストが処理中であれば新たに送信せず、その結果を待つ。
+# 送信関数 (テキストのリスト→ベクトルのリスト) は外部から渡すため、偽のサーバーに差し替えて試験できる。
+import time
+import logging
+import threading
+from concurrent.futures import Future
+
+class EmbeddingBatcher:
+    """
+    埋め込み要求をまとめて送信するバッチャー。
+
+    最初に要求を追加した呼び出し元 (リーダー) が max_wait_ms だけ待ってからバッチを送信する。
+    待機中にバッチが max_batch_size に達した場合は、その時点で追加した呼び出し元が送信する。
+    """
+
+    def __init__(self, embed_batch_fn, max_batch_size: int = 64, max_wait_ms: float = 5.0, name: str = "embeddings"):
+        self.embed_batch_fn = embed_batch_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms / 1000)
+        self.name = name
+        self._lock = threading.Lock()
+        self._in_flight: dict[str, Future] = {}
+        self._current: list | None = None  # 送信待ちのバッチ [(text, future), ...]
+        self._stats = {"requests": 0, "coalesced": 0, "batches": 0, "texts_sent": 0, "max_batch_size": 0, "errors": 0, "latency_ms_total": 0.0, "latency_ms_max": 0.0}
+
+    def embed(self, text: str, timeout: float | None = None):
+        """text の埋め込みを返す (取得に失敗した場合は None)。"""
+        leader_batch, full_batch = None, None
+        with self._lock:
+            self._stats["requests"] += 1
+            future = self._in_flight.get(text)
+            if future is not None:
+                self._stats["coalesced"] += 1
+            else:
+                future = Future()
+                self._in_flight[text] = future
+                if self._current is None: self._current = leader_batch = []
+                self._current.append((text, future))
+                if len(self._current) >= self.max_batch_size: full_batch, self._current = self._current, None
+
+        if full_batch is not None: self._send(full_batch)
+        elif leader_batch is not None:
+            if self.max_wait: time.sleep(self.max_wait)
+            with self._lock:
+                # 待機中に満杯で送信済みであれば何もしない
+                if self._current is not leader_batch: leader_batch = None
+                else: self._current = None
+            if leader_batch is not None: self._send(leader_batch)
+        return future.result(timeout=timeout)
+
+    def _send(self, batch: list):
+        texts = [text for text, _ in batch]
+        started = time.perf_counter()
+        try:
+            vectors = list(self.embed_batch_fn(texts))
+            if len(vectors) != len(texts): raise ValueError(f"応答の件数 ({len(vectors)}) が要求 ({len(texts)}) と一致しません。")
+            failed = False
+        except Exception as e:
+            logging.error(f"埋め込みの一括取得エラー ({self.name}, {len(texts)}件): {e}")
+            vectors, failed = [None] * len(texts), True
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        with self._lock:
+            for text, _ in batch: self._in_flight.pop(text, None)
+            self._stats["batches"] += 1
+            self._stats["texts_sent"] += len(texts)
+            self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(texts))
+            self._stats["latency_ms_total"] += elapsed_ms
+            self._stats["latency_ms_max"] = max(self._stats["latency_ms_max"], elapsed_ms)
+            if failed: self._stats["errors"] += 1
+        for (_, future), vector in zip(batch, vectors): future.set_result(vector)
+
+    def stats(self) -> dict:
+        with self._lock: stats = dict(self._stats)
+        batches = stats["batches"]
+        stats["avg_batch_size"] = stats["texts_sent"] / batches if batches else 0.0
+        stats["avg_latency_ms"] = stats.pop("latency_ms_total") / batches if batches else 0.0
+        return stats
@@ -0,0 +1,198 @@
+# embedding_store.py (科目マップ埋め込みのバイナリストア)
+#
+# UECsubject_maps11/ の各ノードCSVに JSON 文字列として格納された embedding_openai を、
+# 1つの連続した float32 行列 (embeddings.f32) と行→(科目, ノードID) のインデックスに事前コンパイルする。
+# 行列の各行は長さ1に正規化して格納するため、実行時はコピーや再正規化をせずに memmap のまま類似度を計算できる
+# (元の長さは embedding_norms.f32 に格納する)。
+# 実行時は np.memmap で読み取り専用に開くため、gunicorn の各ワーカーはOSのページキャッシュ上の
+# 同じ実体を共有し、ワーカーごとにデコード済みの配列を保持する必要がなくなる。
+# ビルドは新しいディレクトリ (embeddings-<時刻>) に行列・ノルム・インデックスを書き出してから CURRENT_FILE を
+# 置き換えるため、実行中のワーカーや再読み込みが新旧のファイルを組み合わせて開くことはない。
+import os
+import glob
+import json
+import time
+import shutil
+import logging
+import threading
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+MATRIX_FILE = "embeddings.f32"
+NORMS_FILE = "embedding_norms.f32"
+INDEX_FILE = "embeddings_index.json"
+CURRENT_FILE = "embeddings.CURRENT"
+BUILD_DIR_PREFIX = "embeddings-"
+FORMAT_VERSION = 2
+
+NODES_FILE_PREFIX = "subject_map_"
+NODES_FILE_SUFFIX = "_nodes.csv"
+
+def subject_name_from_nodes_path(path: str) -> str:
+    name = os.path.basename(path)
+    return name[len(NODES_FILE_PREFIX):-len(NODES_FILE_SUFFIX)]
+
+def list_subject_node_files(database_dir: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(database_dir, f"{NODES_FILE_PREFIX}*{NODES_FILE_SUFFIX}")))
+
+def file_signature(path: str) -> dict:
+    st = os.stat(path)
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+def _parse_embedding(x) -> np.ndarray | None:
+    if not isinstance(x, str) or not x.startswith('['): return None
+    return np.asarray(json.loads(x), dtype=np.float32)
+
+# =============================================================================
+# 1. ビルド (オフライン処理)
+# =============================================================================
+
+def build_embedding_store(database_dir: str, out_dir: str, id_col: str = 'id', embedding_col: str = 'embedding_openai',
+                          keep_builds: int = 1) -> dict:
+    """
+    全科目マップのノード埋め込みを長さ1に正規化した float32 行列に書き出し、out_dir/CURRENT_FILE を新しいビルドに切り替える。
+    埋め込みが無い行はゼロベクトルとして格納する (コサイン類似度は0となり、従来の None と同じ扱いになる)。
+
+    Returns:
+        - 書き出したインデックス (dict)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    node_files = list_subject_node_files(database_dir)
+    subjects, node_ids, vectors = {}, [], []
+
+    for path in node_files:
+        subject_name = subject_name_from_nodes_path(path)
+        try:
+            df = pd.read_csv(path, usecols=lambda c: c in (id_col, embedding_col))
+        except Exception as e:
+            logging.error(f"埋め込みストア構築: 読み込み失敗のためスキップします ({path}): {e}")
+            continue
+        start = len(node_ids)
+        embeddings = df[embedding_col] if embedding_col in df.columns else [None] * len(df)
+        for node_id, raw in zip(df[id_col].astype(str), embeddings):
+            node_ids.append(node_id); vectors.append(_parse_embedding(raw))
+        subjects[subject_name] = {"start": start, "end": len(node_ids), "source": file_signature(path)}
+
+    # 次元は最も多い埋め込みの次元とする (それ以外の次元の行はゼロベクトルになる)
+    dims = Counter(vec.shape[0] for vec in vectors if vec is not None)
+    dim = dims.most_common(1)[0][0] if dims else 0
+    matrix = np.zeros((len(vectors), dim), dtype=np.float32)
+    for i, vec in enumerate(vectors):
+        if vec is not None and vec.shape[0] == dim: matrix[i] = vec
+        elif vec is not None: logging.warning(f"埋め込みストア構築: 次元が一致しないためゼロベクトルとします ({node_ids[i]})")
+    norms = np.linalg.norm(matrix, axis=1).astype(np.float32) if dim else np.zeros(len(vectors), dtype=np.float32)
+    np.divide(matrix, norms[:, None], out=matrix, where=norms[:, None] != 0)
+
+    build_name = f"{BUILD_DIR_PREFIX}{time.time_ns()}"
+    build_dir = os.path.join(out_dir, build_name)
+    os.makedirs(build_dir)
+    index = {
+        "format_version": FORMAT_VERSION, "dtype": "float32", "build": build_name,
+        "rows": len(node_ids), "dim": dim,
+        "subjects": subjects, "node_ids": node_ids,
+    }
+    matrix.tofile(os.path.join(build_dir, MATRIX_FILE))
+    norms.tofile(os.path.join(build_dir, NORMS_FILE))
+    with open(os.path.join(build_dir, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    tmp_path = os.path.join(out_dir, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(build_name)
+    os.replace(tmp_path, os.path.join(out_dir, CURRENT_FILE))
+
+    # 古いビルドを削除する (実行中のワーカーが開いている memmap は削除後も有効)
+    old_builds = sorted(name for name in os.listdir(out_dir) if name.startswith(BUILD_DIR_PREFIX) and name != build_name)
+    for name in old_builds[:max(0, len(old_builds) - keep_builds)]:
+        shutil.rmtree(os.path.join(out_dir, name), ignore_errors=True)
+
+    logging.info(f"埋め込みストアを構築しました: {len(subjects)}科目, {len(node_ids)}行 x {dim}次元 -> {build_dir}")
+    return index
+
+# =============================================================================
+# 2. 実行時の読み取り (np.memmap)
+# =============================================================================
+
+class EmbeddingStore:
+    """ビルド済み埋め込み行列を np.memmap で読み取り専用に開き、科目単位の行スライスを返す。"""
+
+    def __init__(self, store_dir: str, database_dir: str | None = None):
+        with open(os.path.join(store_dir, CURRENT_FILE), encoding="utf-8") as f:
+            self.build_name = f.read().strip()
+        self.build_dir = os.path.join(store_dir, self.build_name)
+        with open(os.path.join(self.build_dir, INDEX_FILE), encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"未対応の埋め込みストア形式です: {index.get('format_version')}")
+        self.store_dir, self.database_dir = store_dir, database_dir
+        self.rows, self.dim = index["rows"], index["dim"]
+        self.subjects: dict = index["subjects"]
+        self.node_ids: list[str] = index["node_ids"]
+        shape = (self.rows, self.dim)
+        self.matrix = np.memmap(os.path.join(self.build_dir, MATRIX_FILE), dtype=np.float32, mode='r', shape=shape) if self.rows and self.dim else np.zeros(shape, dtype=np.float32)
+        self.norms = np.memmap(os.path.join(self.build_dir, NORMS_FILE), dtype=np.float32, mode='r', shape=(self.rows,)) if self.rows else np.zeros(0, dtype=np.float32)
+        # 行番号→科目の逆引き用 (科目ごとの開始行の昇順)
+        ordered = sorted(self.subjects.items(), key=lambda item: item[1]["start"])
+        self._subject_names = [name for name, _ in ordered]
+        self._subject_starts = np.array([entry["start"] for _, entry in ordered], dtype=np.int64)
+
+    def __contains__(self, subject_name: str) -> bool:
+        return subject_name in self.subjects
+
+    def is_fresh(self, subject_name: str) -> bool:
+        """元のノードCSVがビルド後に変更されていないかを確認する。"""
+        entry = self.subjects.get(subject_name)
+        if entry is None: return False
+        if self.database_dir is None: return True
+        path = os.path.join(self.database_dir, f"{NODES_FILE_PREFIX}{subject_name}{NODES_FILE_SUFFIX}")
+        try: return file_signature(path) == entry["source"]
+        except OSError: return False
+
+    def locate(self, row: int) -> tuple[str, str]:
+        """行番号から (科目名, ノードID) を返す。"""
+        position = int(np.searchsorted(self._subject_starts, row, side='right')) - 1
+        return self._subject_names[position], self.node_ids[row]
+
+    def subject_slice(self, subject_name: str) -> slice:
+        entry = self.subjects[subject_name]
+        return slice(entry["start"], entry["end"])
+
+    def subject_matrix(self, subject_name: str) -> np.ndarray:
+        return self.matrix[self.subject_slice(subject_name)]
+
+    def subject_node_ids(self, subject_name: str) -> list[str]:
+        return self.node_ids[self.subject_slice(subject_name)]
+
+    def vectors_for(self, subject_name: str, node_ids) -> list[np.ndarray] | None:
+        """
+        指定した科目のノードID列に対応する埋め込みベクトル (memmap上のビュー) を返す。
+        ストアに無い・古い・IDが一致しない場合は None を返し、呼び出し側でCSVの値にフォールバックさせる。
+        """
+        if not self.is_fresh(subject_name): return None
+        ids = [str(i) for i in node_ids]
+        stored_ids = self.subject_node_ids(subject_name)
+        if ids != stored_ids: return None
+        matrix = self.subject_matrix(subject_name)
+        return [matrix[i] for i in range(len(ids))]
+
+_store_lock = threading.Lock()
+_store_cache: dict = {}
+
+def get_embedding_store(store_dir: str, database_dir: str | None = None) -> EmbeddingStore | None:
+    """ビルド済みストアをプロセス内で一度だけ開いて返す。未ビルドの場合は None。"""
+    key = (os.path.abspath(store_dir), database_dir)
+    if key in _store_cache: return _store_cache[key]
+    with _store_lock:
+        if key not in _store_cache:
+            store = None
+            if os.path.exists(os.path.join(store_dir, CURRENT_FILE)):
+                try:
+                    store = EmbeddingStore(store_dir, database_dir)
+                    logging.info(f"埋め込みストアを開きました: {store.rows}行 x {store.dim}次元 ({store.build_dir})")
+                except Exception as e:
+                    logging.error(f"埋め込みストアを開けませんでした ({store_dir}): {e}")
+            _store_cache[key] = store
+        return _store_cache[key]
+
+def reset_embedding_store_cache():
+    with _store_lock: _store_cache.clear()
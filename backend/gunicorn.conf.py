@@ -1,7 +1,9 @@
 # gunicorn.conf.py
+import os
+import gc
 
 # ワーカープロセスの数を指定
-workers = 4
+workers = int(os.getenv("GUNICORN_WORKERS", 4))
 
 # ★★★ 最も重要な設定 ★★★
 # 非同期ライブラリとしてgeventを使用するよう指定
@@ -24,3 +26,36 @@ max_requests_jitter = 50
 log_level = 'info'
 accesslog = '-'
 errorlog = '-'
+
+# --- 事前読み込み (preload) モード ---
+# GUNICORN_PRELOAD=1 の場合、マスタープロセスでアプリと読み取り専用データ (マスタデータ・埋め込み・科目マップの木構造) を
+# 読み込んでから fork する。ワーカーはそれらのメモリページをコピーオンライトで共有し、
+# max_requests による再起動時も読み込み直さない。
+# gc.freeze() で読み込み済みオブジェクトをGCの対象外にし、GCの走査による参照カウント等の書き込みでページが複製されるのを防ぐ。
+# GUNICORN_WARMUP=1 の場合は preload しないときも各ワーカーの起動時に同じデータを読み込む (計測・比較用)。
+# 起動後に DATABASE_DIR やマスタCSVが更新された場合は、各ワーカーが変更のあった部分だけを読み込み直して切り替える
+# (time_relation_logic.Config.DATA_RELOAD_INTERVAL)。preload で共有したデータのうち変更されていない部分は共有されたまま残る。
+preload_app = os.getenv("GUNICORN_PRELOAD", "0") == "1"
+warmup_workers = os.getenv("GUNICORN_WARMUP", "0") == "1"
+
+def when_ready(server):
+    if not preload_app: return
+    import time_relation_logic
+    time_relation_logic.warm_up()
+    gc.collect()
+    gc.freeze()
+    server.log.info(f"Preloaded read-only data and froze {gc.get_freeze_count()} objects before forking workers.")
+
+def post_fork(server, worker):
+    if not preload_app: return
+    # マスタープロセスで作成したDB接続をワーカー間で共有しないよう、接続プールを破棄する
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def post_worker_init(worker):
+    import time_relation_logic
+    # データの変更監視はワーカーごとに開始する (マスタープロセスのスレッドは fork 後に引き継がれない)
+    time_relation_logic.start_data_reloader()
+    if preload_app or not warmup_workers: return
+    time_relation_logic.warm_up()
@@ -0,0 +1,79 @@
+# job_queue.py (時間のかかる計算の非同期ジョブ管理)
+#
+# 投入 (submit) したジョブをプロセス内のスレッドプールで実行し、状態と結果を共有の SqliteTTLCache に保存する。
+# 状態は全ワーカーで共有されるため、投入したワーカーと異なるワーカーに問い合わせ (poll) が届いても結果を返せる。
+# ジョブIDは入力から決まる値を呼び出し側が与え、同じIDのジョブが実行中・完了済みであれば新たに実行しない (重複投入の排除)。
+# 実行中のワーカーが再起動などで停止した場合、そのジョブは running_ttl の経過後に期限切れとなり、再投入できるようになる。
+# 例外を送出せずにエラーを返す関数 (結果が "error" キーを持つ dict) も失敗として扱い、failed_ttl の経過後に再投入できるようにする。
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from persistent_cache import SqliteTTLCache
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+class JobManager:
+    """状態を共有ストアに保存する、重複排除つきのジョブ実行管理。"""
+
+    def __init__(self, store: SqliteTTLCache, max_workers: int = 2, running_ttl: float = 300, result_ttl: float = 3600, failed_ttl: float = 60):
+        self.store = store
+        self.max_workers = max(1, max_workers)
+        self.running_ttl, self.result_ttl, self.failed_ttl = running_ttl, result_ttl, failed_ttl
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "deduplicated": 0, "completed": 0, "failed": 0}
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # fork 前 (gunicorn の preload) にスレッドを作らないよう、初回の投入時に生成する
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None: self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+        return self._executor
+
+    def _count(self, name: str):
+        with self._lock: self._stats[name] += 1
+
+    def submit(self, job_id: str, fn, *args) -> dict:
+        """
+        ジョブを投入し、その時点の状態を返す。
+        同じIDのジョブが既に登録されている (実行待ち・実行中・完了) 場合は実行せず、既存の状態を返す。
+        """
+        now = time.time()
+        record = {"job_id": job_id, "status": STATUS_QUEUED, "submitted_at": now, "updated_at": now}
+        for _ in range(2):  # 既存ジョブの取得直前に期限切れになった場合は登録をやり直す
+            if self.store.add(job_id, record, ttl=self.running_ttl):
+                self._count("submitted")
+                self._get_executor().submit(self._run, job_id, record, fn, args)
+                return record
+            existing = self.store.get(job_id)
+            if existing is not None:
+                self._count("deduplicated")
+                return existing
+        raise RuntimeError(f"ジョブを登録できませんでした: {job_id}")
+
+    def get(self, job_id: str) -> dict | None:
+        return self.store.get(job_id)
+
+    def _run(self, job_id: str, record: dict, fn, args):
+        self.store.set(job_id, {**record, "status": STATUS_RUNNING, "updated_at": time.time()}, ttl=self.running_ttl)
+        try:
+            result = fn(*args)
+            if isinstance(result, dict) and result.get("error"):
+                logging.warning(f"ジョブがエラーを返しました ({job_id}): {result['error']}")
+                self.store.set(job_id, {**record, "status": STATUS_FAILED, "updated_at": time.time(), "error": str(result["error"]), "result": result}, ttl=self.failed_ttl)
+                self._count("failed")
+                return
+            self.store.set(job_id, {**record, "status": STATUS_DONE, "updated_at": time.time(), "result": result}, ttl=self.result_ttl)
+            self._count("completed")
+        except Exception as e:
+            logging.error(f"ジョブの実行に失敗しました ({job_id}): {e}", exc_info=True)
+            self.store.set(job_id, {**record, "status": STATUS_FAILED, "updated_at": time.time(), "error": str(e)}, ttl=self.failed_ttl)
+            self._count("failed")
+
+    def stats(self) -> dict:
+        with self._lock: return {**self._stats, "max_workers": self.max_workers}
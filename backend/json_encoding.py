@@ -0,0 +1,67 @@
+# json_encoding.py (APIレスポンスのJSONエンコード)
+#
+# 知識マップの結果やマップ履歴のような大きなペイロードを速く JSON にするためのエンコーダー。
+# orjson がインストールされていればそれを使い (UTF-8 のバイト列を直接生成し、NumPy の数値・配列もそのまま扱える)、
+# 無い環境では標準の json に NumPy 型の変換を加えたものにフォールバックする。どちらでも JSON としては同じ値になる
+# (orjson は非ASCII文字をエスケープしない)。
+#   - FastJSONProvider: Flask の app.json に設定し、jsonify / request.get_json をこのエンコーダーで処理する
+#   - dumps / dumps_bytes: ストリーミングやCSVエクスポートなど、レスポンス以外で JSON 文字列を作る箇所で使う
+import json
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson が無い環境では標準の json を使う
+    orjson = None
+
+# datetime は Flask の既定 (HTTP日付形式) に合わせるため、orjson には変換させず default に渡す
+_ORJSON_OPTIONS = (orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME) if orjson else 0
+
+def _default(o):
+    """標準の json / orjson が扱えない値の変換 (NumPy 型と集合、それ以外は Flask の既定の変換)。"""
+    if isinstance(o, np.generic): return o.item()
+    if isinstance(o, np.ndarray): return o.tolist()
+    if isinstance(o, (set, frozenset)): return list(o)
+    return DefaultJSONProvider.default(o)
+
+def _default_or_str(o):
+    try:
+        return _default(o)
+    except TypeError:
+        return str(o)
+
+def dumps_bytes(obj, sort_keys: bool = False) -> bytes:
+    """obj を UTF-8 の JSON バイト列にする。変換できない値は文字列にする。"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default_or_str, option=_ORJSON_OPTIONS | (orjson.OPT_SORT_KEYS if sort_keys else 0))
+    return json.dumps(obj, ensure_ascii=False, sort_keys=sort_keys, default=_default_or_str, separators=(",", ":")).encode("utf-8")
+
+def dumps(obj, sort_keys: bool = False) -> str:
+    """obj を JSON 文字列にする (非ASCII文字はエスケープしない)。変換できない値は文字列にする。"""
+    if orjson is not None: return dumps_bytes(obj, sort_keys).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, sort_keys=sort_keys, default=_default_or_str, separators=(",", ":"))
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    orjson を使う Flask の JSON プロバイダー。キーのソートなど既定のプロバイダーの設定 (sort_keys, compact) に従う。
+    整形出力 (compact=False またはデバッグモード) や orjson が無い環境では、既定のプロバイダーの処理を使う。
+    """
+    default = staticmethod(_default)
+
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is None or kwargs.keys() - {"separators"}: return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs: return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=self._options() | orjson.OPT_APPEND_NEWLINE), mimetype=self.mimetype)
+
+    def _options(self) -> int:
+        return _ORJSON_OPTIONS | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
@@ -0,0 +1,23 @@
+# lazy_imports.py (重いモジュールの遅延読み込み)
+#
+# import 文の代わりに lazy_import("pandas") のように使うと、モジュールオブジェクトだけを先に登録し、
+# 実際の読み込み (モジュール本体の実行) は最初の属性アクセス時まで遅らせる (importlib.util.LazyLoader)。
+# 一部のエンドポイントでしか使わないライブラリの読み込み時間を、ワーカー起動時から初回使用時に移すために使う。
+import sys
+import threading
+import importlib.util
+
+_lock = threading.Lock()
+
+def lazy_import(name: str):
+    """モジュールを遅延読み込みで登録して返す。既に読み込み済みの場合はそのモジュールを返す。"""
+    with _lock:
+        if name in sys.modules: return sys.modules[name]
+        spec = importlib.util.find_spec(name)
+        if spec is None: raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+        loader = importlib.util.LazyLoader(spec.loader)
+        spec.loader = loader
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        loader.exec_module(module)
+        return module
@@ -0,0 +1,87 @@
+# map_delta.py (マップの版どうしの差分)
+#
+# 知識マップ (nodes / edges を持つ JSON) の2つの版の差分を JSON Patch (RFC 6902) の操作のリストとして求め、
+# 適用して元の版を復元する。マップ履歴を差分で保存するために使う (app.py の new_map_history)。
+#   - 生成する操作は add / remove / replace のみ (move / copy / test は使わない)
+#   - オブジェクトはキーごとに再帰的に比較する。配列は先頭と末尾の一致する要素を除いた残りを位置ごとに比較し、
+#     余った要素を remove / add する (ノードの移動やラベルの変更は、そのノードの値だけの replace になる)
+#   - apply_patch は元の文書を変更せず、新しい文書を返す
+import copy
+
+def _escape(token) -> str:
+    return str(token).replace("~", "~0").replace("/", "~1")
+
+def _unescape(token: str) -> str:
+    return token.replace("~1", "/").replace("~0", "~")
+
+def _same(a, b) -> bool:
+    # JSON として同じ値か (True と 1、1 と 1.0 は入れ子の中でも別の値として扱う)
+    if type(a) is not type(b): return False
+    if isinstance(a, dict): return a.keys() == b.keys() and all(_same(value, b[key]) for key, value in a.items())
+    if isinstance(a, list): return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+    return a == b
+
+def diff(old, new, path: str = "") -> list[dict]:
+    """old を new に変換する JSON Patch の操作のリストを返す (同じ値なら空のリスト)。"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [{"op": "remove", "path": f"{path}/{_escape(key)}"} for key in old if key not in new]
+        for key, value in new.items():
+            if key not in old: ops.append({"op": "add", "path": f"{path}/{_escape(key)}", "value": value})
+            else: ops += diff(old[key], value, f"{path}/{_escape(key)}")
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        return _diff_lists(old, new, path)
+    return [] if _same(old, new) else [{"op": "replace", "path": path, "value": new}]
+
+def _diff_lists(old: list, new: list, path: str) -> list[dict]:
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and _same(old[start], new[start]): start += 1
+    end = 0
+    while end < limit - start and _same(old[len(old) - 1 - end], new[len(new) - 1 - end]): end += 1
+    old_middle, new_middle = old[start:len(old) - end], new[start:len(new) - end]
+    paired = min(len(old_middle), len(new_middle))
+    ops = []
+    for i in range(paired): ops += diff(old_middle[i], new_middle[i], f"{path}/{start + i}")
+    # 余った要素の削除は同じ位置を繰り返し、追加は前から順に挿入する (配列の末尾なら "-")
+    ops += [{"op": "remove", "path": f"{path}/{start + paired}"} for _ in range(len(old_middle) - paired)]
+    for i in range(paired, len(new_middle)):
+        index = "-" if end == 0 else start + i
+        ops.append({"op": "add", "path": f"{path}/{index}", "value": new_middle[i]})
+    return ops
+
+def _parse_index(token: str, size: int, allow_end: bool) -> int:
+    if allow_end and token == "-": return size
+    if not token.isdigit() or (len(token) > 1 and token[0] == "0"): raise ValueError(f"配列の添字が不正です: '{token}'")
+    index = int(token)
+    if index > size or (index == size and not allow_end): raise ValueError(f"配列の添字が範囲外です: {index} (要素数 {size})")
+    return index
+
+def _apply_op(document, op: dict):
+    path, kind = op["path"], op["op"]
+    if path == "":
+        if kind in ("add", "replace"): return copy.deepcopy(op["value"])
+        raise ValueError(f"文書全体に '{kind}' は適用できません。")
+    tokens = [_unescape(token) for token in path.split("/")[1:]]
+    parent = document
+    for token in tokens[:-1]:
+        parent = parent[_parse_index(token, len(parent), False)] if isinstance(parent, list) else parent[token]
+    last = tokens[-1]
+    if isinstance(parent, list):
+        index = _parse_index(last, len(parent), kind == "add")
+        if kind == "add": parent.insert(index, copy.deepcopy(op["value"]))
+        elif kind == "remove": del parent[index]
+        elif kind == "replace": parent[index] = copy.deepcopy(op["value"])
+        else: raise ValueError(f"未対応の操作です: '{kind}'")
+    else:
+        if kind in ("remove", "replace") and last not in parent: raise ValueError(f"キーが存在しません: '{path}'")
+        if kind in ("add", "replace"): parent[last] = copy.deepcopy(op["value"])
+        elif kind == "remove": del parent[last]
+        else: raise ValueError(f"未対応の操作です: '{kind}'")
+    return document
+
+def apply_patch(document, patch: list[dict]):
+    """document に patch を適用した新しい文書を返す (document は変更しない)。"""
+    document = copy.deepcopy(document)
+    for op in patch: document = _apply_op(document, op)
+    return document
@@ -0,0 +1,301 @@
+# persistent_cache.py (ワーカー間で共有する永続キャッシュ)
+#
+# functools.lru_cache はプロセスごとに独立しており、gunicorn のワーカー再起動
+# (max_requests) のたびに失われ、ワーカー数だけ重複して保持される。
+# ここでは SQLite ファイルにキー値を保存し、同一ホストの全ワーカーで共有する。
+# 値は JSON で保存し、有効期限 (TTL)・見つからなかった結果のネガティブキャッシュ・
+# ヒット/ミス数の集計に対応する。キャッシュの障害はミスとして扱い、本処理は止めない。
+# 埋め込みベクトルは SqliteEmbeddingCache で float32 のバイト列として同じファイルに保存する。
+# SQLite への接続はファイルごとにプロセスで1つだけ開き、ロックで操作を直列化して全キャッシュで共有する
+# (gevent のワーカーでは threading.local がグリーンレットごとになり、リクエストごとに接続が増えるため)。
+import os
+import json
+import time
+import hashlib
+import random
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+MISSING = object()  # lookup() で「未登録・期限切れ」を表す番兵
+
+class _SharedConnection:
+    """1つの SQLite ファイルへのプロセス内で共有する接続。操作は lock を取得して行う。"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.lock = threading.RLock()
+        self.schemas: set[str] = set()  # 実行済みの CREATE TABLE 文
+
+_connections_lock = threading.Lock()
+_connections: dict[tuple[str, int], _SharedConnection] = {}
+
+def _shared_connection(path: str, schema: str) -> _SharedConnection:
+    """
+    path への共有接続を返す (テーブルが未作成なら schema を一度だけ実行する)。
+    fork 後の子プロセスが親の接続を使わないよう、プロセスIDごとに別の接続にする。
+    """
+    key = (os.path.abspath(path), os.getpid())
+    shared = _connections.get(key)
+    if shared is None:
+        with _connections_lock:
+            shared = _connections.get(key)
+            if shared is None: shared = _connections[key] = _SharedConnection(key[0])
+    if schema not in shared.schemas:
+        with shared.lock:
+            if schema not in shared.schemas:
+                shared.conn.execute(schema); shared.schemas.add(schema)
+    return shared
+
+class SqliteTTLCache:
+    """
+    名前空間ごとに分けたキー値を SQLite に保存する TTL 付きキャッシュ。
+
+    touch_on_hit=True の場合はヒットのたびに期限を延長するため、期限の早い順が「最近使われていない順」になる。
+    max_entries を指定すると、期限切れの削除時に期限の早いものから削除して件数を上限に収める (LRU 相当)。
+    """
+
+    PURGE_EVERY_WRITES = 500
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS cache_entries ("
+        " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, is_negative INTEGER NOT NULL,"
+        " expires_at REAL NOT NULL, PRIMARY KEY (namespace, key))"
+    )
+
+    def __init__(self, path: str, namespace: str, ttl: float, negative_ttl: float | None = None,
+                 max_entries: int | None = None, touch_on_hit: bool = False):
+        self.path, self.namespace = path, namespace
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.max_entries, self.touch_on_hit = max_entries, touch_on_hit
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "negative_hits": 0, "misses": 0, "writes": 0, "errors": 0}
+
+    @contextmanager
+    def _connection(self):
+        """共有接続をロックを取得した状態で返す (トランザクションはこのブロック内で完結させる)。"""
+        shared = _shared_connection(self.path, self.SCHEMA)
+        with shared.lock: yield shared.conn
+
+    def _count(self, name: str):
+        with self._stats_lock: self._stats[name] += 1
+
+    def get(self, key: str, default=None):
+        """キャッシュ値を返す。ネガティブキャッシュの場合は None、未登録・期限切れの場合は default を返す。"""
+        value = self.lookup(key)
+        return default if value is MISSING else value
+
+    def lookup(self, key: str):
+        """get と同様だが、未登録・期限切れを MISSING で区別して返す。"""
+        try:
+            with self._connection() as conn:
+                row = conn.execute(
+                    "SELECT value, is_negative, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                    (self.namespace, key)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"永続キャッシュの読み込みに失敗しました ({self.namespace}): {e}")
+            self._count("errors"); self._count("misses")
+            return MISSING
+        if row is None or row[2] < time.time():
+            self._count("misses"); return MISSING
+        if row[1]:
+            self._count("negative_hits"); return None
+        self._count("hits")
+        if self.touch_on_hit: self._touch(key)
+        return json.loads(row[0])
+
+    def _touch(self, key: str):
+        try:
+            with self._connection() as conn:
+                conn.execute("UPDATE cache_entries SET expires_at = ? WHERE namespace = ? AND key = ?", (time.time() + self.ttl, self.namespace, key))
+        except sqlite3.Error as e:
+            logging.warning(f"永続キャッシュの期限延長に失敗しました ({self.namespace}): {e}")
+
+    def set(self, key: str, value, ttl: float | None = None):
+        """値を保存する。value が None の場合は「見つからなかった」結果として negative_ttl で保存する。ttl で個別に期限を指定できる。"""
+        is_negative = value is None
+        expires_at = time.time() + (ttl if ttl is not None else self.negative_ttl if is_negative else self.ttl)
+        try:
+            payload = None if is_negative else json.dumps(value, ensure_ascii=False)
+            with self._connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (namespace, key, value, is_negative, expires_at) VALUES (?, ?, ?, ?, ?)",
+                    (self.namespace, key, payload, int(is_negative), expires_at)
+                )
+            self._count("writes")
+            if random.randrange(self.PURGE_EVERY_WRITES) == 0: self.purge_expired()
+            elif self.max_entries and random.randrange(max(1, self.PURGE_EVERY_WRITES // 10)) == 0: self._trim()
+        except (sqlite3.Error, TypeError, ValueError) as e:  # JSON に変換できない値も書き込まずに続行する
+            logging.warning(f"永続キャッシュへの書き込みに失敗しました ({self.namespace}): {e}")
+            self._count("errors")
+
+    def add(self, key: str, value, ttl: float | None = None) -> bool:
+        """
+        キーが未登録 (または期限切れ) の場合のみ値を保存し、保存できたら True を返す。
+        同じファイルを使う全プロセスの間で排他的に判定されるため、処理の重複実行の防止に使える。
+        """
+        now = time.time()
+        try:
+            payload = json.dumps(value, ensure_ascii=False)
+            with self._connection() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ? AND expires_at < ?", (self.namespace, key, now))
+                    inserted = conn.execute(
+                        "INSERT OR IGNORE INTO cache_entries (namespace, key, value, is_negative, expires_at) VALUES (?, ?, ?, 0, ?)",
+                        (self.namespace, key, payload, now + (self.ttl if ttl is None else ttl))
+                    ).rowcount == 1
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK"); raise
+            if inserted: self._count("writes")
+            return inserted
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logging.warning(f"永続キャッシュへの追加に失敗しました ({self.namespace}): {e}")
+            self._count("errors")
+            raise
+
+    def purge_expired(self) -> int:
+        try:
+            with self._connection() as conn:
+                deleted = conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND expires_at < ?", (self.namespace, time.time())).rowcount
+            return deleted + self._trim()
+        except sqlite3.Error as e:
+            logging.warning(f"永続キャッシュの期限切れエントリ削除に失敗しました ({self.namespace}): {e}")
+            return 0
+
+    def _trim(self) -> int:
+        """件数が max_entries を超えている場合、期限の早いものから削除する。"""
+        if not self.max_entries: return 0
+        try:
+            with self._connection() as conn:
+                return conn.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key IN ("
+                    " SELECT key FROM cache_entries WHERE namespace = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.namespace, self.namespace, self.max_entries)
+                ).rowcount
+        except sqlite3.Error as e:
+            logging.warning(f"永続キャッシュの件数制限に失敗しました ({self.namespace}): {e}")
+            return 0
+
+    def clear(self) -> int:
+        try:
+            with self._connection() as conn:
+                return conn.execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,)).rowcount
+        except sqlite3.Error as e:
+            logging.warning(f"永続キャッシュの削除に失敗しました ({self.namespace}): {e}")
+            return 0
+
+    def delete_except_prefix(self, prefix: str) -> int:
+        """キーが prefix で始まらないエントリを削除し、削除件数を返す (キーの先頭にバージョンを付けた古い世代の削除用)。"""
+        try:
+            with self._connection() as conn:
+                return conn.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND substr(key, 1, ?) != ?", (self.namespace, len(prefix), prefix)
+                ).rowcount
+        except sqlite3.Error as e:
+            logging.warning(f"永続キャッシュの古い世代の削除に失敗しました ({self.namespace}): {e}")
+            return 0
+
+    def stats(self) -> dict:
+        """このプロセスでのヒット/ミス数 (ネガティブキャッシュのヒットは negative_hits)。"""
+        with self._stats_lock: stats = dict(self._stats)
+        lookups = stats["hits"] + stats["negative_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["negative_hits"]) / lookups if lookups else 0.0
+        return stats
+
+class SqliteEmbeddingCache:
+    """
+    埋め込みベクトルの永続キャッシュ。(モデル名, 正規化済みテキストの SHA-256) をキーとし、
+    ベクトルは float32 のバイト列として保存する (JSON の約1/4の大きさ)。埋め込みはモデルとテキストで決まるため期限は設けない。
+    """
+
+    def __init__(self, path: str, table: str = "embedding_cache"):
+        self.path, self.table = path, table
+        self._schema = (
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            " model TEXT NOT NULL, text_hash TEXT NOT NULL, dim INTEGER NOT NULL, vector BLOB NOT NULL,"
+            " created_at REAL NOT NULL, PRIMARY KEY (model, text_hash))"
+        )
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "errors": 0}
+
+    @contextmanager
+    def _connection(self):
+        """共有接続をロックを取得した状態で返す (トランザクションはこのブロック内で完結させる)。"""
+        shared = _shared_connection(self.path, self._schema)
+        with shared.lock: yield shared.conn
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _count(self, name: str, n: int = 1):
+        with self._stats_lock: self._stats[name] += n
+
+    def get(self, model: str, text: str) -> np.ndarray | None:
+        return self.get_many(model, [text]).get(text)
+
+    def get_many(self, model: str, texts) -> dict[str, np.ndarray]:
+        """保存済みのテキスト→ベクトル (読み取り専用の float32 配列) を返す。見つからないテキストは含めない。"""
+        hashes = {self.text_hash(text): text for text in dict.fromkeys(texts)}
+        found, hash_list = {}, list(hashes)
+        try:
+            for i in range(0, len(hash_list), 500):  # SQLite のプレースホルダ数の上限に収める
+                chunk = hash_list[i:i + 500]
+                with self._connection() as conn:
+                    rows = conn.execute(
+                        f"SELECT text_hash, dim, vector FROM {self.table} WHERE model = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                        (model, *chunk)
+                    ).fetchall()
+                for text_hash, dim, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    if vector.shape[0] == dim: found[hashes[text_hash]] = vector
+        except sqlite3.Error as e:
+            logging.warning(f"埋め込みキャッシュの読み込みに失敗しました: {e}")
+            self._count("errors")
+        self._count("hits", len(found)); self._count("misses", len(hashes) - len(found))
+        return found
+
+    def set_many(self, model: str, vectors: dict):
+        """テキスト→ベクトルをまとめて保存する (None のベクトルは保存しない)。"""
+        rows = []
+        now = time.time()
+        for text, vector in vectors.items():
+            if vector is None: continue
+            vector = np.asarray(vector, dtype=np.float32)
+            rows.append((model, self.text_hash(text), int(vector.shape[0]), vector.tobytes(), now))
+        if not rows: return
+        try:
+            with self._connection() as conn:
+                conn.execute("BEGIN")
+                try:
+                    conn.executemany(f"INSERT OR REPLACE INTO {self.table} (model, text_hash, dim, vector, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+                    conn.execute("COMMIT")
+                except sqlite3.Error:
+                    conn.execute("ROLLBACK"); raise
+            self._count("writes", len(rows))
+        except sqlite3.Error as e:
+            logging.warning(f"埋め込みキャッシュへの書き込みに失敗しました: {e}")
+            self._count("errors")
+
+    def clear(self, model: str | None = None) -> int:
+        try:
+            with self._connection() as conn:
+                if model is None: return conn.execute(f"DELETE FROM {self.table}").rowcount
+                return conn.execute(f"DELETE FROM {self.table} WHERE model = ?", (model,)).rowcount
+        except sqlite3.Error as e:
+            logging.warning(f"埋め込みキャッシュの削除に失敗しました: {e}")
+            return 0
+
+    def stats(self) -> dict:
+        with self._stats_lock: stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
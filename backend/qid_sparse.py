@@ -0,0 +1,83 @@
+# qid_sparse.py (QID集合の整数符号化と疎行列表現)
+#
+# all_node_qids / neighboring_qids を文字列の set のまま持つと、ノードごとに
+# 積集合・和集合を作ってJaccard係数を計算することになる。ここではQIDをプロセス共通の
+# 語彙で整数IDに変換し、各ノードの集合をCSR形式 (indptr, indices) の行として保持する。
+# 1つの入力集合と数千ノードとの積集合サイズは1回の疎行列ベクトル積で求まり、
+# 和集合サイズは事前計算した行の長さから得られる。
+import threading
+import numpy as np
+
+class QidVocabulary:
+    """QID文字列→整数IDの対応表。科目マップやマスタの読み込み時に採番し、全リクエストで共有する。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids: dict[str, int] = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, qids) -> np.ndarray:
+        """QID群を登録し、重複を除いた整数IDの昇順配列を返す。"""
+        ids = self._ids
+        missing = [q for q in qids if q not in ids]
+        if missing:
+            with self._lock:
+                for q in missing:
+                    if q not in ids: ids[q] = len(ids)
+        return np.unique(np.fromiter((ids[q] for q in qids), dtype=np.int32))
+
+    def encode(self, qids) -> np.ndarray:
+        """QID群を登録し、要素ごとの整数IDを入力と同じ順で返す (文字列でない・空の要素は -1)。"""
+        ids = self._ids
+        missing = [q for q in qids if isinstance(q, str) and q and q not in ids]
+        if missing:
+            with self._lock:
+                for q in missing:
+                    if q not in ids: ids[q] = len(ids)
+        return np.fromiter((ids[q] if isinstance(q, str) and q else -1 for q in qids), dtype=np.int32, count=len(qids))
+
+    def lookup(self, qids) -> np.ndarray:
+        """登録済みのQIDのみを整数IDに変換する (未登録のQIDはどのノードとも一致しないため除外してよい)。"""
+        ids = self._ids
+        return np.unique(np.fromiter((ids[q] for q in qids if q in ids), dtype=np.int32))
+
+    def id_of(self, qid) -> int:
+        return self._ids.get(qid, -1) if qid else -1
+
+qid_vocabulary = QidVocabulary()
+
+class QidSetMatrix:
+    """ノードごとのQID集合を行とするCSR形式の0/1疎行列。"""
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray):
+        self.indptr, self.indices = indptr, indices
+        self.row_lengths = np.diff(indptr)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @classmethod
+    def from_sets(cls, qid_sets, vocabulary: QidVocabulary = qid_vocabulary) -> "QidSetMatrix":
+        rows = [vocabulary.add(s) if s else np.zeros(0, dtype=np.int32) for s in qid_sets]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(r) for r in rows], out=indptr[1:])
+        indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+        return cls(indptr, indices.astype(np.int32, copy=False))
+
+    def intersection_counts(self, query_ids: np.ndarray) -> np.ndarray:
+        """各行と query_ids (整数IDの集合) との積集合サイズ。0/1行列と0/1ベクトルの積に相当する。"""
+        if len(query_ids) == 0 or len(self.indices) == 0:
+            return np.zeros(len(self), dtype=np.int64)
+        hits = np.concatenate(([0], np.cumsum(np.isin(self.indices, query_ids), dtype=np.int64)))
+        return hits[self.indptr[1:]] - hits[self.indptr[:-1]]
+
+    def take(self, positions) -> "QidSetMatrix":
+        """指定した行だけを抜き出した新しい行列を返す。"""
+        positions = np.asarray(positions, dtype=np.intp)
+        lengths = self.row_lengths[positions]
+        indptr = np.zeros(len(positions) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        gather = np.repeat(self.indptr[:-1][positions] - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return QidSetMatrix(indptr, self.indices[gather])
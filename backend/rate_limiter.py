@@ -0,0 +1,49 @@
+# rate_limiter.py (外部APIへのリクエスト頻度制御)
+#
+# 呼び出しごとに固定時間 sleep する代わりに、トークンバケットでプロセス全体の
+# リクエスト頻度を制限する。並行して呼び出されても合計が rate (回/秒) を超えず、
+# しばらく呼び出しが無かった後は burst 回まで待たずに送信できる。
+# gevent の monkey patch 下では threading.Lock / time.sleep が協調的になるため、
+# 待機中も他のグリーンレットの処理は止まらない。
+import time
+import threading
+
+class TokenBucket:
+    """rate 回/秒・最大 burst 回のトークンバケット。スレッド (グリーンレット) 間で共有できる。"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        if rate <= 0: raise ValueError("rate は正の値である必要があります。")
+        self.rate, self.capacity = float(rate), max(1, int(burst))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._waited_seconds = 0.0
+        self._acquired = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        """トークンがあれば消費して True を返す (待機しない)。"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens < 1: return False
+            self._tokens -= 1; self._acquired += 1
+            return True
+
+    def acquire(self) -> float:
+        """トークンを1つ消費する。足りない場合は補充されるまで待機し、待機した秒数を返す。"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # 先にトークンを予約 (負の残高も可) しておき、ロックの外で不足分だけ待つ
+            self._tokens -= 1; self._acquired += 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self._waited_seconds += wait
+        if wait > 0: time.sleep(wait)
+        return wait
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"rate_per_sec": self.rate, "burst": self.capacity, "acquired": self._acquired, "waited_seconds": round(self._waited_seconds, 3)}
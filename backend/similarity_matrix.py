@@ -0,0 +1,50 @@
+# similarity_matrix.py (学問分野 × 科目の類似度行列の保存・読み込み)
+#
+# 学問分野と科目の類似度は利用者の入力に依存しないため、build_data.py で全組み合わせを事前計算して
+# float64 の .npy に保存し、実行時は np.load(mmap_mode='r') で読み取り専用に開く。
+# 行列は生成元のマスタデータのバージョンと類似度の重みをメタデータとして持ち、
+# どちらかが現在の値と一致しない場合は読み込まず、呼び出し側でリクエストごとの計算にフォールバックさせる。
+import os
+import json
+import logging
+import numpy as np
+
+MATRIX_FILE = "field_subject_similarity.npy"
+META_FILE = "field_subject_similarity.json"
+FORMAT_VERSION = 1
+
+def save_similarity_matrix(out_dir: str, matrix: np.ndarray, meta: dict) -> dict:
+    """行列とメタデータを一時ファイル経由で out_dir に保存する。"""
+    os.makedirs(out_dir, exist_ok=True)
+    meta = {**meta, "format_version": FORMAT_VERSION, "shape": list(matrix.shape)}
+    tmp_path = os.path.join(out_dir, MATRIX_FILE + ".tmp.npy")
+    np.save(tmp_path, np.ascontiguousarray(matrix, dtype=np.float64))
+    os.replace(tmp_path, os.path.join(out_dir, MATRIX_FILE))
+    tmp_path = os.path.join(out_dir, META_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(out_dir, META_FILE))
+    logging.info(f"学問分野×科目の類似度行列を保存しました: {matrix.shape[0]} x {matrix.shape[1]} -> {out_dir}")
+    return meta
+
+def load_similarity_matrix(out_dir: str, expected: dict) -> np.ndarray | None:
+    """
+    保存済みの行列を読み取り専用で開く。
+    未ビルド、または expected の各項目 (マスタのバージョン・重み・行列の形状など) がメタデータと一致しない場合は None。
+    """
+    meta_path = os.path.join(out_dir, META_FILE)
+    if not os.path.exists(meta_path): return None
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != FORMAT_VERSION: return None
+        mismatched = [key for key, value in expected.items() if meta.get(key) != value]
+        if mismatched:
+            logging.info(f"学問分野×科目の類似度行列が現在のマスタデータと一致しないため使用しません ({', '.join(mismatched)})。")
+            return None
+        matrix = np.load(os.path.join(out_dir, MATRIX_FILE), mmap_mode='r')
+        if list(matrix.shape) != meta.get("shape"): return None
+        return matrix
+    except Exception as e:
+        logging.error(f"学問分野×科目の類似度行列を読み込めませんでした ({out_dir}): {e}")
+        return None
@@ -0,0 +1,138 @@
+# stage_timing.py (処理段階ごとの時間計測)
+#
+# リクエストごとに各段階の所要時間 (time.perf_counter による単調時計) とキャッシュのヒット/ミス数を集計し、
+# HTTP の Server-Timing ヘッダーの値として返す。集計中のリクエストは contextvars で保持するため、計測する関数に
+# 引数を追加する必要がない (スレッド・gevent のグリーンレットごとに別のコンテキストになる)。
+# 集計を終えたリクエストの段階ごとの合計時間は、プロセス内の段階別ヒストグラムに加算する。
+# 集計中でないとき (collect の外) の stage / count_cache は何もしない。
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+# ヒストグラムのバケットの上限 (ミリ秒)。これを超えた値は最後の溢れバケットに数える
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+class RequestTimings:
+    """1リクエスト分の段階ごとの合計時間 (秒) と、キャッシュごとの [ヒット数, ミス数]。"""
+
+    def __init__(self):
+        self.durations: dict[str, float] = {}
+        self.cache_counts: dict[str, list[int]] = {}
+        self._active: set[str] = set()
+
+    def add(self, name: str, seconds: float):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def count(self, name: str, hits: int = 0, misses: int = 0):
+        counts = self.cache_counts.setdefault(name, [0, 0])
+        counts[0] += hits; counts[1] += misses
+
+    def server_timing(self) -> str:
+        """Server-Timing ヘッダーの値 (段階は dur=ミリ秒、キャッシュは cache_<名前> の desc にヒット/ミス数)。"""
+        metrics = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.durations.items()]
+        metrics += [f'cache_{name};desc="hit={hits} miss={misses}"' for name, (hits, misses) in self.cache_counts.items()]
+        return ", ".join(metrics)
+
+    def to_dict(self) -> dict:
+        return {"durations_ms": {name: round(seconds * 1000, 3) for name, seconds in self.durations.items()},
+                "cache": {name: {"hits": hits, "misses": misses} for name, (hits, misses) in self.cache_counts.items()}}
+
+class StageHistograms:
+    """段階ごとのリクエスト単位の所要時間のヒストグラムと、キャッシュのヒット/ミス数の累計 (プロセス内)。"""
+
+    def __init__(self, buckets_ms=HISTOGRAM_BUCKETS_MS):
+        self.buckets_ms = tuple(buckets_ms)
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._stages: dict[str, dict] = {}
+        self._cache_counts: dict[str, list[int]] = {}
+
+    def observe(self, timings: RequestTimings):
+        with self._lock:
+            self._requests += 1
+            for name, seconds in timings.durations.items():
+                ms = seconds * 1000
+                hist = self._stages.get(name)
+                if hist is None: hist = self._stages[name] = {"count": 0, "sum_ms": 0.0, "max_ms": 0.0, "buckets": [0] * (len(self.buckets_ms) + 1)}
+                hist["count"] += 1; hist["sum_ms"] += ms; hist["max_ms"] = max(hist["max_ms"], ms)
+                hist["buckets"][bisect.bisect_left(self.buckets_ms, ms)] += 1
+            for name, (hits, misses) in timings.cache_counts.items():
+                counts = self._cache_counts.setdefault(name, [0, 0])
+                counts[0] += hits; counts[1] += misses
+
+    def _quantile_ms(self, hist: dict, q: float) -> float:
+        """q 分位を含むバケットの上限 (溢れバケットの場合は最大値)。"""
+        target, seen = q * hist["count"], 0
+        for bound, n in zip(self.buckets_ms, hist["buckets"]):
+            seen += n
+            if seen >= target: return float(min(bound, hist["max_ms"]))
+        return hist["max_ms"]
+
+    def stats(self) -> dict:
+        with self._lock:
+            stages = {}
+            for name, hist in self._stages.items():
+                labels = [f"le_{bound}ms" for bound in self.buckets_ms] + [f"gt_{self.buckets_ms[-1]}ms"]
+                stages[name] = {
+                    "count": hist["count"], "mean_ms": round(hist["sum_ms"] / hist["count"], 3), "max_ms": round(hist["max_ms"], 3),
+                    "p50_ms": round(self._quantile_ms(hist, 0.5), 3), "p95_ms": round(self._quantile_ms(hist, 0.95), 3),
+                    "buckets": {label: n for label, n in zip(labels, hist["buckets"]) if n},
+                }
+            cache = {name: {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0.0} for name, (hits, misses) in self._cache_counts.items()}
+            return {"requests": self._requests, "buckets_ms": list(self.buckets_ms), "stages": stages, "cache": cache}
+
+    def reset(self):
+        with self._lock: self._requests, self._stages, self._cache_counts = 0, {}, {}
+
+stage_histograms = StageHistograms()
+_current_timings: contextvars.ContextVar[RequestTimings | None] = contextvars.ContextVar("stage_timings", default=None)
+
+def current_timings() -> RequestTimings | None:
+    return _current_timings.get()
+
+@contextmanager
+def collect(histograms: StageHistograms | None = stage_histograms):
+    """
+    このブロック内の計測を1リクエスト分として集計する。既に集計中であればそれをそのまま使う
+    (ヒストグラムへの加算は最も外側のブロックの終了時に1回だけ行う)。
+    """
+    timings = _current_timings.get()
+    if timings is not None:
+        yield timings; return
+    timings = RequestTimings()
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+        if histograms is not None: histograms.observe(timings)
+
+@contextmanager
+def stage(name: str):
+    """ブロックの所要時間を段階 name に加算する。同じ段階が入れ子になった場合は外側だけを数える。"""
+    timings = _current_timings.get()
+    if timings is None or name in timings._active:
+        yield; return
+    timings._active.add(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+        timings._active.discard(name)
+
+def timed(name: str):
+    """関数全体を段階 name として計測するデコレーター。"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name): return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count_cache(name: str, hits: int = 0, misses: int = 0):
+    timings = _current_timings.get()
+    if timings is not None: timings.count(name, hits, misses)
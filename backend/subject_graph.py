@@ -0,0 +1,96 @@
+# subject_graph.py (科目マップの木構造インデックス)
+#
+# 科目マップのノード・エッジCSVを、ノードを整数IDで表した不変の木構造に変換する。
+# 親ポインタと子エッジのリストを事前に作っておくことで、ルートまでの経路抽出は O(深さ)、
+# ルート直下の子ノードの取得は O(子の数) で済む (DataFrame のブールマスクによる
+# 全エッジ走査を繰り返さない)。一度構築したオブジェクトはリクエスト間で共有する。
+import numpy as np
+
+ROOT_ID_SUFFIX = "_0"
+
+class SubjectGraph:
+    """
+    科目マップの木構造。
+
+    - node_ids: ノードID (CSVの行順)。整数ID = この並びの位置
+    - parent: 各ノードの親ノードの整数ID (無い場合は -1)
+    - children: 各ノードの子ノードの整数IDのタプル
+    - root: ルートノード ("_0" で終わるID) の整数ID (無い場合は -1)
+    - depth: 各ノードのルートからの深さ (ルートに辿り着けない場合は -1)
+    """
+
+    def __init__(self, node_ids: list[str], edge_sources: list[str], edge_targets: list[str]):
+        self.node_ids = tuple(node_ids)
+        self.edge_sources, self.edge_targets = tuple(edge_sources), tuple(edge_targets)
+        n = len(self.node_ids)
+
+        self._position: dict[str, int] = {}
+        for i, node_id in enumerate(self.node_ids): self._position.setdefault(node_id, i)
+
+        # エッジ番号をCSVの順に保持する (親は「そのノードを target とする最初のエッジ」の source)
+        self._parent_edge: dict[str, int] = {}
+        self._child_edges: dict[str, list[int]] = {}
+        for e, (source, target) in enumerate(zip(self.edge_sources, self.edge_targets)):
+            self._parent_edge.setdefault(target, e)
+            self._child_edges.setdefault(source, []).append(e)
+
+        self.parent = np.full(n, -1, dtype=np.int32)
+        for i, node_id in enumerate(self.node_ids):
+            e = self._parent_edge.get(node_id)
+            if e is not None: self.parent[i] = self._position.get(self.edge_sources[e], -1)
+        self.children = tuple(
+            tuple(self._position[self.edge_targets[e]] for e in self._child_edges.get(node_id, ()) if self.edge_targets[e] in self._position)
+            for node_id in self.node_ids
+        )
+        self.root = next((i for i, node_id in enumerate(self.node_ids) if node_id.endswith(ROOT_ID_SUFFIX)), -1)
+        self.depth = self._compute_depths()
+
+    def _compute_depths(self) -> np.ndarray:
+        depth = np.full(len(self.node_ids), -1, dtype=np.int32)
+        if self.root < 0: return depth
+        depth[self.root], frontier = 0, [self.root]
+        while frontier:
+            next_frontier = []
+            for i in frontier:
+                for c in self.children[i]:
+                    if depth[c] < 0: depth[c] = depth[i] + 1; next_frontier.append(c)
+            frontier = next_frontier
+        return depth
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def position_of(self, node_id: str) -> int:
+        return self._position.get(node_id, -1)
+
+    @staticmethod
+    def is_root_id(node_id: str) -> bool:
+        return node_id.endswith(ROOT_ID_SUFFIX)
+
+    def child_ids(self, node_id: str) -> list[str]:
+        """node_id を source とするエッジの target (CSVの順)。"""
+        return [self.edge_targets[e] for e in self._child_edges.get(node_id, ())]
+
+    def edges_within(self, node_ids) -> list[int]:
+        """両端が node_ids に含まれるエッジの番号 (CSVの順)。"""
+        node_ids = set(node_ids)
+        return sorted(e for source in node_ids for e in self._child_edges.get(source, ()) if self.edge_targets[e] in node_ids)
+
+    def path_to_root(self, node_id: str) -> tuple[list[int], list[int]]:
+        """
+        node_id からルートまで親を辿り、経路上のノード位置とエッジ番号を返す。
+        親エッジの source がノード表に無い場合は、そのエッジまでを含めて打ち切る。
+        """
+        path_nodes, path_edges = {}, {}
+        current_id = node_id
+        for _ in range(len(self.node_ids)):  # 循環がある場合の無限ループ防止
+            position = self._position.get(current_id)
+            if position is None: break
+            path_nodes.setdefault(current_id, position)
+            if self.is_root_id(current_id): break
+            e = self._parent_edge.get(current_id)
+            if e is None: break
+            parent_id = self.edge_sources[e]
+            path_edges.setdefault(f"{parent_id}->{current_id}", e)
+            current_id = parent_id
+        return list(path_nodes.values()), list(path_edges.values())
@@ -0,0 +1,11 @@
+# tests/conftest.py (テスト共通の設定)
+#
+# backend/ のモジュールを読み込めるようにし、共有キャッシュの SQLite をテストごとの一時ディレクトリに向ける
+# (time_relation_logic は読み込み時にキャッシュを開くため、読み込み前に環境変数を設定する)。
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path: sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="kmap_test_cache_"), "shared_cache.sqlite3"))
@@ -0,0 +1,41 @@
+# tests/test_job_queue.py (非同期ジョブの状態管理)
+#
+# ジョブの結果に応じて done / failed のどちらで保存されるか、失敗したジョブが failed_ttl の経過後に再投入できるかを確認する。
+import time
+
+from job_queue import STATUS_DONE, STATUS_FAILED, JobManager
+from persistent_cache import SqliteTTLCache
+
+def _wait(manager: JobManager, job_id: str) -> dict:
+    for _ in range(200):
+        job = manager.get(job_id)
+        if job and job["status"] in (STATUS_DONE, STATUS_FAILED): return job
+        time.sleep(0.01)
+    raise AssertionError(f"ジョブが終了しませんでした: {job_id}")
+
+def _manager(tmp_path, **kwargs) -> JobManager:
+    return JobManager(SqliteTTLCache(str(tmp_path / "jobs.sqlite3"), "jobs", ttl=60), max_workers=1, **kwargs)
+
+def test_successful_result_is_done(tmp_path):
+    manager = _manager(tmp_path)
+    manager.submit("ok", lambda x: {"value": x}, 3)
+    job = _wait(manager, "ok")
+    assert job["status"] == STATUS_DONE and job["result"] == {"value": 3}
+    assert manager.submit("ok", lambda x: {"value": x}, 4)["status"] == STATUS_DONE  # 完了済みのジョブは再実行しない
+
+def test_error_result_is_failed_and_can_be_resubmitted(tmp_path):
+    manager = _manager(tmp_path, failed_ttl=0.2)
+    manager.submit("err", lambda: {"future_map": {"nodes": [], "edges": []}, "error": "入力が不正です"})
+    job = _wait(manager, "err")
+    assert job["status"] == STATUS_FAILED and job["error"] == "入力が不正です"
+    assert manager.stats()["failed"] == 1 and manager.stats()["completed"] == 0
+    time.sleep(0.3)
+    manager.submit("err", lambda: {"value": 1})
+    assert _wait(manager, "err")["status"] == STATUS_DONE
+
+def test_exception_is_failed(tmp_path):
+    manager = _manager(tmp_path)
+    def boom(): raise ValueError("失敗")
+    manager.submit("boom", boom)
+    job = _wait(manager, "boom")
+    assert job["status"] == STATUS_FAILED and job["error"] == "失敗"
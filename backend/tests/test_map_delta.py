@@ -0,0 +1,66 @@
+# tests/test_map_delta.py (マップの版どうしの差分)
+#
+# diff で求めた差分を apply_patch で適用すると新しい版が型まで含めて復元されることを、
+# 入れ子の数値・真偽値の型だけが変わる場合と、ランダムなマップの組で確認する。
+import json
+import random
+import pytest
+
+import map_delta
+
+def _dump(document) -> str:
+    # json.dumps は 1 / 1.0 / true を別の文字列にするため、型の違いも比較できる
+    return json.dumps(document, sort_keys=True, ensure_ascii=False)
+
+def _assert_round_trip(old, new):
+    patch = map_delta.diff(old, new)
+    assert _dump(map_delta.apply_patch(old, patch)) == _dump(new)
+    assert _dump(map_delta.apply_patch(new, map_delta.diff(new, old))) == _dump(old)
+
+@pytest.mark.parametrize("old, new", [
+    ([1], [1.0]),
+    ([[1, 2]], [[1.0, 2]]),
+    ({"x": True}, {"x": 1}),
+    ([{"x": True}], [{"x": 1}]),
+    ({"nodes": [{"id": 1, "pos": {"x": 0}}], "edges": []}, {"nodes": [{"id": 1, "pos": {"x": 0.0}}], "edges": []}),
+    ({"nodes": [{"a": [False]}, {"b": 2}]}, {"nodes": [{"a": [0]}, {"b": 2}]}),
+])
+def test_nested_type_changes_are_kept(old, new):
+    assert map_delta.diff(old, new)
+    _assert_round_trip(old, new)
+
+def _random_value(rng: random.Random, depth: int):
+    kind = rng.randrange(7 if depth < 3 else 5)
+    if kind == 0: return rng.choice([0, 1, 2])
+    if kind == 1: return rng.choice([0.0, 1.0, 2.5])
+    if kind == 2: return rng.choice([True, False])
+    if kind == 3: return rng.choice(["a", "b", "/~"])
+    if kind == 4: return None
+    if kind == 5: return [_random_value(rng, depth + 1) for _ in range(rng.randrange(4))]
+    return {rng.choice(["x", "y", "a/b", "m~n"]): _random_value(rng, depth + 1) for _ in range(rng.randrange(4))}
+
+def _random_map(rng: random.Random) -> dict:
+    nodes = [{"id": str(i), "label": rng.choice(["ソート", "探索"]), "data": _random_value(rng, 1)} for i in range(rng.randrange(5))]
+    return {"nodes": nodes, "edges": [{"source": "0", "target": str(i), "w": _random_value(rng, 2)} for i in range(rng.randrange(3))]}
+
+def _mutate(rng: random.Random, document):
+    # 一部の値を同じ値の別の型 (int / float / bool) に置き換えたり、要素を追加・削除したりする
+    document = json.loads(json.dumps(document))
+    def walk(value):
+        if isinstance(value, dict): return {key: walk(item) for key, item in value.items()}
+        if isinstance(value, list):
+            items = [walk(item) for item in value if rng.random() > 0.1]
+            if rng.random() < 0.2: items.insert(rng.randrange(len(items) + 1), _random_value(rng, 3))
+            return items
+        if rng.random() < 0.3 and isinstance(value, (bool, int, float)) and value in (0, 1):
+            return rng.choice([int(value), float(value), bool(value)])
+        return value
+    return walk(document)
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_round_trip(seed):
+    rng = random.Random(seed)
+    for _ in range(200):
+        old = _random_map(rng)
+        _assert_round_trip(old, _mutate(rng, old))
+        _assert_round_trip(old, _random_map(rng))
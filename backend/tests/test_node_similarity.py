@@ -0,0 +1,106 @@
+# tests/test_node_similarity.py (一括類似度計算と1件ずつの計算の一致)
+#
+# calculate_batch_node_similarity が、候補ノードごとに calculate_final_node_similarity を呼んだ結果と
+# 同じ値になることを、ランダムな候補ノード群 (埋め込み・QIDの欠損や次元の異なる埋め込みを含む) で確認する。
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+import embedding_store
+import time_relation_logic as trl
+from time_relation_logic import Config, NodeFeatureMatrix
+
+DIM = 8
+QID_POOL = [f"Q{900000 + i}" for i in range(40)]
+
+def _random_qids(rng, max_size: int) -> set:
+    return set(rng.choice(QID_POOL, size=int(rng.integers(0, max_size + 1)), replace=False))
+
+def _random_embedding(rng):
+    kind = rng.random()
+    if kind < 0.15: return None
+    if kind < 0.25: return rng.standard_normal(DIM + int(rng.integers(1, 4)))  # 次元が異なる
+    if kind < 0.3: return np.zeros(DIM)
+    return rng.standard_normal(DIM)
+
+def _random_candidates(rng, n: int) -> pd.DataFrame:
+    rows = []
+    for _ in range(n):
+        all_qids = _random_qids(rng, 6)
+        rep_qid = rng.choice(sorted(all_qids)) if all_qids and rng.random() < 0.7 else (None if rng.random() < 0.5 else np.nan)
+        rows.append({
+            Config.COL_EMBEDDING: _random_embedding(rng), Config.COL_REP_QID: rep_qid,
+            Config.COL_ALL_QIDS: all_qids, Config.COL_NEIGHBORING_QIDS: _random_qids(rng, 10),
+        })
+    return pd.DataFrame(rows, columns=[Config.COL_EMBEDDING, Config.COL_REP_QID, Config.COL_ALL_QIDS, Config.COL_NEIGHBORING_QIDS])
+
+def _random_input(rng) -> dict:
+    all_qids = _random_qids(rng, 4) | ({"Q_UNKNOWN"} if rng.random() < 0.2 else set())
+    return {
+        "rep_qid": rng.choice(sorted(all_qids)) if all_qids and rng.random() < 0.5 else None,
+        "all_qids": all_qids, "neighbor_qids": _random_qids(rng, 10),
+        "embedding": rng.standard_normal(DIM) if rng.random() < 0.8 else None,
+    }
+
+def _row_node(row) -> dict:
+    return {"rep_qid": row[Config.COL_REP_QID], "all_qids": row[Config.COL_ALL_QIDS],
+            "neighbor_qids": row[Config.COL_NEIGHBORING_QIDS], "embedding": row[Config.COL_EMBEDDING]}
+
+def _expected(input_node: dict, df: pd.DataFrame) -> np.ndarray:
+    return np.array([trl.calculate_final_node_similarity(input_node, _row_node(row)) for _, row in df.iterrows()], dtype=float)
+
+@pytest.mark.parametrize("seed", range(20))
+def test_batch_similarity_matches_per_node(seed):
+    rng = np.random.default_rng(seed)
+    df = _random_candidates(rng, int(rng.integers(1, 30)))
+    features = NodeFeatureMatrix.from_dataframe(df)
+    for _ in range(5):
+        input_node = _random_input(rng)
+        np.testing.assert_allclose(trl.calculate_batch_node_similarity(input_node, features), _expected(input_node, df), rtol=1e-5, atol=1e-6)
+
+def test_empty_candidates():
+    features = NodeFeatureMatrix.from_dataframe(_random_candidates(np.random.default_rng(0), 0))
+    assert trl.calculate_batch_node_similarity(_random_input(np.random.default_rng(1)), features).shape == (0,)
+
+def test_input_without_qids_or_embedding():
+    rng = np.random.default_rng(2)
+    df = _random_candidates(rng, 15)
+    input_node = {"rep_qid": None, "all_qids": set(), "neighbor_qids": set(), "embedding": None}
+    result = trl.calculate_batch_node_similarity(input_node, NodeFeatureMatrix.from_dataframe(df))
+    np.testing.assert_allclose(result, _expected(input_node, df))
+    assert not result.any()
+
+def test_candidates_without_qids():
+    rng = np.random.default_rng(3)
+    df = _random_candidates(rng, 10)
+    df[Config.COL_REP_QID] = None
+    df[Config.COL_ALL_QIDS] = [set() for _ in range(len(df))]
+    df[Config.COL_NEIGHBORING_QIDS] = [set() for _ in range(len(df))]
+    input_node = _random_input(rng)
+    np.testing.assert_allclose(trl.calculate_batch_node_similarity(input_node, NodeFeatureMatrix.from_dataframe(df)), _expected(input_node, df), rtol=1e-5, atol=1e-6)
+
+def test_wrong_dimension_first_row():
+    # 先頭の行の埋め込みの次元が異なっても、他の行の埋め込みは比較に使われる
+    rng = np.random.default_rng(4)
+    df = _random_candidates(rng, 12)
+    df.at[0, Config.COL_EMBEDDING] = rng.standard_normal(DIM + 2)
+    input_node = {**_random_input(rng), "embedding": rng.standard_normal(DIM)}
+    np.testing.assert_allclose(trl.calculate_batch_node_similarity(input_node, NodeFeatureMatrix.from_dataframe(df)), _expected(input_node, df), rtol=1e-5, atol=1e-6)
+
+def test_embedding_store_rows_match_per_node(tmp_path):
+    # 埋め込みストアの正規化済みの行 (memmap) を使った場合も同じ値になる
+    rng = np.random.default_rng(5)
+    df = _random_candidates(rng, 20)
+    df[Config.COL_ID] = [f"n{i}" for i in range(len(df))]
+    csv = df[[Config.COL_ID]].assign(**{Config.COL_EMBEDDING: [json.dumps(v.tolist()) if v is not None else None for v in df[Config.COL_EMBEDDING]]})
+    database_dir, out_dir = tmp_path / "maps", tmp_path / "compiled"
+    database_dir.mkdir()
+    csv.to_csv(database_dir / f"{embedding_store.NODES_FILE_PREFIX}科目{embedding_store.NODES_FILE_SUFFIX}", index=False)
+    embedding_store.build_embedding_store(str(database_dir), str(out_dir), id_col=Config.COL_ID, embedding_col=Config.COL_EMBEDDING)
+    store = embedding_store.EmbeddingStore(str(out_dir), str(database_dir))
+    features = NodeFeatureMatrix.from_dataframe(df, unit_embeddings=store.subject_matrix("科目"))
+    assert np.shares_memory(features.unit_embeddings, store.matrix)  # コピーせずに参照する
+    for _ in range(5):
+        input_node = _random_input(rng)
+        np.testing.assert_allclose(trl.calculate_batch_node_similarity(input_node, features), _expected(input_node, df), rtol=1e-5, atol=1e-6)
@@ -0,0 +1,35 @@
+# tests/test_persistent_cache.py (SQLite 永続キャッシュの接続の共有)
+#
+# 同じファイルを使うキャッシュが、スレッドをまたいでもプロセス内で1つの接続を共有し、
+# テーブル作成が一度だけ行われることを確認する。
+import os
+import threading
+import numpy as np
+
+import persistent_cache
+from persistent_cache import SqliteEmbeddingCache, SqliteTTLCache
+
+def test_caches_share_one_connection_per_process(tmp_path, monkeypatch):
+    opened = []
+    connect = persistent_cache.sqlite3.connect
+    monkeypatch.setattr(persistent_cache.sqlite3, "connect", lambda *args, **kwargs: opened.append(args) or connect(*args, **kwargs))
+    path = str(tmp_path / "cache.sqlite3")
+    results = SqliteTTLCache(path, "results", ttl=60, touch_on_hit=True)
+    jobs = SqliteTTLCache(path, "jobs", ttl=60)
+    embeddings = SqliteEmbeddingCache(path)
+
+    def work(i: int):
+        results.set(f"key{i}", {"value": i})
+        assert results.get(f"key{i}") == {"value": i}
+        assert jobs.add(f"job{i}", i) and not jobs.add(f"job{i}", i)
+        embeddings.set_many("model", {f"text{i}": np.full(4, i, dtype=np.float32)})
+        assert embeddings.get_many("model", [f"text{i}"])[f"text{i}"][0] == i
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(16)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    assert len(opened) == 1
+    shared = persistent_cache._connections[(os.path.abspath(path), os.getpid())]
+    assert len(shared.schemas) == 2  # cache_entries と embedding_cache
+    assert results.stats()["errors"] == jobs.stats()["errors"] == 0
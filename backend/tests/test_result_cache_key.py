@@ -0,0 +1,30 @@
+# tests/test_result_cache_key.py (結果キャッシュのキーとジョブID)
+#
+# 結果に影響する計算パラメータを変えると、結果キャッシュのキーと重複排除に使うジョブIDの両方が変わることを確認する。
+import pytest
+
+import time_relation_logic as trl
+from time_relation_logic import Config
+
+class _Snapshot:
+    version = "snapshot-v1"
+
+INPUT = {"label": "ソート", "sentence": "整列アルゴリズム", "extend_query": ["クイックソート"], "year": 2}
+
+def _keys() -> tuple[str, str]:
+    data_version = trl._result_data_version(_Snapshot())
+    cache_key = trl.temporal_result_cache_key(INPUT["label"], INPUT["sentence"], INPUT["extend_query"], INPUT["year"], data_version)
+    return cache_key, trl.temporal_request_key(INPUT)
+
+@pytest.mark.parametrize("name, value", [
+    ("TOP_K_SUBJECTS", 3), ("TOP_N_NODES_IN_SUBGRAPH", 8), ("SIMILARITY_THRESHOLD", 0.25),
+    ("WEIGHT_GAKUMON_SIM", 0.5), ("WEIGHT_INPUT_NODE_SIM", 0.5),
+    ("WEIGHT_REP_PATH", 0.5), ("WEIGHT_NEIGHBOR_JACCARD", 0.2), ("WEIGHT_EMBEDDING_COSINE", 0.4),
+])
+def test_parameters_change_cache_key_and_job_id(monkeypatch, name, value):
+    monkeypatch.setattr(trl, "get_data_snapshot", lambda: _Snapshot())
+    cache_key, job_id = _keys()
+    assert _keys() == (cache_key, job_id)
+    monkeypatch.setattr(Config, name, value)
+    new_cache_key, new_job_id = _keys()
+    assert new_cache_key != cache_key and new_job_id != job_id
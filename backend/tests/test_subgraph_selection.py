@@ -0,0 +1,89 @@
+# tests/test_subgraph_selection.py (科目マップからの部分木の選択)
+#
+# _select_subgraph が、全ノードの類似度から選ぶ場合と同じ部分木・類似度を返しつつ、
+# ANNインデックスの接続点候補が与えられた場合は必要な行 (候補・ルートの子・ルートまでの経路) だけを採点することを確認する。
+# あわせて、接続点候補の見つかった科目への絞り込み (ann_subject_positions) を確認する。
+import numpy as np
+import pandas as pd
+import pytest
+
+import time_relation_logic as trl
+from subject_graph import SubjectGraph
+from time_relation_logic import Config, NodeFeatureMatrix, SubjectMap
+
+DIM = 8
+QID_POOL = [f"Q{800000 + i}" for i in range(30)]
+
+def _random_subject_map(rng, n: int) -> SubjectMap:
+    node_ids = ["S_0", *(f"S_{i}" for i in range(1, n))]
+    parents = [int(rng.integers(0, i)) if rng.random() < 0.9 else 0 for i in range(1, n)]
+    rows = [{
+        Config.COL_ID: node_id, Config.COL_EMBEDDING: rng.standard_normal(DIM),
+        Config.COL_REP_QID: None, Config.COL_ALL_QIDS: set(rng.choice(QID_POOL, size=int(rng.integers(0, 4)), replace=False)),
+        Config.COL_NEIGHBORING_QIDS: set(rng.choice(QID_POOL, size=int(rng.integers(0, 6)), replace=False)),
+    } for node_id in node_ids]
+    df = pd.DataFrame(rows)
+    graph = SubjectGraph(node_ids, [node_ids[p] for p in parents], node_ids[1:])
+    return SubjectMap(name="科目", nodes_df=df, edges_df=pd.DataFrame(), features=NodeFeatureMatrix.from_dataframe(df),
+                      graph=graph, signature=(), output_columns={})
+
+def _random_input(rng) -> dict:
+    return {"rep_qid": None, "all_qids": set(rng.choice(QID_POOL, size=3, replace=False)),
+            "neighbor_qids": set(rng.choice(QID_POOL, size=5, replace=False)), "embedding": rng.standard_normal(DIM)}
+
+def _expected(input_node: dict, subject_map: SubjectMap, entry_candidates):
+    # 全ノードの類似度を先に計算してから接続点と部分木を選ぶ (絞り込みを入れる前の選び方)
+    graph = subject_map.graph
+    similarities = trl.calculate_batch_node_similarity(input_node, subject_map.features)
+    entry_positions = np.arange(len(graph))
+    if entry_candidates:
+        candidate_positions = np.flatnonzero(np.isin(np.array(graph.node_ids, dtype=object), entry_candidates))
+        if len(candidate_positions): entry_positions = candidate_positions
+    entry_position = int(entry_positions[np.argmax(similarities[entry_positions])])
+    if similarities[entry_position] < Config.SIMILARITY_THRESHOLD: return None
+    entry_point_id = graph.node_ids[entry_position]
+    if graph.is_root_id(entry_point_id):
+        considered = set(graph.child_ids(entry_point_id)) | {entry_point_id}
+        positions = [i for i, node_id in enumerate(graph.node_ids) if node_id in considered]
+        node_positions = [positions[i] for i in np.argsort(-similarities[positions], kind='stable')[:Config.TOP_N_NODES_IN_SUBGRAPH]]
+    else:
+        node_positions, _ = graph.path_to_root(entry_point_id)
+    return node_positions, entry_point_id, similarities[node_positions]
+
+@pytest.mark.parametrize("seed", range(20))
+def test_selection_matches_full_scan(seed):
+    rng = np.random.default_rng(seed)
+    subject_map = _random_subject_map(rng, int(rng.integers(2, 60)))
+    for _ in range(5):
+        input_node = _random_input(rng)
+        node_ids = subject_map.graph.node_ids
+        for entry_candidates in (None, list(rng.choice(node_ids, size=min(3, len(node_ids)), replace=False)), ["S_0"], ["存在しないID"]):
+            selected, expected = trl._select_subgraph(input_node, subject_map, entry_candidates), _expected(input_node, subject_map, entry_candidates)
+            assert (selected is None) == (expected is None)
+            if selected is None: continue
+            node_positions, _, entry_point_id, node_similarities = selected
+            expected_positions, expected_entry, expected_similarities = expected
+            assert (list(node_positions), entry_point_id) == (list(expected_positions), expected_entry)
+            np.testing.assert_allclose(node_similarities, expected_similarities, rtol=1e-5, atol=1e-6)
+
+def test_entry_candidates_score_only_needed_rows(monkeypatch):
+    rng = np.random.default_rng(100)
+    subject_map = _random_subject_map(rng, 200)
+    scored_rows = []
+    batch = trl.calculate_batch_node_similarity
+    monkeypatch.setattr(trl, "calculate_batch_node_similarity", lambda node, features: scored_rows.append(len(features)) or batch(node, features))
+    graph = subject_map.graph
+    leaf = next(node_id for i, node_id in enumerate(graph.node_ids) if not graph.children[i])
+    monkeypatch.setattr(Config, "SIMILARITY_THRESHOLD", -np.inf)
+    trl._select_subgraph(_random_input(rng), subject_map, [leaf])
+    assert sum(scored_rows) == len(graph.path_to_root(leaf)[0])  # 候補の葉は経路の先頭なので、経路の行だけを採点する
+    scored_rows.clear()
+    trl._select_subgraph(_random_input(rng), subject_map, ["S_0"])
+    assert sum(scored_rows) == len(graph.child_ids("S_0")) + 1
+
+def test_ann_subject_positions():
+    subject_df = pd.DataFrame({Config.COL_LABEL: ["A", "B", "C", "D"]})
+    positions = np.array([0, 2, 3])
+    np.testing.assert_array_equal(trl.ann_subject_positions(subject_df, positions, {"C": ["c1"], "B": ["b1"]}), [2])
+    np.testing.assert_array_equal(trl.ann_subject_positions(subject_df, positions, {"B": ["b1"]}), positions)  # 候補の科目が無ければ絞り込まない
+    np.testing.assert_array_equal(trl.ann_subject_positions(subject_df, positions, {}), positions)
@@ -6,10 +6,24 @@ import json
 import logging
 import operator
 import time
+import hashlib
+import threading
 import requests
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from functools import lru_cache
-import spacy
-from openai import OpenAI
+import embedding_store
+import columnar_store
+import ann_index
+import similarity_matrix
+import stage_timing
+from qid_sparse import QidSetMatrix, qid_vocabulary
+from subject_graph import SubjectGraph
+from persistent_cache import SqliteTTLCache, SqliteEmbeddingCache, MISSING
+from rate_limiter import TokenBucket
+from embedding_service import EmbeddingBatcher
+from job_queue import JobManager
 
 # =============================================================================
 # 0. 設定項目 (Configクラス)
@@ -19,16 +33,43 @@ class Config:
     DATABASE_DIR = "./UECsubject_maps11/"
     GAKUMON_CSV_PATH = "./combined_data_regex.csv"
     SUBJECT_CSV_PATH = "./combined_data_regex.csv"
+    # build_data.py で生成する事前コンパイル済みデータ (埋め込み行列など) の出力先
+    COMPILED_DATA_DIR = os.getenv("COMPILED_DATA_DIR", "./compiled_data/")
+    COLUMNAR_SUBDIR = "subject_maps"  # 科目マップの列指向ストア (COMPILED_DATA_DIR 内のサブディレクトリ)
 
     # --- APIとモデル設定 ---
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "YOUR_OPENAI_API_KEY_HERE")
     OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+    OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # 互換サーバー (試験用の偽サーバーなど) を使う場合に指定
+    OPENAI_TIMEOUT = 60  # 埋め込み取得の待ち時間の上限 (秒)
+    # 同時に発生した埋め込み要求をまとめる最大件数と待ち時間 (ミリ秒)
+    EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", 64))
+    EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", 5))
     
-    WIKIDATA_API_ENDPOINT = "https://www.wikidata.org/w/api.php"
-    WIKIDATA_SPARQL_ENDPOINT = "https://query.wikidata.org/sparql"
+    WIKIDATA_API_ENDPOINT = os.getenv("WIKIDATA_API_ENDPOINT", "https://www.wikidata.org/w/api.php")
+    WIKIDATA_SPARQL_ENDPOINT = os.getenv("WIKIDATA_SPARQL_ENDPOINT", "https://query.wikidata.org/sparql")
     WIKIDATA_HEADERS = {'User-Agent': 'KnowledgeMapTool/1.2 (flowergumi3@gmail.com)'}
-    WIKIDATA_API_SLEEP = 0.05
     WIKIDATA_TIMEOUT = 30
+    # Wikidata への同時リクエスト数と、ワーカープロセス全体での送信頻度 (トークンバケット: 回/秒, 連続送信の上限)
+    WIKIDATA_MAX_CONCURRENCY = int(os.getenv("WIKIDATA_MAX_CONCURRENCY", 4))
+    WIKIDATA_API_RATE = float(os.getenv("WIKIDATA_API_RATE", 10))
+    WIKIDATA_API_BURST = int(os.getenv("WIKIDATA_API_BURST", 5))
+    WIKIDATA_SPARQL_RATE = float(os.getenv("WIKIDATA_SPARQL_RATE", 5))
+    WIKIDATA_SPARQL_BURST = int(os.getenv("WIKIDATA_SPARQL_BURST", 2))
+
+    # --- 永続キャッシュ設定 (全ワーカーで共有するSQLiteファイル) ---
+    CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "./cache/shared_cache.sqlite3")
+    WIKIDATA_CACHE_TTL = int(os.getenv("WIKIDATA_CACHE_TTL", 60 * 60 * 24 * 30))  # 秒
+    WIKIDATA_CACHE_NEGATIVE_TTL = int(os.getenv("WIKIDATA_CACHE_NEGATIVE_TTL", 60 * 60 * 24))  # 見つからなかった結果の保持期間 (秒)
+    # find_temporal_relation の結果キャッシュ (最後に使われてからの保持期間と最大件数)
+    RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") == "1"
+    RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 60 * 60 * 24 * 7))  # 秒
+    RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 5000))
+    # 非同期ジョブ (投入→問い合わせ) の同時実行数と、状態の保持期間 (秒)
+    JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", 2))
+    JOB_RUNNING_TTL = 300  # 実行中のまま更新されないジョブを期限切れとみなすまでの時間 (ワーカー停止時の再投入用)
+    JOB_RESULT_TTL = 60 * 60
+    JOB_FAILED_TTL = 60
 
     SIMILARITY_THRESHOLD = 0.0
 
@@ -45,10 +86,14 @@ class Config:
     EDGE_COL_TARGET = 'target'
     
     # --- 計算パラメータ ---
-    TOP_K_SUBJECTS = 1
+    TOP_K_SUBJECTS = int(os.getenv("TOP_K_SUBJECTS", 1))
     TOP_N_NODES_IN_SUBGRAPH = 5
+    SUBJECT_MAP_CACHE_SIZE = 512  # プロセス内に保持する科目マップ (ノード表・木構造) の最大数
     NEIGHBOR_MAX_QIDS_TO_EXPAND = 7
     NEIGHBOR_LIMIT_PER_DIRECTION = 15
+    # 複数QIDの隣接QIDを VALUES 句で1回のSPARQLにまとめて取得する (上限はクライアント側でQIDごとに適用)
+    NEIGHBOR_BATCH_SPARQL = os.getenv("NEIGHBOR_BATCH_SPARQL", "1") == "1"
+    NEIGHBOR_BATCH_ROWS_PER_ITEM = 200  # 一括クエリ全体の LIMIT = QID数 × この値 (被参照の多いQIDによる応答肥大化を防ぐ)
     WEIGHT_GAKUMON_SIM = 0.4
     WEIGHT_INPUT_NODE_SIM = 0.6
     WEIGHT_REP_PATH = 0.4
@@ -57,90 +102,289 @@ class Config:
     NEIGHBOR_OUTGOING_PROPS = ("P31", "P279", "P361", "P101", "P527", "P2579", "P178", "P400", "P179", "P106", "P276", "P800", "P166", "P272", "P495", "P127", "P138", "P159", "P176", "P463", "P30", "P36", "P17", "P47", "P136", "P155", "P156", "P840")
     NEIGHBOR_INCOMING_PROPS = ("P31", "P279", "P361", "P101", "P921", "P1433", "P3095", "P710", "P131", "P171", "P607", "P793", "P50", "P170", "P58", "P86", "P123", "P161", "P184", "P185")
 
+    # --- 近似最近傍インデックス (build_data.py ann で構築) ---
+    # 有効時は全科目マップを対象にした1回の検索で、採点する科目 (候補の見つかった科目) と各科目の接続点候補を絞り込む
+    USE_ANN_ENTRY_POINTS = os.getenv("USE_ANN_ENTRY_POINTS", "0") == "1"
+    ANN_TOP_N_NODES = 50
+    ANN_NPROBE = 8
+
+    # --- データの再読み込み (DATABASE_DIR・マスタCSV・事前コンパイル済みデータの変更を監視) ---
+    # この間隔 (秒) でファイルの更新時刻とサイズを確認し、2回続けて同じ変更が見えたら新しいスナップショットに切り替える。0で無効
+    DATA_RELOAD_INTERVAL = float(os.getenv("DATA_RELOAD_INTERVAL", "30"))
+
 # =============================================================================
 # 1. グローバルクライアント・モデル初期化
 # =============================================================================
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-client_openai = None
-if Config.OPENAI_API_KEY and Config.OPENAI_API_KEY != "YOUR_OPENAI_API_KEY_HERE":
-    try:
-        client_openai = OpenAI(api_key=Config.OPENAI_API_KEY)
-        logging.info("OpenAI APIクライアント初期化成功。")
-    except Exception as e:
-        logging.error(f"OpenAI APIクライアント初期化失敗: {e}")
-else:
+# openai・spaCy は読み込みに時間がかかるため、ワーカー起動時ではなく初回使用時に読み込む
+_OPENAI_ENABLED = bool(Config.OPENAI_API_KEY) and Config.OPENAI_API_KEY != "YOUR_OPENAI_API_KEY_HERE"
+if not _OPENAI_ENABLED:
     logging.warning("OPENAI_API_KEY未設定またはデフォルト値のままです。OpenAI関連機能はスキップされます。")
 
-nlp = None
-try:
-    nlp = spacy.load("ja_core_news_sm")
-    logging.info("spaCy日本語モデルロード成功。")
-except OSError:
-    logging.error("spaCy日本語モデル'ja_core_news_sm'が見つかりません。`python -m spacy download ja_core_news_sm`を実行してください。")
+_lazy_init_lock = threading.Lock()
+_openai_client, _openai_client_initialized = None, False
+_nlp, _nlp_initialized = None, False
+
+def get_openai_client():
+    """OpenAI APIクライアントを初回呼び出し時に生成して返す (APIキー未設定・初期化失敗の場合は None)。"""
+    global _openai_client, _openai_client_initialized
+    if _openai_client_initialized: return _openai_client
+    with _lazy_init_lock:
+        if not _openai_client_initialized:
+            if _OPENAI_ENABLED:
+                try:
+                    from openai import OpenAI
+                    _openai_client = OpenAI(api_key=Config.OPENAI_API_KEY, base_url=Config.OPENAI_BASE_URL)
+                    logging.info("OpenAI APIクライアント初期化成功。")
+                except Exception as e:
+                    logging.error(f"OpenAI APIクライアント初期化失敗: {e}")
+            _openai_client_initialized = True
+    return _openai_client
+
+def get_nlp():
+    """spaCy日本語モデルを初回呼び出し時に読み込んで返す (見つからない場合は None)。"""
+    global _nlp, _nlp_initialized
+    if _nlp_initialized: return _nlp
+    with _lazy_init_lock:
+        if not _nlp_initialized:
+            try:
+                import spacy
+                _nlp = spacy.load("ja_core_news_sm")
+                logging.info("spaCy日本語モデルロード成功。")
+            except (ImportError, OSError):
+                logging.error("spaCy日本語モデル'ja_core_news_sm'が見つかりません。`python -m spacy download ja_core_news_sm`を実行してください。")
+            _nlp_initialized = True
+    return _nlp
 
 # =============================================================================
 # 2. ヘルパー関数群 (API連携と類似度計算)
 # =============================================================================
 
+# 埋め込みの永続キャッシュ ((モデル, 正規化テキストのハッシュ) → float32 ベクトル、全ワーカーで共有)
+embedding_cache = SqliteEmbeddingCache(Config.CACHE_DB_PATH)
+
+def normalize_embedding_text(text) -> str:
+    return str(text).replace("\n", " ").strip() if text else ""
+
+def _request_embeddings_openai(texts: list[str], model: str) -> list[np.ndarray]:
+    response = get_openai_client().embeddings.create(input=texts, model=model)
+    vectors = [None] * len(texts)
+    for item in response.data: vectors[item.index] = np.asarray(item.embedding, dtype=np.float32)
+    embedding_cache.set_many(model, dict(zip(texts, vectors)))
+    return vectors
+
+# モデルごとのバッチャー (同時に発生した要求を1回の embeddings.create にまとめる)
+_embedding_batchers: dict[str, EmbeddingBatcher] = {}
+_embedding_batchers_lock = threading.Lock()
+
+def get_embedding_batcher(model=Config.OPENAI_EMBEDDING_MODEL) -> EmbeddingBatcher:
+    batcher = _embedding_batchers.get(model)
+    if batcher is None:
+        with _embedding_batchers_lock:
+            batcher = _embedding_batchers.get(model)
+            if batcher is None:
+                batcher = EmbeddingBatcher(lambda texts: _request_embeddings_openai(texts, model), Config.EMBEDDING_BATCH_MAX_SIZE, Config.EMBEDDING_BATCH_WAIT_MS, name=model)
+                _embedding_batchers[model] = batcher
+    return batcher
+
 @lru_cache(maxsize=16384)
 def get_embedding_openai(text, model=Config.OPENAI_EMBEDDING_MODEL):
-    if not client_openai or not text: return None
+    if not text or not get_openai_client(): return None
+    text_to_embed = normalize_embedding_text(text)
+    if not text_to_embed: return None
+    embedding = embedding_cache.get(model, text_to_embed)
+    stage_timing.count_cache("embedding", hits=embedding is not None, misses=embedding is None)
+    if embedding is not None: return embedding
     try:
-        text_to_embed = str(text).replace("\n", " ").strip()
-        if not text_to_embed: return None
-        response = client_openai.embeddings.create(input=[text_to_embed], model=model)
-        return np.array(response.data[0].embedding)
-    except Exception as e: 
-        logging.error(f"OpenAI埋め込み取得エラー ('{text[:30]}...'): {e}")
+        embedding = get_embedding_batcher(model).embed(text_to_embed, timeout=Config.OPENAI_TIMEOUT)
+    except Exception as e:  # 待ち時間の超過 (TimeoutError) や OpenAI API のエラー
+        logging.error(f"OpenAI埋め込み取得エラー ('{text[:30]}...'): {e!r}")
         return None
+    if embedding is None: logging.error(f"OpenAI埋め込み取得エラー ('{text[:30]}...')")
+    return embedding
 
-@lru_cache(maxsize=16384)
-def search_wikidata_entity_qid(term):
-    if not term or not str(term).strip(): return None
-    params = {"action": "wbsearchentities", "format": "json", "language": "ja", "uselang": "ja", "search": str(term).strip(), "limit": 1}
+def prefetch_embeddings(texts, model=Config.OPENAI_EMBEDDING_MODEL) -> dict:
+    """
+    テキスト群の埋め込みを永続キャッシュに事前登録する (未登録のものだけを EMBEDDING_BATCH_MAX_SIZE 件ずつ取得)。
+    デプロイ直後やワーカー追加時に、よく使う入力の埋め込みを用意しておくために使う。
+    """
+    normalized = [t for t in dict.fromkeys(normalize_embedding_text(text) for text in texts) if t]
+    cached = embedding_cache.get_many(model, normalized)
+    missing = [t for t in normalized if t not in cached]
+    fetched, failed = 0, 0
+    if missing and not get_openai_client():
+        logging.warning("OpenAI APIクライアントが無いため、埋め込みの事前取得をスキップします。")
+        return {"requested": len(normalized), "cached": len(normalized) - len(missing), "fetched": 0, "failed": len(missing)}
+    for i in range(0, len(missing), Config.EMBEDDING_BATCH_MAX_SIZE):
+        chunk = missing[i:i + Config.EMBEDDING_BATCH_MAX_SIZE]
+        try:
+            vectors = _request_embeddings_openai(chunk, model)
+            fetched += sum(v is not None for v in vectors); failed += sum(v is None for v in vectors)
+        except Exception as e:
+            logging.error(f"埋め込みの事前取得エラー ({len(chunk)}件): {e}")
+            failed += len(chunk)
+    return {"requested": len(normalized), "cached": len(normalized) - len(missing), "fetched": fetched, "failed": failed}
+
+# --- Wikidata 検索結果の永続キャッシュ (term→QID, QID→隣接QID) ---
+wikidata_term_cache = SqliteTTLCache(Config.CACHE_DB_PATH, "wikidata_term_qid", Config.WIKIDATA_CACHE_TTL, Config.WIKIDATA_CACHE_NEGATIVE_TTL)
+wikidata_neighbor_cache = SqliteTTLCache(Config.CACHE_DB_PATH, "wikidata_neighbor_qids", Config.WIKIDATA_CACHE_TTL, Config.WIKIDATA_CACHE_NEGATIVE_TTL)
+
+# ワーカープロセス内の全リクエストで共有する頻度制限と、検索用のスレッドプール (初回使用時に生成)
+wikidata_api_limiter = TokenBucket(Config.WIKIDATA_API_RATE, Config.WIKIDATA_API_BURST)
+wikidata_sparql_limiter = TokenBucket(Config.WIKIDATA_SPARQL_RATE, Config.WIKIDATA_SPARQL_BURST)
+_wikidata_executor = None
+_wikidata_executor_lock = threading.Lock()
+
+def _get_wikidata_executor() -> ThreadPoolExecutor:
+    global _wikidata_executor
+    if _wikidata_executor is None:
+        with _wikidata_executor_lock:
+            if _wikidata_executor is None: _wikidata_executor = ThreadPoolExecutor(max_workers=max(1, Config.WIKIDATA_MAX_CONCURRENCY), thread_name_prefix="wikidata")
+    return _wikidata_executor
+
+def _request_wikidata_entity_qid(term: str) -> str | None:
+    wikidata_api_limiter.acquire()
+    params = {"action": "wbsearchentities", "format": "json", "language": "ja", "uselang": "ja", "search": term, "limit": 1}
+    response = requests.get(Config.WIKIDATA_API_ENDPOINT, params=params, timeout=Config.WIKIDATA_TIMEOUT, headers=Config.WIKIDATA_HEADERS)
+    response.raise_for_status()
+    results = response.json().get("search", [])
+    return results[0].get("id") if results else None
+
+def _search_wikidata_entity_qid(term) -> tuple[str | None, bool]:
+    """(QID, キャッシュから取得したか) を返す。通信エラーはキャッシュしない。"""
+    if not term or not str(term).strip(): return None, True
+    term = str(term).strip()
+    cached = wikidata_term_cache.lookup(term)
+    if cached is not MISSING: return cached, True
     try:
-        response = requests.get(Config.WIKIDATA_API_ENDPOINT, params=params, timeout=Config.WIKIDATA_TIMEOUT, headers=Config.WIKIDATA_HEADERS)
-        response.raise_for_status()
-        results = response.json().get("search", [])
-        return results[0].get("id") if results else None
+        qid = _request_wikidata_entity_qid(term)
     except Exception as e: 
         logging.debug(f"Wikidataエンティティ検索エラー (term='{term}'): {e}")
-        return None
+        return None, False
+    wikidata_term_cache.set(term, qid)
+    return qid, False
+
+def search_wikidata_entity_qid(term):
+    return _search_wikidata_entity_qid(term)[0]
+
+def resolve_terms_to_qids(terms) -> list[str | None]:
+    """
+    各タームのQIDを入力と同じ順序で返す (見つからない・エラーの場合は None)。
+    キャッシュに無いタームは最大 WIKIDATA_MAX_CONCURRENCY 件ずつ並行して問い合わせ、
+    送信頻度はプロセス共通のトークンバケットで制限する。
+    """
+    terms = [str(term).strip() if term is not None else "" for term in terms]
+    resolved, pending = {}, []
+    for term in dict.fromkeys(terms):  # 重複を除き、最初に現れた順に処理する
+        if not term: resolved[term] = None; continue
+        cached = wikidata_term_cache.lookup(term)
+        if cached is MISSING: pending.append(term)
+        else: resolved[term] = cached
+    stage_timing.count_cache("wikidata_term", hits=sum(1 for term in resolved if term), misses=len(pending))
+    if len(pending) == 1: resolved[pending[0]] = _search_wikidata_entity_qid(pending[0])[0]
+    elif pending:
+        for term, (qid, _) in zip(pending, _get_wikidata_executor().map(_search_wikidata_entity_qid, pending)): resolved[term] = qid
+    return [resolved[term] for term in terms]
 
-@lru_cache(maxsize=8192)
 def get_qids_from_terms_list(terms_tuple):
-    all_qids = set()
-    if not terms_tuple: return all_qids
-    for term in terms_tuple:
-        qid = search_wikidata_entity_qid(term)
-        if qid: all_qids.add(qid)
-        time.sleep(Config.WIKIDATA_API_SLEEP)
-    return all_qids
-
-@lru_cache(maxsize=8192)
-def get_neighbor_qids_for_node(initial_qids_tuple):
-    if not initial_qids_tuple: return set()
-    aggregated_neighbors, qids_processed_count = set(), 0
-    for qid in initial_qids_tuple:
-        if qids_processed_count >= Config.NEIGHBOR_MAX_QIDS_TO_EXPAND: break
-        if not qid: continue
-        union_blocks = []
-        if Config.NEIGHBOR_OUTGOING_PROPS: union_blocks.append(f"{{ wd:{qid} ?prop_out ?related . VALUES ?prop_out {{ {' '.join(f'wdt:{p}' for p in Config.NEIGHBOR_OUTGOING_PROPS)} }} }}")
-        if Config.NEIGHBOR_INCOMING_PROPS: union_blocks.append(f"{{ ?related ?prop_in wd:{qid} . VALUES ?prop_in {{ {' '.join(f'wdt:{p}' for p in Config.NEIGHBOR_INCOMING_PROPS)} }} }}")
-        if not union_blocks: qids_processed_count += 1; continue
-        sparql_query = f"SELECT DISTINCT ?related WHERE {{ {' UNION '.join(union_blocks)} FILTER(STRSTARTS(STR(?related), 'http://www.wikidata.org/entity/Q')) FILTER(?related != wd:{qid}) }} LIMIT {Config.NEIGHBOR_LIMIT_PER_DIRECTION}"
+    if not terms_tuple: return set()
+    return {qid for qid in resolve_terms_to_qids(terms_tuple) if qid}
+
+def _request_neighbor_qids(qid: str) -> set:
+    union_blocks = []
+    if Config.NEIGHBOR_OUTGOING_PROPS: union_blocks.append(f"{{ wd:{qid} ?prop_out ?related . VALUES ?prop_out {{ {' '.join(f'wdt:{p}' for p in Config.NEIGHBOR_OUTGOING_PROPS)} }} }}")
+    if Config.NEIGHBOR_INCOMING_PROPS: union_blocks.append(f"{{ ?related ?prop_in wd:{qid} . VALUES ?prop_in {{ {' '.join(f'wdt:{p}' for p in Config.NEIGHBOR_INCOMING_PROPS)} }} }}")
+    if not union_blocks: return set()
+    sparql_query = f"SELECT DISTINCT ?related WHERE {{ {' UNION '.join(union_blocks)} FILTER(STRSTARTS(STR(?related), 'http://www.wikidata.org/entity/Q')) FILTER(?related != wd:{qid}) }} LIMIT {Config.NEIGHBOR_LIMIT_PER_DIRECTION}"
+    wikidata_sparql_limiter.acquire()
+    response = requests.get(Config.WIKIDATA_SPARQL_ENDPOINT, headers={'Accept': 'application/sparql-results+json', **Config.WIKIDATA_HEADERS}, params={'query': sparql_query, 'format': 'json'}, timeout=Config.WIKIDATA_TIMEOUT)
+    response.raise_for_status()
+    neighbors = set()
+    for binding in response.json().get("results", {}).get("bindings", []):
+        if (value_uri := binding.get("related", {}).get("value", "")).startswith("http://www.wikidata.org/entity/Q"): neighbors.add(value_uri.split('/')[-1])
+    return neighbors
+
+def _request_neighbor_qids_batch(qids: list[str]) -> dict[str, set]:
+    """
+    複数QIDの隣接QIDを VALUES ?item { ... } による1回のSPARQLで取得し、QID→隣接QID集合を返す。
+    QIDごとの上限 (NEIGHBOR_LIMIT_PER_DIRECTION) はクライアント側で適用する。
+    応答がクエリ全体の LIMIT に達した場合、上限件数に満たないQIDは取りこぼしの可能性があるため結果に含めない。
+    """
+    union_blocks = []
+    if Config.NEIGHBOR_OUTGOING_PROPS: union_blocks.append(f"{{ ?item ?prop_out ?related . VALUES ?prop_out {{ {' '.join(f'wdt:{p}' for p in Config.NEIGHBOR_OUTGOING_PROPS)} }} }}")
+    if Config.NEIGHBOR_INCOMING_PROPS: union_blocks.append(f"{{ ?related ?prop_in ?item . VALUES ?prop_in {{ {' '.join(f'wdt:{p}' for p in Config.NEIGHBOR_INCOMING_PROPS)} }} }}")
+    if not union_blocks: return {qid: set() for qid in qids}
+    row_limit = len(qids) * Config.NEIGHBOR_BATCH_ROWS_PER_ITEM
+    sparql_query = f"SELECT DISTINCT ?item ?related WHERE {{ VALUES ?item {{ {' '.join(f'wd:{qid}' for qid in qids)} }} {' UNION '.join(union_blocks)} FILTER(STRSTARTS(STR(?related), 'http://www.wikidata.org/entity/Q')) FILTER(?related != ?item) }} LIMIT {row_limit}"
+    wikidata_sparql_limiter.acquire()
+    response = requests.get(Config.WIKIDATA_SPARQL_ENDPOINT, headers={'Accept': 'application/sparql-results+json', **Config.WIKIDATA_HEADERS}, params={'query': sparql_query, 'format': 'json'}, timeout=Config.WIKIDATA_TIMEOUT)
+    response.raise_for_status()
+    bindings = response.json().get("results", {}).get("bindings", [])
+
+    neighbors_by_qid = {qid: set() for qid in qids}
+    for binding in bindings:
+        item = binding.get("item", {}).get("value", "").split('/')[-1]
+        value_uri = binding.get("related", {}).get("value", "")
+        neighbors = neighbors_by_qid.get(item)
+        if neighbors is None or not value_uri.startswith("http://www.wikidata.org/entity/Q"): continue
+        if len(neighbors) < Config.NEIGHBOR_LIMIT_PER_DIRECTION: neighbors.add(value_uri.split('/')[-1])
+    if len(bindings) >= row_limit:
+        neighbors_by_qid = {qid: n for qid, n in neighbors_by_qid.items() if len(n) >= Config.NEIGHBOR_LIMIT_PER_DIRECTION}
+    return neighbors_by_qid
+
+def get_neighbor_qids_mapping(initial_qids_tuple) -> dict[str, set]:
+    """
+    先頭から最大 NEIGHBOR_MAX_QIDS_TO_EXPAND 個のQIDについて、QID→隣接QID集合を返す。
+    キャッシュに無いQIDは一括モードでは1回のSPARQLでまとめて取得し、取得できなかったQIDのみ個別に問い合わせる。
+    """
+    if not initial_qids_tuple: return {}
+    target_qids = [qid for qid in initial_qids_tuple if qid][:Config.NEIGHBOR_MAX_QIDS_TO_EXPAND]
+    neighbors_by_qid, missing_qids = {}, []
+    for qid in target_qids:
+        cached = wikidata_neighbor_cache.lookup(qid)
+        if cached is MISSING: missing_qids.append(qid)
+        else: neighbors_by_qid[qid] = set(cached or ())
+    stage_timing.count_cache("wikidata_neighbor", hits=len(neighbors_by_qid), misses=len(missing_qids))
+
+    def store(qid, neighbors):
+        # 隣接QIDが無い結果はネガティブキャッシュとして短めの期限で保存する
+        wikidata_neighbor_cache.set(qid, sorted(neighbors) if neighbors else None)
+        neighbors_by_qid[qid] = neighbors
+
+    if Config.NEIGHBOR_BATCH_SPARQL and len(missing_qids) > 1:
         try:
-            response = requests.get(Config.WIKIDATA_SPARQL_ENDPOINT, headers={'Accept': 'application/sparql-results+json', **Config.WIKIDATA_HEADERS}, params={'query': sparql_query, 'format': 'json'}, timeout=Config.WIKIDATA_TIMEOUT)
-            response.raise_for_status()
-            for binding in response.json().get("results", {}).get("bindings", []):
-                if (value_uri := binding.get("related", {}).get("value", "")).startswith("http://www.wikidata.org/entity/Q"): aggregated_neighbors.add(value_uri.split('/')[-1])
+            for qid, neighbors in _request_neighbor_qids_batch(missing_qids).items(): store(qid, neighbors)
+        except Exception as e: logging.error(f"SPARQL隣接QID一括取得エラー (qids={missing_qids}): {e}。個別取得に切り替えます。")
+        missing_qids = [qid for qid in missing_qids if qid not in neighbors_by_qid]
+
+    for qid in missing_qids:
+        try: store(qid, _request_neighbor_qids(qid))
         except Exception as e: logging.error(f"SPARQL隣接QID取得エラー (qid='{qid}'): {e}")
-        qids_processed_count += 1; time.sleep(Config.WIKIDATA_API_SLEEP / 2)
+    return neighbors_by_qid
+
+def get_neighbor_qids_for_node(initial_qids_tuple):
+    aggregated_neighbors = set()
+    for neighbors in get_neighbor_qids_mapping(initial_qids_tuple).values(): aggregated_neighbors.update(neighbors)
     return aggregated_neighbors
 
+def get_cache_stats() -> dict:
+    """このプロセスでの各キャッシュのヒット/ミス数。"""
+    return {
+        "wikidata_term_qid": wikidata_term_cache.stats(),
+        "wikidata_neighbor_qids": wikidata_neighbor_cache.stats(),
+        "temporal_relation_results": temporal_result_cache.stats(),
+        "temporal_relation_jobs": {**temporal_jobs.stats(), **temporal_jobs.store.stats()},
+        "wikidata_api_rate_limit": wikidata_api_limiter.stats(),
+        "wikidata_sparql_rate_limit": wikidata_sparql_limiter.stats(),
+        "embedding_vectors": embedding_cache.stats(),
+        "data_snapshot": _current_snapshot.info() if _current_snapshot else None,
+        "stage_latency": stage_timing.stage_histograms.stats(),
+        **{f"embedding_batcher:{model}": batcher.stats() for model, batcher in _embedding_batchers.items()},
+    }
+
 def calculate_jaccard_similarity(set1: set, set2: set) -> float:
-    if not isinstance(set1, set) or not isinstance(set2, set) or not set1 or not set2: return 0.0
+    if not isinstance(set1, (set, frozenset)) or not isinstance(set2, (set, frozenset)) or not set1 or not set2: return 0.0
     intersection = len(set1.intersection(set2)); union = len(set1.union(set2))
     return intersection / union if union > 0 else 0.0
 
@@ -167,6 +411,103 @@ def calculate_final_node_similarity(node1: dict, node2: dict) -> float:
            (neighbor_jaccard_sim * Config.WEIGHT_NEIGHBOR_JACCARD) + \
            (embed_sim * Config.WEIGHT_EMBEDDING_COSINE)
 
+# --- 類似度の一括計算 (DataFrame.apply を使わずに候補ノード群をまとめてスコアリング) ---
+
+def normalize_embedding(vec) -> np.ndarray | None:
+    if vec is None or not isinstance(vec, np.ndarray) or vec.ndim != 1: return None
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm != 0 else None
+
+def _normalize_rows_inplace(matrix: np.ndarray):
+    norms = np.linalg.norm(matrix, axis=1)
+    np.divide(matrix, norms[:, None], out=matrix, where=norms[:, None] != 0)
+
+class NodeFeatureMatrix:
+    """
+    候補ノード群の特徴量を一括計算用にまとめた読み取り専用の構造。
+    埋め込みは行ごとに正規化済みの float32 行列 (埋め込みが無い・次元が異なる行はゼロベクトル) で保持し、
+    QID集合は整数符号化したCSR行列、代表QIDは整数ID (無い場合は-1) として保持する。
+    """
+
+    def __init__(self, unit_embeddings: np.ndarray, rep_ids: np.ndarray, all_qids: QidSetMatrix, neighbor_qids: QidSetMatrix):
+        self.unit_embeddings = unit_embeddings
+        self.rep_ids, self.all_qids, self.neighbor_qids = rep_ids, all_qids, neighbor_qids
+        self.unit_embeddings.flags.writeable = False
+
+    def __len__(self):
+        return len(self.rep_ids)
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, use_rep_qid: bool = True, unit_embeddings: np.ndarray | None = None) -> "NodeFeatureMatrix":
+        """unit_embeddings (埋め込みストアの正規化済みの行) を渡した場合は、埋め込み列から行列を作らずにそれを使う。"""
+        n = len(df)
+        matrix = unit_embeddings
+        if matrix is None:
+            embeddings = list(df[Config.COL_EMBEDDING]) if Config.COL_EMBEDDING in df.columns else [None] * n
+            # 次元は最も多い埋め込みの次元とする (先頭の行の次元が異なっても、他の行をゼロベクトルにしない)
+            dims = Counter(v.shape[0] for v in embeddings if isinstance(v, np.ndarray) and v.ndim == 1)
+            dim = dims.most_common(1)[0][0] if dims else 0
+            matrix = np.zeros((n, dim), dtype=np.float32)
+            for i, vec in enumerate(embeddings):
+                if isinstance(vec, np.ndarray) and vec.shape == (dim,): matrix[i] = vec
+            _normalize_rows_inplace(matrix)
+
+        def qid_matrix(col):
+            sets = [s if isinstance(s, (set, frozenset)) else None for s in df[col]] if col in df.columns else [None] * n
+            return QidSetMatrix.from_sets(sets)
+        rep_qids = df[Config.COL_REP_QID] if use_rep_qid and Config.COL_REP_QID in df.columns else [None] * n
+        rep_ids = np.array([qid_vocabulary.add([q])[0] if isinstance(q, str) and q else -1 for q in rep_qids], dtype=np.int32)
+        return cls(matrix, rep_ids, qid_matrix(Config.COL_ALL_QIDS), qid_matrix(Config.COL_NEIGHBORING_QIDS))
+
+    @classmethod
+    def from_arrays(cls, unit_embeddings: np.ndarray, rep_ids: np.ndarray, all_qids: QidSetMatrix, neighbor_qids: QidSetMatrix) -> "NodeFeatureMatrix":
+        """
+        ビルド済みストアの正規化済みの埋め込み行列と整数符号化済みのQIDから構築する (from_dataframe と同じ値になる)。
+        埋め込みは memmap のスライスをコピーせずに参照するため、ワーカー間でページキャッシュを共有できる。
+        """
+        return cls(unit_embeddings, rep_ids, all_qids, neighbor_qids)
+
+    def subset(self, positions) -> "NodeFeatureMatrix":
+        positions = np.asarray(positions, dtype=np.intp)
+        return NodeFeatureMatrix(
+            self.unit_embeddings[positions], self.rep_ids[positions],
+            self.all_qids.take(positions), self.neighbor_qids.take(positions),
+        )
+
+def calculate_batch_node_similarity(input_node: dict, candidates: NodeFeatureMatrix) -> np.ndarray:
+    """calculate_final_node_similarity と同じ重み付けで、入力ノードと候補ノード群の類似度を一括計算する。"""
+    n = len(candidates)
+    if n == 0: return np.zeros(0)
+
+    # 1. 埋め込みのコサイン類似度 (正規化済み行列との行列ベクトル積)
+    embed_sim = np.zeros(n)
+    unit_input = normalize_embedding(input_node.get('embedding'))
+    if unit_input is not None and candidates.unit_embeddings.shape[1] == unit_input.shape[0]:
+        # 入力側を行列と同じ float32 にして積を取る (float64 にすると行列全体の一時コピーが作られる)
+        embed_sim = candidates.unit_embeddings @ unit_input.astype(candidates.unit_embeddings.dtype, copy=False)
+
+    # 2. 代表QIDの経路スコア (calculate_representative_path_score と同じ判定を整数IDで行う)
+    rep_in, all_in = input_node.get('rep_qid'), input_node.get('all_qids', set())
+    if not isinstance(all_in, (set, frozenset)): all_in = set()
+    all_in_ids = qid_vocabulary.lookup(all_in)
+    rep_in_id = qid_vocabulary.id_of(rep_in)
+    rep_hit = candidates.all_qids.intersection_counts(np.array([rep_in_id], dtype=np.int32)) > 0 if rep_in_id >= 0 else np.zeros(n, dtype=bool)
+    rep_hit |= np.isin(candidates.rep_ids, all_in_ids)
+    overlap = candidates.all_qids.intersection_counts(all_in_ids) > 0
+    path_sim = np.where(rep_hit, 1.0, np.where(overlap, 0.5, 0.0))
+
+    # 3. 隣接QID集合のJaccard係数 (積集合は疎行列ベクトル積、和集合は行の長さから求める)
+    neighbor_jaccard_sim = np.zeros(n)
+    neighbors_in = input_node.get('neighbor_qids', set())
+    if isinstance(neighbors_in, (set, frozenset)) and neighbors_in:
+        intersection = candidates.neighbor_qids.intersection_counts(qid_vocabulary.lookup(neighbors_in))
+        union = len(neighbors_in) + candidates.neighbor_qids.row_lengths - intersection
+        np.divide(intersection, union, out=neighbor_jaccard_sim, where=candidates.neighbor_qids.row_lengths > 0)
+
+    return (path_sim * Config.WEIGHT_REP_PATH) + \
+           (neighbor_jaccard_sim * Config.WEIGHT_NEIGHBOR_JACCARD) + \
+           (embed_sim * Config.WEIGHT_EMBEDDING_COSINE)
+
 def safe_load_csv(path: str) -> pd.DataFrame | None:
     try: return pd.read_csv(path)
     except FileNotFoundError: logging.error(f"ファイルが見つかりません: {path}"); return None
@@ -178,7 +519,9 @@ def safe_load_csv(path: str) -> pd.DataFrame | None:
 
 def preprocess_master_data(df: pd.DataFrame) -> pd.DataFrame:
     def to_set(x): return set(str(x).split(',')) if pd.notna(x) and str(x).strip() else set()
-    def to_vec(x): return np.array(json.loads(x)) if isinstance(x, str) and x.startswith('[') else None
+    def to_vec(x):
+        if isinstance(x, np.ndarray): return x  # 埋め込みストアから割り当て済み
+        return np.array(json.loads(x)) if isinstance(x, str) and x.startswith('[') else None
     
     for col, converter in {Config.COL_ALL_QIDS: to_set, Config.COL_NEIGHBORING_QIDS: to_set, Config.COL_EMBEDDING: to_vec}.items():
         if col in df.columns: df[col] = df[col].apply(converter)
@@ -187,15 +530,416 @@ def preprocess_master_data(df: pd.DataFrame) -> pd.DataFrame:
             df[col] = [converter(None) for _ in range(len(df))]
     return df
 
+# --- マスタデータストア (プロセス内で一度だけ読み込み・前処理して共有) ---
+
+@dataclass(frozen=True)
+class MasterData:
+    """前処理済みマスタデータのスナップショット。全リクエストで共有するため、呼び出し側で変更しないこと。"""
+    gakumon_df: pd.DataFrame
+    subject_df: pd.DataFrame
+    loaded_at: float
+    version: str
+    gakumon_features: NodeFeatureMatrix
+    subject_features: NodeFeatureMatrix
+    subject_year_order: np.ndarray    # 学年が数値の科目の行位置を学年の昇順に並べたもの
+    subject_years_sorted: np.ndarray  # 上記の順に並べた学年 (未来/過去の科目は searchsorted によるスライスで得る)
+    field_subject_similarity: np.ndarray | None = None  # 事前計算済みの学問分野×科目の類似度 (build_data.py field-matrix)
+
+    def field_similarities_for(self, field_label) -> np.ndarray | None:
+        """学問分野 (gakumon_df のインデックス) に対する全科目の類似度。事前計算済みの行列が無い場合は None。"""
+        if self.field_subject_similarity is None: return None
+        position = self.gakumon_df.index.get_loc(field_label) if field_label in self.gakumon_df.index else None
+        return self.field_subject_similarity[position] if isinstance(position, (int, np.integer)) else None
+
+def _year_partition(df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    years = df[Config.COL_YEAR].to_numpy(dtype=float) if Config.COL_YEAR in df.columns else np.full(len(df), np.nan)
+    valid = np.flatnonzero(~np.isnan(years))
+    order = valid[np.argsort(years[valid], kind='stable')]
+    return order, years[order]
+
+def _freeze_master_df(df: pd.DataFrame) -> pd.DataFrame:
+    """共有用に集合をfrozenset、埋め込みベクトルを読み取り専用にし、学年列を数値化する。"""
+    for col in (Config.COL_ALL_QIDS, Config.COL_NEIGHBORING_QIDS):
+        df[col] = [frozenset(s) for s in df[col]]
+    for vec in df[Config.COL_EMBEDDING]:
+        if isinstance(vec, np.ndarray): vec.flags.writeable = False
+    if Config.COL_YEAR in df.columns:
+        df[Config.COL_YEAR] = pd.to_numeric(df[Config.COL_YEAR], errors='coerce')
+    return df
+
+def _field_matrix_expected(version: str, n_fields: int, n_subjects: int) -> dict:
+    """類似度行列が現在のマスタデータ・重みで計算されたものかを確認するためのメタデータ。"""
+    return {
+        "master_version": version, "shape": [n_fields, n_subjects],
+        "weights": [Config.WEIGHT_REP_PATH, Config.WEIGHT_NEIGHBOR_JACCARD, Config.WEIGHT_EMBEDDING_COSINE],
+    }
+
+def _master_files_version(paths) -> str:
+    """マスタファイルのパス・更新時刻・サイズからバージョン文字列を生成する。"""
+    digest = hashlib.sha1()
+    for path in sorted(set(paths)):
+        st = os.stat(path)
+        digest.update(f"{os.path.abspath(path)}:{st.st_mtime_ns}:{st.st_size};".encode())
+    return digest.hexdigest()[:12]
+
+class MasterDataStore:
+    """学問・科目マスタをプロセス単位で一度だけロードし、読み取り専用で共有するストア。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: MasterData | None = None
+
+    def get(self) -> MasterData:
+        data = self._data
+        if data is not None: return data
+        with self._lock:
+            if self._data is None: self._data = self._load()
+            return self._data
+
+    def invalidate(self):
+        with self._lock: self._data = None
+
+    def _load(self) -> MasterData:
+        started = time.perf_counter()
+        version = _master_files_version([Config.GAKUMON_CSV_PATH, Config.SUBJECT_CSV_PATH]) if os.path.exists(Config.GAKUMON_CSV_PATH) and os.path.exists(Config.SUBJECT_CSV_PATH) else None
+        df_gakumon = safe_load_csv(Config.GAKUMON_CSV_PATH)
+        # 学問と科目が同一ファイルの場合は一度だけ読み込んで共有する
+        same_file = os.path.abspath(Config.GAKUMON_CSV_PATH) == os.path.abspath(Config.SUBJECT_CSV_PATH)
+        df_subject = df_gakumon if same_file else safe_load_csv(Config.SUBJECT_CSV_PATH)
+        if df_gakumon is None or df_subject is None:
+            raise FileNotFoundError("学問または科目のマスタファイルが見つかりません。")
+
+        df_gakumon = _freeze_master_df(preprocess_master_data(df_gakumon))
+        df_subject = df_gakumon if same_file else _freeze_master_df(preprocess_master_data(df_subject))
+        gakumon_features = NodeFeatureMatrix.from_dataframe(df_gakumon, use_rep_qid=False)
+        subject_features = gakumon_features if same_file else NodeFeatureMatrix.from_dataframe(df_subject, use_rep_qid=False)
+        subject_year_order, subject_years_sorted = _year_partition(df_subject)
+        field_matrix = similarity_matrix.load_similarity_matrix(Config.COMPILED_DATA_DIR, _field_matrix_expected(version, len(df_gakumon), len(df_subject))) if version else None
+        data = MasterData(
+            gakumon_df=df_gakumon, subject_df=df_subject, loaded_at=time.time(), version=version,
+            gakumon_features=gakumon_features, subject_features=subject_features,
+            subject_year_order=subject_year_order, subject_years_sorted=subject_years_sorted,
+            field_subject_similarity=field_matrix
+        )
+        logging.info(f"マスタデータをロードしました (学問: {len(df_gakumon)}件, 科目: {len(df_subject)}件, version: {data.version}, 類似度行列: {'あり' if field_matrix is not None else 'なし'}, {time.perf_counter() - started:.2f}秒)。")
+        return data
+
+def get_master_data() -> MasterData:
+    return get_data_snapshot().master_data
+
+# 列指向ストアに格納する列 (部分木抽出のスコア計算と出力ノードに使う列のみ)
+SUBJECT_MAP_NODE_COLUMNS = {
+    Config.COL_ID: "id", Config.COL_LABEL: "text", Config.COL_SENTENCE: "text", Config.COL_YEAR: "number",
+    Config.COL_REP_QID: "qid", Config.COL_ALL_QIDS: "qid_list", Config.COL_NEIGHBORING_QIDS: "qid_list",
+}
+# 列指向ストアから DataFrame として読み込む列 (QID集合と埋め込みは特徴量行列として直接読み込む)
+SUBJECT_MAP_TABLE_COLUMNS = [Config.COL_ID, Config.COL_LABEL, Config.COL_SENTENCE, Config.COL_YEAR, Config.COL_REP_QID]
+# 結果のノードに含める列 (フロントエンドに必要な列のみ)
+SUBJECT_MAP_OUTPUT_COLUMNS = [Config.COL_ID, Config.COL_LABEL, Config.COL_SENTENCE]
+SUBJECT_MAP_EDGE_COLUMNS = {Config.EDGE_COL_SOURCE: "id", Config.EDGE_COL_TARGET: "id"}
+SUBJECT_MAP_EDGE_RENAMES = {'from': Config.EDGE_COL_SOURCE, 'to': Config.EDGE_COL_TARGET}
+
+def get_subject_map_columnar_store() -> columnar_store.ColumnarStore | None:
+    return columnar_store.get_columnar_store(os.path.join(Config.COMPILED_DATA_DIR, Config.COLUMNAR_SUBDIR), Config.DATABASE_DIR)
+
+def load_subject_map_columnar(subject_name: str, stores: "CompiledStores") -> tuple[pd.DataFrame, pd.DataFrame, NodeFeatureMatrix] | None:
+    """
+    列指向ストアと埋め込みストアからノード表・エッジ表・特徴量を組み立てる。
+    ノード表は出力に使う列だけを読み込み、QID集合は文字列の set を作らずに整数IDのCSR行列へ直接変換する。
+    どちらかのストアが未ビルド・古い場合やノードIDが一致しない場合は None を返し、呼び出し側でCSVを読み込ませる。
+    """
+    columns, store = stores.columnar, stores.embeddings
+    if columns is None or store is None or not columns.is_fresh(subject_name) or not store.is_fresh(subject_name): return None
+    try:
+        df_nodes = columns.nodes(subject_name, SUBJECT_MAP_TABLE_COLUMNS)
+        df_edges = columns.edges(subject_name, SUBJECT_MAP_EDGE_COLUMNS)
+        if store.subject_node_ids(subject_name) != list(df_nodes[Config.COL_ID]):
+            logging.warning(f"埋め込みストアのノードIDが '{subject_name}' の列指向ストアと一致しません。CSVを使用します。"); return None
+        features = NodeFeatureMatrix.from_arrays(
+            store.subject_matrix(subject_name), columns.qid_ids(subject_name, Config.COL_REP_QID, qid_vocabulary),
+            columns.qid_matrix(subject_name, Config.COL_ALL_QIDS, qid_vocabulary),
+            columns.qid_matrix(subject_name, Config.COL_NEIGHBORING_QIDS, qid_vocabulary),
+        )
+    except Exception as e:
+        logging.error(f"列指向ストアの読み込み中にエラーが発生しました ({subject_name}): {e}"); return None
+    return df_nodes, df_edges, features
+
+def load_subject_map_nodes(subject_name: str, store: embedding_store.EmbeddingStore | None = None) -> pd.DataFrame | None:
+    """
+    科目マップのノードCSVを読み込み、前処理済みのDataFrameを返す。
+    ビルド済みの埋め込みストアがあれば埋め込み列(JSON文字列)の解析を省略し、memmap上のベクトルを割り当てる。
+    """
+    nodes_path = os.path.join(Config.DATABASE_DIR, f"subject_map_{subject_name}_nodes.csv")
+    if store is not None and store.is_fresh(subject_name):
+        try:
+            df_nodes = pd.read_csv(nodes_path, usecols=lambda c: c != Config.COL_EMBEDDING)
+        except FileNotFoundError:
+            logging.error(f"ファイルが見つかりません: {nodes_path}"); return None
+        except Exception as e:
+            logging.error(f"ファイルの読み込み中にエラーが発生しました ({nodes_path}): {e}"); return None
+        vectors = store.vectors_for(subject_name, df_nodes[Config.COL_ID]) if Config.COL_ID in df_nodes.columns else None
+        if vectors is not None:
+            df_nodes[Config.COL_EMBEDDING] = pd.Series(vectors, index=df_nodes.index, dtype=object)
+            return preprocess_master_data(df_nodes)
+        logging.warning(f"埋め込みストアのノードIDが '{subject_name}' のCSVと一致しません。CSVの埋め込みを使用します。")
+
+    df_nodes = safe_load_csv(nodes_path)
+    if df_nodes is None: return None
+    return preprocess_master_data(df_nodes)
+
+# --- 科目マップキャッシュ (ノード表・特徴量・木構造を科目ごとに一度だけ構築して共有) ---
+
+@dataclass(frozen=True)
+class SubjectMap:
+    """科目マップ1件分の読み取り専用キャッシュ。"""
+    name: str
+    nodes_df: pd.DataFrame
+    edges_df: pd.DataFrame
+    features: NodeFeatureMatrix
+    graph: SubjectGraph
+    signature: tuple
+    output_columns: dict[str, list]  # 結果のノードに含める列の値 (行順, NaN は None に置換済み)
+
+def _subject_map_paths(subject_name: str) -> tuple[str, str]:
+    return (os.path.join(Config.DATABASE_DIR, f"subject_map_{subject_name}_nodes.csv"),
+            os.path.join(Config.DATABASE_DIR, f"subject_map_{subject_name}_edges.csv"))
+
+def _subject_map_signature(subject_name: str) -> tuple:
+    """ノード・エッジCSVの更新時刻とサイズ。ファイルが更新されたらキャッシュを作り直す。"""
+    signature = []
+    for path in _subject_map_paths(subject_name):
+        try: st = os.stat(path); signature.append((st.st_mtime_ns, st.st_size))
+        except OSError: signature.append(None)
+    return tuple(signature)
+
+def load_subject_map(subject_name: str, stores: "CompiledStores | None" = None) -> SubjectMap | None:
+    nodes_path, edges_path = _subject_map_paths(subject_name)
+    signature = _subject_map_signature(subject_name)
+    stores = stores or open_compiled_stores()
+    compiled = load_subject_map_columnar(subject_name, stores)
+    if compiled is not None:
+        df_nodes, df_edges, features = compiled
+    else:
+        df_nodes = load_subject_map_nodes(subject_name, stores.embeddings)
+        if df_nodes is None: return None
+        df_nodes[Config.COL_ID] = df_nodes[Config.COL_ID].astype(str)
+
+        df_edges = safe_load_csv(edges_path)
+        if df_edges is None: df_edges = pd.DataFrame(columns=[Config.EDGE_COL_SOURCE, Config.EDGE_COL_TARGET])
+        df_edges = df_edges.rename(columns=SUBJECT_MAP_EDGE_RENAMES)
+        df_edges[Config.EDGE_COL_SOURCE] = df_edges[Config.EDGE_COL_SOURCE].astype(str)
+        df_edges[Config.EDGE_COL_TARGET] = df_edges[Config.EDGE_COL_TARGET].astype(str)
+        # 埋め込みストアの行を使えた場合は、その memmap のスライスをそのまま特徴量にする
+        store = stores.embeddings
+        unit_embeddings = store.subject_matrix(subject_name) if store is not None and store.is_fresh(subject_name) and store.subject_node_ids(subject_name) == list(df_nodes[Config.COL_ID]) else None
+        features = NodeFeatureMatrix.from_dataframe(df_nodes, unit_embeddings=unit_embeddings)
+
+    graph = SubjectGraph(list(df_nodes[Config.COL_ID]), list(df_edges[Config.EDGE_COL_SOURCE]), list(df_edges[Config.EDGE_COL_TARGET]))
+    # NaN (Not a Number) はJSONに変換できないため、None (JavaScript側でnullになる) に置換しておく
+    output_columns = {col: [None if isinstance(v, float) and v != v else v for v in df_nodes[col].tolist()]
+                      for col in SUBJECT_MAP_OUTPUT_COLUMNS if col in df_nodes.columns}
+    return SubjectMap(
+        name=subject_name, nodes_df=df_nodes, edges_df=df_edges,
+        features=features, graph=graph, signature=signature, output_columns=output_columns
+    )
+
+# --- データのスナップショット (マスタデータ・科目マップ・事前コンパイル済みストアの組を一括で差し替える) ---
+
+@dataclass(frozen=True)
+class CompiledStores:
+    """build_data.py で生成したストア。ビルドし直された場合は開き直したものを新しいスナップショットに持たせる。"""
+    embeddings: embedding_store.EmbeddingStore | None
+    columnar: columnar_store.ColumnarStore | None
+    ann: ann_index.AnnIndex | None
+
+def open_compiled_stores(reopen: bool = False) -> CompiledStores:
+    """ビルド済みのストアを開く。reopen=True の場合はプロセス内のキャッシュを破棄して現在のファイルを開き直す。"""
+    if reopen:
+        embedding_store.reset_embedding_store_cache(); columnar_store.reset_columnar_store_cache(); ann_index.reset_ann_index_cache()
+    return CompiledStores(
+        embeddings=embedding_store.get_embedding_store(Config.COMPILED_DATA_DIR, Config.DATABASE_DIR),
+        columnar=get_subject_map_columnar_store(),
+        ann=ann_index.get_ann_index(Config.COMPILED_DATA_DIR, Config.DATABASE_DIR) if Config.USE_ANN_ENTRY_POINTS else None,
+    )
+
+# スナップショットの元になる事前コンパイル済みデータ (いずれもビルドの最後に置き換えられるファイル)
+COMPILED_MARKER_FILES = (embedding_store.CURRENT_FILE, ann_index.META_FILE, os.path.join(Config.COLUMNAR_SUBDIR, columnar_store.CURRENT_FILE))
+
+def _file_signature(path: str) -> tuple | None:
+    try: st = os.stat(path); return (st.st_mtime_ns, st.st_size)
+    except OSError: return None
+
+def scan_data_signatures() -> dict:
+    """マスタCSV・各科目マップのCSV・事前コンパイル済みデータの (更新時刻, サイズ)。"""
+    subject_names = [embedding_store.subject_name_from_nodes_path(path) for path in embedding_store.list_subject_node_files(Config.DATABASE_DIR)]
+    return {
+        "master": [_file_signature(path) for path in (Config.GAKUMON_CSV_PATH, Config.SUBJECT_CSV_PATH, os.path.join(Config.COMPILED_DATA_DIR, similarity_matrix.META_FILE))],
+        "compiled": [_file_signature(os.path.join(Config.COMPILED_DATA_DIR, name)) for name in COMPILED_MARKER_FILES],
+        "subjects": {name: _subject_map_signature(name) for name in subject_names},
+    }
+
+def _signatures_version(signatures: dict) -> str:
+    return hashlib.sha1(json.dumps(signatures, sort_keys=True).encode()).hexdigest()[:12]
+
+class DataSnapshot:
+    """
+    ある時点のデータ (マスタデータ・科目マップ・事前コンパイル済みストア) の組。
+    リクエストは開始時に取得したスナップショットだけを参照するため、処理中に再読み込みが起きても新旧のデータが混ざらない。
+    科目マップは初めて参照されたときに読み込み、このスナップショット内で共有する。
+    """
+
+    def __init__(self, signatures: dict, master_store: MasterDataStore, stores: CompiledStores, subject_maps: dict | None = None):
+        self.signatures = signatures
+        self.version = _signatures_version(signatures)
+        self.master_store, self.stores = master_store, stores
+        self.created_at = time.time()
+        self._lock = threading.Lock()
+        self._subject_maps: "OrderedDict[str, SubjectMap]" = OrderedDict(subject_maps or {})
+
+    @property
+    def master_data(self) -> MasterData:
+        return self.master_store.get()
+
+    def subject_map(self, subject_name: str) -> SubjectMap | None:
+        with self._lock:
+            cached = self._subject_maps.get(subject_name)
+            if cached is not None:
+                self._subject_maps.move_to_end(subject_name)
+                stage_timing.count_cache("subject_map", hits=1)
+                return cached
+        stage_timing.count_cache("subject_map", misses=1)
+        with stage_timing.stage("subject_map_load"): subject_map = load_subject_map(subject_name, self.stores)
+        if subject_map is None: return None
+        with self._lock:
+            subject_map = self._subject_maps.setdefault(subject_name, subject_map)
+            self._subject_maps.move_to_end(subject_name)
+            while len(self._subject_maps) > Config.SUBJECT_MAP_CACHE_SIZE: self._subject_maps.popitem(last=False)
+        return subject_map
+
+    def loaded_subject_maps(self) -> dict[str, SubjectMap]:
+        with self._lock: return dict(self._subject_maps)
+
+    def info(self) -> dict:
+        return {"version": self.version, "created_at": self.created_at, "subjects": len(self.signatures["subjects"]), "subject_maps_loaded": len(self._subject_maps)}
+
+_current_snapshot: DataSnapshot | None = None
+_snapshot_reload_lock = threading.Lock()
+_reloader_pid: int | None = None
+
+def get_data_snapshot() -> DataSnapshot:
+    """現在のスナップショットを返す (初回のみ作成する)。"""
+    snapshot = _current_snapshot
+    if snapshot is not None: return snapshot
+    reload_data_snapshot()
+    return _current_snapshot
+
+def get_subject_map(subject_name: str) -> SubjectMap | None:
+    """現在のスナップショットの科目マップを返す。"""
+    return get_data_snapshot().subject_map(subject_name)
+
+def _build_snapshot(previous: DataSnapshot | None, signatures: dict) -> tuple[DataSnapshot, dict]:
+    """
+    変更のあった部分だけを読み込み直した新しいスナップショットを作る。
+    変更されていない科目マップ・マスタデータ・ストアは前のスナップショットのものをそのまま引き継ぐ。
+    """
+    compiled_changed = previous is None or previous.signatures["compiled"] != signatures["compiled"]
+    stores = open_compiled_stores(reopen=previous is not None) if compiled_changed else previous.stores
+    master_changed = previous is None or previous.signatures["master"] != signatures["master"]
+    master_store = MasterDataStore() if master_changed else previous.master_store
+
+    carried, reloaded = {}, []
+    for subject_name, subject_map in (previous.loaded_subject_maps().items() if previous else ()):
+        signature = signatures["subjects"].get(subject_name)
+        if signature is None: continue  # 削除された科目
+        if signature == subject_map.signature: carried[subject_name] = subject_map; continue
+        subject_map = load_subject_map(subject_name, stores)
+        if subject_map is not None: carried[subject_name] = subject_map; reloaded.append(subject_name)
+
+    snapshot = DataSnapshot(signatures, master_store, stores, carried)
+    if previous is not None and master_changed:
+        # 切り替え後の最初のリクエストで読み込まないよう、ここでマスタデータを読み込んでおく
+        try: master_store.get()
+        except FileNotFoundError as e: logging.warning(f"データの再読み込み: マスタデータを読み込めません: {e}")
+    return snapshot, {"master_reloaded": master_changed, "stores_reopened": compiled_changed, "subject_maps_reloaded": reloaded}
+
+def reload_data_snapshot(signatures: dict | None = None) -> dict:
+    """
+    ファイルの変更を確認し、変更があれば新しいスナップショットを作成して切り替える。
+    切り替えは参照の代入1回で行い、以後のリクエストから新しいデータを使う。古いバージョンの結果キャッシュは削除する。
+    """
+    global _current_snapshot
+    with _snapshot_reload_lock:
+        previous = _current_snapshot
+        signatures = signatures or scan_data_signatures()
+        if previous is not None and signatures == previous.signatures:
+            return {"reloaded": False, "version": previous.version}
+        started = time.perf_counter()
+        snapshot, summary = _build_snapshot(previous, signatures)
+        _current_snapshot = snapshot
+        summary = {"reloaded": True, "version": snapshot.version, "previous_version": previous.version if previous else None, **summary}
+    if previous is not None:
+        summary["result_cache_dropped"] = temporal_result_cache.delete_except_prefix(_result_cache_key_prefix(_result_data_version(snapshot)))
+        logging.info(f"データのスナップショットを切り替えました: {summary} ({time.perf_counter() - started:.2f}秒)")
+    return summary
+
+def _data_reload_loop():
+    last_scan = None
+    while True:
+        time.sleep(Config.DATA_RELOAD_INTERVAL)
+        try:
+            scan = scan_data_signatures()
+            current = _current_snapshot
+            # 書き込み途中のファイルを読まないよう、同じ変更が2回続けて見えた時点で切り替える
+            if current is not None and scan != current.signatures and scan == last_scan: reload_data_snapshot(scan)
+            last_scan = scan
+        except Exception as e:
+            logging.error(f"データの再読み込みに失敗しました: {e}", exc_info=True)
+
+def start_data_reloader() -> bool:
+    """
+    ファイルの変更を監視するスレッドをこのプロセスで開始する (gunicorn の各ワーカーの起動時に呼び出す)。
+    fork 前のマスタープロセスでは呼び出さないこと (スレッドは fork 後のワーカーに引き継がれない)。
+    """
+    global _reloader_pid
+    if Config.DATA_RELOAD_INTERVAL <= 0: return False
+    with _snapshot_reload_lock:
+        if _reloader_pid == os.getpid(): return False
+        _reloader_pid = os.getpid()
+    threading.Thread(target=_data_reload_loop, name="data-reloader", daemon=True).start()
+    logging.info(f"データの変更監視を開始しました ({Config.DATA_RELOAD_INTERVAL}秒間隔, pid={os.getpid()})。")
+    return True
+
+def warm_up(preload_subject_maps: bool = True) -> dict:
+    """
+    読み取り専用のデータ (マスタデータ・埋め込みストア・列指向ストア・ANNインデックス・科目マップと木構造) を先に読み込む。
+    gunicorn の preload_app で fork 前にマスタープロセスから呼び出し、全ワーカーでメモリを共有するために使う。
+    読み込めないデータは記録して続行する。
+    """
+    started = time.perf_counter()
+    snapshot = get_data_snapshot()
+    summary = {"version": snapshot.version, "master_data": False, "embedding_store": snapshot.stores.embeddings is not None,
+               "columnar_store": snapshot.stores.columnar is not None, "ann_index": snapshot.stores.ann is not None, "subject_maps": 0}
+    try:
+        summary["master_data"] = snapshot.master_data.version
+    except FileNotFoundError as e:
+        logging.warning(f"事前読み込み: マスタデータを読み込めません: {e}")
+    if preload_subject_maps:
+        for subject_name in list(snapshot.signatures["subjects"])[:Config.SUBJECT_MAP_CACHE_SIZE]:
+            if snapshot.subject_map(subject_name) is not None: summary["subject_maps"] += 1
+    logging.info(f"事前読み込みが完了しました: {summary} ({time.perf_counter() - started:.2f}秒)")
+    return summary
+
+@stage_timing.timed("input_features")
 def create_input_node_features(label: str, sentence: str, extend_qid_list: list[str]) -> dict:
     logging.info(f"入力ノードの特徴量を生成中: {label}")
     all_concepts = {label, *extend_qid_list}
     logging.info(f"  QID生成のための検索ターム群: {list(all_concepts)}")
 
-    all_qids = get_qids_from_terms_list(tuple(all_concepts))
-    rep_qid = next(iter(get_qids_from_terms_list(tuple([label]))), f"Q_{label.replace(' ', '_')}")
-    neighbor_qids = get_neighbor_qids_for_node(tuple(all_qids))
-    embedding = get_embedding_openai(f"{label} {sentence}")
+    with stage_timing.stage("wikidata_qids"):
+        all_qids = get_qids_from_terms_list(tuple(all_concepts))
+        rep_qid = next(iter(get_qids_from_terms_list(tuple([label]))), f"Q_{label.replace(' ', '_')}")
+    with stage_timing.stage("wikidata_neighbors"): neighbor_qids = get_neighbor_qids_for_node(tuple(all_qids))
+    with stage_timing.stage("embedding"): embedding = get_embedding_openai(f"{label} {sentence}")
     
     input_node = {
         'rep_qid': rep_qid, 'all_qids': all_qids, 
@@ -205,228 +949,375 @@ def create_input_node_features(label: str, sentence: str, extend_qid_list: list[
     logging.info(f"入力ノード '{label}' の特徴量を生成しました (QID数: {len(all_qids)}, 隣接QID数: {len(neighbor_qids)})。")
     return input_node
 
-def find_most_similar_academic_field(input_node: dict, gakumon_df: pd.DataFrame) -> pd.Series | None:
+@stage_timing.timed("field_match")
+def find_most_similar_academic_field(input_node: dict, gakumon_df: pd.DataFrame, gakumon_features: NodeFeatureMatrix | None = None) -> pd.Series | None:
     logging.info("最も類似度の高い学問分野を特定しています...")
     if gakumon_df is None or gakumon_df.empty:
         logging.error("学問分野データが読み込めません。"); return None
 
-    gakumon_df['similarity_to_input'] = gakumon_df.apply(
-        lambda row: calculate_final_node_similarity(input_node, {
-            'rep_qid': None,
-            'all_qids': row.get(Config.COL_ALL_QIDS, set()),
-            'neighbor_qids': row.get(Config.COL_NEIGHBORING_QIDS, set()),
-            'embedding': row.get(Config.COL_EMBEDDING)
-        }),
-        axis=1
-    )
-    most_similar_field = gakumon_df.loc[gakumon_df['similarity_to_input'].idxmax()]
+    # 共有マスタを変更しないよう、類似度は別のSeriesとして保持する
+    if gakumon_features is None: gakumon_features = NodeFeatureMatrix.from_dataframe(gakumon_df, use_rep_qid=False)
+    similarities = pd.Series(calculate_batch_node_similarity(input_node, gakumon_features), index=gakumon_df.index)
+    most_similar_field = gakumon_df.loc[similarities.idxmax()].copy()
+    most_similar_field['similarity_to_input'] = similarities.max()
     logging.info(f"最も類似度の高い学問分野を特定: '{most_similar_field.get(Config.COL_LABEL, 'N/A')}' (類似度: {most_similar_field['similarity_to_input']:.4f})")
     return most_similar_field
 
-def find_top_related_subjects(input_node: dict, academic_field: pd.Series, subject_df: pd.DataFrame, input_year: int, op: callable) -> pd.DataFrame:
-    logging.info(f"関連科目を抽出 (学年条件: {op.__name__} {input_year})...")
-    filtered_subjects = subject_df[op(subject_df[Config.COL_YEAR], input_year)].copy()
-    if filtered_subjects.empty: 
+def _academic_field_node(academic_field: pd.Series) -> dict:
+    return {'rep_qid': None, 'all_qids': academic_field.get(Config.COL_ALL_QIDS, set()), 'neighbor_qids': academic_field.get(Config.COL_NEIGHBORING_QIDS, set()), 'embedding': academic_field.get(Config.COL_EMBEDDING)}
+
+def compute_field_subject_matrix(master_data: MasterData) -> np.ndarray:
+    """全学問分野×全科目の類似度 (score_subjects の学問分野側の項) を計算する。"""
+    matrix = np.zeros((len(master_data.gakumon_df), len(master_data.subject_df)), dtype=np.float64)
+    for i, (_, field) in enumerate(master_data.gakumon_df.iterrows()):
+        matrix[i] = calculate_batch_node_similarity(_academic_field_node(field), master_data.subject_features)
+    return matrix
+
+def build_field_subject_matrix(out_dir: str = Config.COMPILED_DATA_DIR) -> dict:
+    """現在のマスタデータから学問分野×科目の類似度行列を計算して保存する (build_data.py field-matrix)。"""
+    master_data = get_master_data()
+    if not master_data.version: raise FileNotFoundError("マスタファイルのバージョンを取得できません。")
+    matrix = compute_field_subject_matrix(master_data)
+    return similarity_matrix.save_similarity_matrix(out_dir, matrix, _field_matrix_expected(master_data.version, *matrix.shape))
+
+@stage_timing.timed("subject_ranking")
+def score_subjects(input_node: dict, academic_field: pd.Series, subject_features: NodeFeatureMatrix, field_similarities: np.ndarray | None = None) -> np.ndarray:
+    """
+    全科目の総合類似度 (学問分野との類似度と入力ノードとの類似度の重み付き和) を1回で計算する。
+    field_similarities (事前計算済み行列の該当行) を渡した場合、学問分野側の項は計算しない。
+    """
+    if field_similarities is not None: sim_with_field = np.asarray(field_similarities)
+    else: sim_with_field = calculate_batch_node_similarity(_academic_field_node(academic_field), subject_features)
+    sim_with_input = calculate_batch_node_similarity(input_node, subject_features)
+    return (sim_with_field * Config.WEIGHT_GAKUMON_SIM) + (sim_with_input * Config.WEIGHT_INPUT_NODE_SIM)
+
+@stage_timing.timed("subject_ranking")
+def select_top_subjects(subject_df: pd.DataFrame, scores: np.ndarray, positions: np.ndarray, k: int | None = None) -> pd.DataFrame:
+    """positions (行位置) の中から総合類似度の上位k件 (省略時は Config.TOP_K_SUBJECTS) を返す (同点は元の行順、DataFrame.nlargest と同じ)。"""
+    k = Config.TOP_K_SUBJECTS if k is None else k
+    if len(positions) == 0:
         logging.warning("指定された学年条件に合う科目がありません。")
         return pd.DataFrame()
-        
-    academic_field_node = {'rep_qid': None, 'all_qids': academic_field.get(Config.COL_ALL_QIDS, set()), 'neighbor_qids': academic_field.get(Config.COL_NEIGHBORING_QIDS, set()), 'embedding': academic_field.get(Config.COL_EMBEDDING)}
+    positions = np.sort(positions)
+    top = positions[np.argsort(-scores[positions], kind='stable')[:k]]
+    logging.info(f"上位{len(top)}件の関連科目を抽出しました。")
+    return subject_df.iloc[top].assign(total_similarity=scores[top])
 
-    def calculate_total_similarity(subject_row):
-        subject_node = {'rep_qid': None, 'all_qids': subject_row.get(Config.COL_ALL_QIDS, set()), 'neighbor_qids': subject_row.get(Config.COL_NEIGHBORING_QIDS, set()), 'embedding': subject_row.get(Config.COL_EMBEDDING)}
-        sim_with_field = calculate_final_node_similarity(academic_field_node, subject_node)
-        sim_with_input = calculate_final_node_similarity(input_node, subject_node)
-        return (sim_with_field * Config.WEIGHT_GAKUMON_SIM) + (sim_with_input * Config.WEIGHT_INPUT_NODE_SIM)
+def year_slice(year_order: np.ndarray, years_sorted: np.ndarray, input_year, op: callable) -> np.ndarray:
+    """学年の昇順に並べた行位置から、op(学年, input_year) を満たす範囲をスライスで返す (gt/lt 以外はマスクで絞り込む)。"""
+    if op is operator.gt: return year_order[np.searchsorted(years_sorted, input_year, side='right'):]
+    if op is operator.lt: return year_order[:np.searchsorted(years_sorted, input_year, side='left')]
+    return year_order[np.asarray(op(years_sorted, input_year), dtype=bool)]
 
-    filtered_subjects['total_similarity'] = filtered_subjects.apply(calculate_total_similarity, axis=1)
-    top_k = filtered_subjects.nlargest(Config.TOP_K_SUBJECTS, 'total_similarity')
-    logging.info(f"上位{len(top_k)}件の関連科目を抽出しました。")
-    return top_k
+@stage_timing.timed("subject_ranking")
+def find_top_related_subjects(input_node: dict, academic_field: pd.Series, subject_df: pd.DataFrame, input_year: int, op: callable, subject_features: NodeFeatureMatrix | None = None) -> pd.DataFrame:
+    logging.info(f"関連科目を抽出 (学年条件: {op.__name__} {input_year})...")
+    if subject_features is None: subject_features = NodeFeatureMatrix.from_dataframe(subject_df, use_rep_qid=False)
+    year_order, years_sorted = _year_partition(subject_df)
+    return select_top_subjects(subject_df, score_subjects(input_node, academic_field, subject_features), year_slice(year_order, years_sorted, input_year, op))
 
 # --- ▼▼▼ ここからが修正対象の関数 ▼▼▼ ---
 
-def extract_subgraph_from_subject_map(input_node: dict, subject_name: str) -> tuple[pd.DataFrame | None, pd.DataFrame | None, str | None]:
+@stage_timing.timed("ann_search")
+def find_ann_entry_candidates(input_node: dict, input_year: int, op: callable, snapshot: DataSnapshot | None = None) -> dict[str, list[str]] | None:
     """
-    指定された科目のマップから、入力ノードに最も類似した部分木を抽出する。
-    接続点がルートか否かで、部分木の抽出方法を変える。
-    
+    全科目マップのANNインデックスから、学年条件を満たし入力埋め込みに近いノードを検索し、
+    科目名→接続点候補ノードIDのリスト (類似度順) を返す。無効またはインデックス未構築の場合は None。
+    """
+    if not Config.USE_ANN_ENTRY_POINTS: return None
+    index = (snapshot or get_data_snapshot()).stores.ann
+    if index is None: return None
+    hits = index.search(input_node.get('embedding'), Config.ANN_TOP_N_NODES, Config.ANN_NPROBE,
+                        year_filter=lambda years: (years >= 0) & op(years, input_year))
+    candidates = {}
+    for subject_name, node_id, _ in hits: candidates.setdefault(subject_name, []).append(node_id)
+    logging.info(f"ANNインデックスから {len(hits)} 件の接続点候補を取得しました ({len(candidates)}科目)。")
+    return candidates
+
+def ann_subject_positions(subject_df: pd.DataFrame, positions: np.ndarray, entry_candidates: dict[str, list[str]]) -> np.ndarray:
+    """positions (行位置) のうち、ANNインデックスの検索で接続点候補が見つかった科目だけを返す (1件も無い場合は positions のまま)。"""
+    if Config.COL_LABEL not in subject_df.columns or not entry_candidates: return positions
+    labels = subject_df[Config.COL_LABEL].to_numpy(dtype=object)[positions]
+    pruned = positions[np.isin(labels, list(entry_candidates))]
+    if len(pruned) == 0:
+        logging.info("ANNインデックスの接続点候補を持つ科目が学年条件の中に無いため、全科目から選びます。")
+        return positions
+    return pruned
+
+def _select_subgraph(input_node: dict, subject_map: SubjectMap, entry_candidates: list[str] | None = None) -> tuple[list[int], list[int], str, np.ndarray] | None:
+    """
+    科目マップから入力ノードに最も類似した部分木を選ぶ。接続点がルートか否かで、部分木の選び方を変える。
+    entry_candidates (ANNインデックスの検索結果) が与えられた場合は、その中から接続点を選び、
+    類似度は候補ノードと部分木の候補 (ルートの子ノード・ルートまでの経路) の行だけで計算する。
+
     Returns:
-        - 部分木を構成するノードのDataFrame
-        - 部分木内のエッジのDataFrame
-        - 部分木への接続点となるノードのID
+        - (部分木のノードの行位置, 部分木内のエッジの行位置, 接続点のノードID, 部分木の各ノードと入力ノードの類似度 (ノードの行位置の順))
+        - 類似度が閾値未満、または部分木が空の場合は None
     """
-    logging.info(f"  科目 '{subject_name}' のマップから部分木を抽出しています...")
-    nodes_path = os.path.join(Config.DATABASE_DIR, f"subject_map_{subject_name}_nodes.csv")
-    edges_path = os.path.join(Config.DATABASE_DIR, f"subject_map_{subject_name}_edges.csv")
-    
-    df_map_nodes, df_map_edges = safe_load_csv(nodes_path), safe_load_csv(edges_path)
-    if df_map_nodes is None or df_map_nodes.empty: 
-        return None, None, None
-        
-    df_map_nodes = preprocess_master_data(df_map_nodes)
-
-    # 1. 科目マップ内の各ノードと入力ノードとの類似度を計算
-    df_map_nodes['similarity_to_input'] = df_map_nodes.apply(
-        lambda row: calculate_final_node_similarity(input_node, {
-            'rep_qid': row.get(Config.COL_REP_QID), 'all_qids': row.get(Config.COL_ALL_QIDS, set()),
-            'neighbor_qids': row.get(Config.COL_NEIGHBORING_QIDS, set()), 'embedding': row.get(Config.COL_EMBEDDING)
-        }),
-        axis=1
-    )
-    
+    graph = subject_map.graph
+
+    # 1. 科目マップ内のノードと入力ノードとの類似度を、必要になった行だけ計算する (キャッシュ済みのノード表は変更しない)
+    similarities = np.zeros(len(graph))
+    scored = np.zeros(len(graph), dtype=bool)
+    def similarities_of(positions) -> np.ndarray:
+        positions = np.asarray(positions, dtype=np.intp)
+        missing = positions[~scored[positions]]
+        if len(missing) == len(graph): similarities[:] = calculate_batch_node_similarity(input_node, subject_map.features)
+        elif len(missing): similarities[missing] = calculate_batch_node_similarity(input_node, subject_map.features.subset(missing))
+        scored[missing] = True
+        return similarities[positions]
+
     # 2. 最も類似度が高いノードを「接続点（エントリーポイント）」候補として特定
-    entry_point_node = df_map_nodes.loc[df_map_nodes['similarity_to_input'].idxmax()]
-    entry_point_id = str(entry_point_node[Config.COL_ID])
-    max_similarity = entry_point_node['similarity_to_input']
+    entry_positions = np.arange(len(graph))
+    if entry_candidates:
+        candidate_positions = np.flatnonzero(np.isin(np.array(graph.node_ids, dtype=object), entry_candidates))
+        if len(candidate_positions): entry_positions = candidate_positions
+    entry_position = int(entry_positions[np.argmax(similarities_of(entry_positions))])
+    entry_point_id = graph.node_ids[entry_position]
+    max_similarity = similarities[entry_position]
 
     # 3. 類似度が閾値未満の場合は、この科目を関連なしと判断し、何も返さない
     if max_similarity < Config.SIMILARITY_THRESHOLD:
-        logging.info(f"    '{subject_name}' の最大類似度({max_similarity:.4f})が閾値を下回ったため、マップを生成しません。")
-        return None, None, None
+        logging.info(f"    '{subject_map.name}' の最大類似度({max_similarity:.4f})が閾値を下回ったため、マップを生成しません。")
+        return None
 
     # 4. 接続点の種類に応じて、部分木の抽出ロジックを分岐
-    subgraph_nodes_df = pd.DataFrame()
-    subgraph_edges_df = pd.DataFrame()
-
-
-    if entry_point_id.endswith("_0"):
+    if graph.is_root_id(entry_point_id):
         # 【ケース1】 接続点が科目のルートノードの場合
         logging.info(f"    接続点がルートノード ({entry_point_id}) です。最も関連性の高い部分木を抽出します。")
-        # 以前の安定したロジックを踏襲しつつ、子ノードに限定する機能を追加
-        
-        # a) ルートノードの直接の子ノードIDを取得
-        child_edges_df = df_map_edges[df_map_edges[Config.EDGE_COL_SOURCE] == entry_point_id] if df_map_edges is not None else pd.DataFrame()
-        child_node_ids = set(child_edges_df[Config.EDGE_COL_TARGET])
-        
-        # b) 科目マップ全体から、これらの子ノードとルートノードのみを抽出
-        nodes_to_consider_ids = child_node_ids.union({entry_point_id})
-        df_map_subset = df_map_nodes[df_map_nodes[Config.COL_ID].astype(str).isin(nodes_to_consider_ids)].copy()
-        
-        # c) 抽出したサブセットの中から、類似度上位のノードを部分木として最終決定
-        subgraph_nodes_df = df_map_subset.nlargest(Config.TOP_N_NODES_IN_SUBGRAPH, 'similarity_to_input').copy()
-
-        # d) 最終決定したノード間のエッジのみを抽出
-        subgraph_node_ids = set(subgraph_nodes_df[Config.COL_ID].astype(str))
-        subgraph_edges_df = df_map_edges[
-            df_map_edges[Config.EDGE_COL_SOURCE].isin(subgraph_node_ids) &
-            df_map_edges[Config.EDGE_COL_TARGET].isin(subgraph_node_ids)
-        ].copy()
+        # a) ルートノードの直接の子ノードとルートノードのみを候補とする (CSVの行順)
+        nodes_to_consider_ids = set(graph.child_ids(entry_point_id)) | {entry_point_id}
+        candidate_positions = [i for i, node_id in enumerate(graph.node_ids) if node_id in nodes_to_consider_ids]
+        # b) 候補の中から類似度上位のノードを部分木として最終決定 (同点は行順を優先)
+        order = np.argsort(-similarities_of(candidate_positions), kind='stable')[:Config.TOP_N_NODES_IN_SUBGRAPH]
+        node_positions = [candidate_positions[i] for i in order]
+        # c) 最終決定したノード間のエッジのみを抽出
+        edge_positions = graph.edges_within(graph.node_ids[i] for i in node_positions)
     else:
         # 【ケース2】 接続点が個別のノードの場合
         logging.info(f"    接続点が個別ノード ({entry_point_id}) です。ルートまでの経路を抽出します。")
-        path_nodes, path_edges = {}, {}
-        current_node_id = entry_point_id
-        
-        # エッジ情報を探索しやすいように準備
-        if df_map_edges is not None and not df_map_edges.empty:
-            df_map_edges.rename(columns={'from': 'source', 'to': 'target'}, inplace=True, errors='ignore')
-            df_map_edges[Config.EDGE_COL_SOURCE] = df_map_edges[Config.EDGE_COL_SOURCE].astype(str)
-            df_map_edges[Config.EDGE_COL_TARGET] = df_map_edges[Config.EDGE_COL_TARGET].astype(str)
-            
-            # 探索ループ
-            for _ in range(len(df_map_nodes)): # 無限ループ防止
-                node_data = df_map_nodes[df_map_nodes[Config.COL_ID].astype(str) == current_node_id]
-                if node_data.empty: break
-                path_nodes[current_node_id] = node_data.iloc[0]
-
-                if current_node_id.endswith("_0"): break
-
-                # 親ノードを探索
-                parent_edge = df_map_edges[df_map_edges[Config.EDGE_COL_TARGET] == current_node_id]
-                if parent_edge.empty: break
-                
-                parent_id = parent_edge.iloc[0][Config.EDGE_COL_SOURCE]
-                path_edges[f"{parent_id}->{current_node_id}"] = parent_edge.iloc[0]
-                current_node_id = parent_id
-        
-        if path_nodes:
-            subgraph_nodes_df = pd.DataFrame(path_nodes.values())
-        if path_edges:
-            subgraph_edges_df = pd.DataFrame(path_edges.values())
-
-    if subgraph_nodes_df.empty:
-        return None, None, None
+        node_positions, edge_positions = graph.path_to_root(entry_point_id)
 
-    logging.info(f"    '{subject_name}' から {len(subgraph_nodes_df)} ノード、{len(subgraph_edges_df)} エッジの部分木を抽出しました。接続点: ID {entry_point_id}")
-    return subgraph_nodes_df, subgraph_edges_df, entry_point_id
+    if not node_positions: return None
+    logging.info(f"    '{subject_map.name}' から {len(node_positions)} ノード、{len(edge_positions)} エッジの部分木を抽出しました。接続点: ID {entry_point_id}")
+    return node_positions, edge_positions, entry_point_id, similarities_of(node_positions)
 
+def extract_subgraph_from_subject_map(input_node: dict, subject_name: str, entry_candidates: list[str] | None = None, snapshot: DataSnapshot | None = None) -> tuple[pd.DataFrame | None, pd.DataFrame | None, str | None]:
+    """
+    指定された科目のマップから、入力ノードに最も類似した部分木を抽出する (選び方は _select_subgraph)。
+    結果の組み立てには DataFrame を作らない extract_subgraph_records を使う。
+    
+    Returns:
+        - 部分木を構成するノードのDataFrame
+        - 部分木内のエッジのDataFrame
+        - 部分木への接続点となるノードのID
+    """
+    logging.info(f"  科目 '{subject_name}' のマップから部分木を抽出しています...")
+    subject_map = (snapshot or get_data_snapshot()).subject_map(subject_name)
+    if subject_map is None or subject_map.nodes_df.empty:
+        return None, None, None
+    selected = _select_subgraph(input_node, subject_map, entry_candidates)
+    if selected is None:
+        return None, None, None
+    node_positions, edge_positions, entry_point_id, node_similarities = selected
+    subgraph_nodes_df = subject_map.nodes_df.iloc[node_positions].assign(similarity_to_input=node_similarities)
+    subgraph_edges_df = subject_map.edges_df.iloc[edge_positions] if edge_positions else pd.DataFrame()
+    return subgraph_nodes_df, subgraph_edges_df, entry_point_id
 
-def generate_final_map(input_node: dict, top_subjects_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+@stage_timing.timed("subgraph_extraction")
+def extract_subgraph_records(input_node: dict, subject_name: str, entry_candidates: list[str] | None = None, snapshot: DataSnapshot | None = None) -> tuple[list[dict], list[dict], str] | None:
     """
-    関連する各科目のマップから抽出した部分木を結合し、最終的な知識マップを生成する。
+    extract_subgraph_from_subject_map と同じ部分木を、DataFrame を作らずに結果のレコードとして返す。
+
+    Returns:
+        - (ノード [{id, label, sentence, group}], 部分木内のエッジ [{source, target}], 接続点のノードID)
+        - 部分木が得られない場合は None
     """
-    final_nodes_list, final_edges_list = [], []
-    
-    # グラフの始点となる入力ノードを定義
-    input_node_id = f"input_{input_node[Config.COL_LABEL]}"
-    input_node_record = {
-        'id': input_node_id, 
-        'label': input_node[Config.COL_LABEL], 
+    logging.info(f"  科目 '{subject_name}' のマップから部分木を抽出しています...")
+    subject_map = (snapshot or get_data_snapshot()).subject_map(subject_name)
+    if subject_map is None or not len(subject_map.graph): return None
+    selected = _select_subgraph(input_node, subject_map, entry_candidates)
+    if selected is None: return None
+    node_positions, edge_positions, entry_point_id, _ = selected
+
+    columns, graph = subject_map.output_columns.items(), subject_map.graph
+    nodes = []
+    for i in node_positions:
+        node = {col: values[i] for col, values in columns}
+        node['group'] = subject_name
+        nodes.append(node)
+    edges = [{Config.EDGE_COL_SOURCE: graph.edge_sources[e], Config.EDGE_COL_TARGET: graph.edge_targets[e]} for e in edge_positions]
+    return nodes, edges, entry_point_id
+
+def _input_node_record(input_node: dict) -> dict:
+    """グラフの始点となる入力ノード。"""
+    return {
+        'id': f"input_{input_node[Config.COL_LABEL]}",
+        'label': input_node[Config.COL_LABEL],
         'group': 'Input',
         #'all_node_qids': list(input_node.get('all_qids', [])),
         'extend_query': list(input_node.get('all_qids', []))
     }
-    final_nodes_list.append(pd.DataFrame([input_node_record]))
-    
-    # 関連する科目ごとに処理を実行
-    for _, subject_row in top_subjects_df.iterrows():
-        subject_name = subject_row[Config.COL_LABEL]
-        
-        # 科目マップから関連部分木とその接続点を抽出
-        subgraph_nodes_df, subgraph_edges_df, entry_point_id = extract_subgraph_from_subject_map(input_node, subject_name)
-        
+
+def iter_subject_subgraphs(input_node: dict, top_subjects_df: pd.DataFrame, entry_candidates: dict[str, list[str]] | None = None, snapshot: DataSnapshot | None = None):
+    """
+    関連する科目ごとに部分木を抽出し、(科目名, 追加するノードのレコード, 追加するエッジのレコード, 接続点ID) を
+    top_subjects_df の順 (総合類似度の順) に返す。エッジは入力ノードから接続点へのエッジが先頭。
+    有効な部分木が得られなかった科目は返さない。
+    """
+    input_node_id = _input_node_record(input_node)['id']
+    snapshot = snapshot or get_data_snapshot()
+    subject_names = list(top_subjects_df[Config.COL_LABEL]) if Config.COL_LABEL in top_subjects_df.columns else []
+    for subject_name in subject_names:
+        # 科目マップから関連部分木とその接続点を抽出 (ノードはフロントエンドに必要な列のみ)
+        extracted = extract_subgraph_records(input_node, subject_name, (entry_candidates or {}).get(subject_name), snapshot)
         # 有効な部分木と接続点が得られた場合のみ処理を続行
-        if subgraph_nodes_df is not None and not subgraph_nodes_df.empty and entry_point_id:
-            
-            # 1. 部分木のノードを最終リストに追加
-            # ★★★ フロントエンドに必要な列のみを選択し、非シリアライズ可能データを除外 ★★★
-            required_columns = [Config.COL_ID, Config.COL_LABEL, Config.COL_SENTENCE]
-            # 存在する列のみを抽出
-            cols_to_select = [col for col in required_columns if col in subgraph_nodes_df.columns]
-            
-            nodes_to_add = subgraph_nodes_df[cols_to_select].copy()
-            nodes_to_add['group'] = subject_name
-            
-            # all_node_qids列をセットからリストに変換
-            if Config.COL_ALL_QIDS in nodes_to_add.columns:
-                 nodes_to_add[Config.COL_ALL_QIDS] = nodes_to_add[Config.COL_ALL_QIDS].apply(lambda s: list(s) if isinstance(s, set) else (s if isinstance(s, list) else []))
-            
-            # フロントエンドでのキー名統一のため、all_node_qidsをextend_queryにもコピー
-            #if Config.COL_ALL_QIDS in nodes_to_add.columns:
-            #    nodes_to_add['extend_query'] = nodes_to_add[Config.COL_ALL_QIDS]
-
-            final_nodes_list.append(nodes_to_add)
-            
-            # 2. 入力ノードから部分木の接続点へのエッジを生成
-            connection_edge = {Config.EDGE_COL_SOURCE: input_node_id, Config.EDGE_COL_TARGET: entry_point_id}
-            final_edges_list.append(pd.DataFrame([connection_edge]))
-
-            # 3. 部分木内部のエッジを最終リストに追加
-            if subgraph_edges_df is not None and not subgraph_edges_df.empty:
-                final_edges_list.append(subgraph_edges_df[[Config.EDGE_COL_SOURCE, Config.EDGE_COL_TARGET]])
-
-    # 全てのノードとエッジを結合して最終的なDataFrameを作成
-    if not final_nodes_list: 
-        return pd.DataFrame(), pd.DataFrame()
-        
-    final_nodes_df = pd.concat(final_nodes_list, ignore_index=True).drop_duplicates(subset=['id'])
-    
-    if not final_edges_list:
-        return final_nodes_df, pd.DataFrame(columns=[Config.EDGE_COL_SOURCE, Config.EDGE_COL_TARGET])
-        
-    final_edges_df = pd.concat(final_edges_list, ignore_index=True).drop_duplicates()
-    
-    return final_nodes_df, final_edges_df
+        if extracted is None or not extracted[2]: continue
+        nodes_to_add, subgraph_edges, entry_point_id = extracted
+        # 入力ノードから部分木の接続点へのエッジと、部分木内部のエッジ
+        edges_to_add = [{Config.EDGE_COL_SOURCE: input_node_id, Config.EDGE_COL_TARGET: entry_point_id}, *subgraph_edges]
+        yield subject_name, nodes_to_add, edges_to_add, entry_point_id
 
+@stage_timing.timed("map_assembly")
+def assemble_final_map(input_node: dict, subgraphs: list) -> tuple[list[dict], list[dict]]:
+    """
+    入力ノードと iter_subject_subgraphs の各部分木を結合し、重複を除いた最終的なノード・エッジのレコードを返す。
+    重複は先に現れたものを残し (ノードはID、エッジは始点と終点の組で判定)、ノードのキーは全ノードで揃える (無い値は None)。
+    """
+    nodes, node_ids, keys = [], set(), {}
+    for node in [_input_node_record(input_node), *(node for _, nodes_to_add, _, _ in subgraphs for node in nodes_to_add)]:
+        keys.update(dict.fromkeys(node))
+        if node['id'] in node_ids: continue
+        node_ids.add(node['id'])
+        nodes.append(node)
+    edges, edge_keys = [], set()
+    for _, _, edges_to_add, _ in subgraphs:
+        for edge in edges_to_add:
+            key = (edge[Config.EDGE_COL_SOURCE], edge[Config.EDGE_COL_TARGET])
+            if key in edge_keys: continue
+            edge_keys.add(key)
+            edges.append(edge)
+    return [{key: node.get(key) for key in keys} for node in nodes], edges
+
+def generate_final_map(input_node: dict, top_subjects_df: pd.DataFrame, entry_candidates: dict[str, list[str]] | None = None) -> tuple[list[dict], list[dict]]:
+    """
+    関連する各科目のマップから抽出した部分木を結合し、最終的な知識マップ (ノード・エッジのレコード) を生成する。
+    """
+    return assemble_final_map(input_node, list(iter_subject_subgraphs(input_node, top_subjects_df, entry_candidates)))
 
 # =============================================================================
 # 4. メイン実行関数 (app.py から呼び出される)
 # =============================================================================
 
-def find_temporal_relation(input_node_data: dict) -> dict:
+# --- 結果キャッシュ (正規化した入力 + データのバージョン → 未来/過去マップ、全ワーカーで共有) ---
+temporal_result_cache = SqliteTTLCache(Config.CACHE_DB_PATH, "temporal_relation", Config.RESULT_CACHE_TTL,
+                                       max_entries=Config.RESULT_CACHE_MAX_ENTRIES, touch_on_hit=True)
+
+def _normalize_input_text(text) -> str:
+    return " ".join(str(text).split()) if text else ""
+
+def _result_config_version() -> str:
+    """結果に影響する計算パラメータ (科目数・部分木のノード数・閾値・類似度の重み・ANN検索の設定) を並べた文字列。"""
+    weights = (Config.WEIGHT_GAKUMON_SIM, Config.WEIGHT_INPUT_NODE_SIM, Config.WEIGHT_REP_PATH, Config.WEIGHT_NEIGHBOR_JACCARD, Config.WEIGHT_EMBEDDING_COSINE)
+    params = f"k={Config.TOP_K_SUBJECTS}:n={Config.TOP_N_NODES_IN_SUBGRAPH}:th={Config.SIMILARITY_THRESHOLD!r}:w={','.join(repr(w) for w in weights)}"
+    if Config.USE_ANN_ENTRY_POINTS: params += f":ann={Config.ANN_TOP_N_NODES},{Config.ANN_NPROBE}"
+    return params
+
+def _result_data_version(snapshot: DataSnapshot) -> str:
     """
-    入力データに基づいて時間的関係性を持つ科目を特定し、
-    未来(発展)と過去(基礎)の知識マップを辞書形式で返す。
+    結果に影響するデータ (スナップショット)・設定のバージョン。結果キャッシュのキーとジョブIDに含め、
+    これが変わると古い結果・ジョブはキーが一致しなくなる。
+    """
+    return f"{snapshot.version}:ann={int(Config.USE_ANN_ENTRY_POINTS)}:{_result_config_version()}"
+
+def _result_cache_key_prefix(data_version: str) -> str:
+    """結果キャッシュのキーの先頭に付けるバージョン。データの切り替え時にこれ以外のキーを削除する。"""
+    return hashlib.sha1(data_version.encode("utf-8")).hexdigest()[:12] + ":"
+
+def temporal_result_cache_key(label, sentence, extend_query, year, data_version: str) -> str:
+    """(label, sentence, ソート済み extend_query, year) を正規化し、データのバージョンと合わせたキー。"""
+    terms = sorted({_normalize_input_text(term) for term in (extend_query or [])} - {""})
+    try: year = int(year)
+    except (TypeError, ValueError): year = _normalize_input_text(year)
+    payload = json.dumps([_normalize_input_text(label), _normalize_input_text(sentence), terms, year, data_version], ensure_ascii=False)
+    return _result_cache_key_prefix(data_version) + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def clear_result_cache() -> int:
+    """結果キャッシュを全ワーカー分まとめて削除し、削除件数を返す。"""
+    return temporal_result_cache.clear()
+
+def _iter_temporal_stages(snapshot: DataSnapshot, label: str, sentence: str, extend_qid, year):
+    """
+    未来(発展)・過去(基礎)のマップを計算しながら、各段階の結果をイベント (dict) として順に返す。
+    最後のイベントは {"stage": "complete", "result": ...} (基準ノードの除外は呼び出し側で行う)。
+    """
+    with stage_timing.stage("master_data"): master_data = snapshot.master_data  # 初回のみマスタCSVを読み込む
+    df_gakumon, df_subject = master_data.gakumon_df, master_data.subject_df
+
+    # 2. 入力ノードの特徴量生成
+    input_node_feature = create_input_node_features(label, sentence, extend_qid)
+    yield {"stage": "input_features", "data": {
+        "input_node": _input_node_record(input_node_feature), "rep_qid": input_node_feature['rep_qid'],
+        "qids": sorted(input_node_feature['all_qids']), "neighbor_qid_count": len(input_node_feature['neighbor_qids']),
+        "has_embedding": input_node_feature['embedding'] is not None,
+    }}
+
+    # 3. 最も類似した学問分野を特定
+    most_similar_field = find_most_similar_academic_field(input_node_feature, df_gakumon, master_data.gakumon_features)
+    if most_similar_field is None:
+        raise ValueError("類似する学問分野を特定できませんでした。")
+    yield {"stage": "academic_field", "data": {"label": most_similar_field.get(Config.COL_LABEL), "similarity": float(most_similar_field['similarity_to_input'])}}
+
+    # 4. 全科目の総合類似度を1回だけ計算し、未来・過去はそれぞれ学年順のスライスから上位を選ぶ
+    #    ANNインデックスが有効な場合は、検索で接続点候補が見つかった科目だけを採点して上位を選ぶ
+    field_similarities = master_data.field_similarities_for(most_similar_field.name)
+    subject_scores = None
+
+    # 5. 未来 (発展)・6. 過去 (基礎) の関連マップ生成 (部分木は抽出でき次第返す)
+    result = {}
+    for direction, op, title in (("future", operator.gt, "年次の高い(発展)"), ("past", operator.lt, "年次の低い(基礎)")):
+        logging.info(f"\n--- {title}科目群のマップ生成を開始 ---")
+        positions = year_slice(master_data.subject_year_order, master_data.subject_years_sorted, year, op)
+        entry_candidates = find_ann_entry_candidates(input_node_feature, year, op, snapshot)
+        if entry_candidates is not None:
+            positions = ann_subject_positions(df_subject, positions, entry_candidates)
+            scores = np.zeros(len(df_subject))
+            scores[positions] = score_subjects(input_node_feature, most_similar_field, master_data.subject_features.subset(positions),
+                                               None if field_similarities is None else np.asarray(field_similarities)[positions])
+        else:
+            if subject_scores is None: subject_scores = score_subjects(input_node_feature, most_similar_field, master_data.subject_features, field_similarities)
+            scores = subject_scores
+        top_subjects = select_top_subjects(df_subject, scores, positions)
+        yield {"stage": "subjects", "direction": direction, "data": [
+            {"label": label, "total_similarity": float(score)} for label, score in zip(top_subjects[Config.COL_LABEL], top_subjects['total_similarity'])
+        ] if not top_subjects.empty else []}
+        subgraphs = []
+        for subgraph in iter_subject_subgraphs(input_node_feature, top_subjects, entry_candidates, snapshot):
+            subgraphs.append(subgraph)
+            subject_name, nodes_to_add, edges_to_add, entry_point_id = subgraph
+            yield {"stage": "subgraph", "direction": direction, "subject": subject_name, "entry_point_id": entry_point_id,
+                   "nodes": nodes_to_add, "edges": edges_to_add}
+        nodes, edges = assemble_final_map(input_node_feature, subgraphs)
+        result[f"{direction}_map"] = {"nodes": nodes, "edges": edges}
+
+    yield {"stage": "complete", "result": result}
+
+def _error_result(error: str) -> dict:
+    return {
+        "future_map": {"nodes": [], "edges": []},
+        "past_map": {"nodes": [], "edges": []},
+        "error": error
+    }
+
+def _exclude_node(nodes: list[dict], node_id: str | None) -> list[dict]:
+    return [node for node in nodes if str(node.get('id')) != node_id] if node_id else nodes
+
+def stream_temporal_relation(input_node_data: dict):
+    """
+    find_temporal_relation と同じ処理を行い、各段階 (入力の特徴量・学問分野・未来/過去の上位科目・科目ごとの部分木) の
+    結果をイベントとして順に返すジェネレーター。
+    最後のイベントは必ず "complete" (find_temporal_relation と同じ結果) か "error" (result にエラー時の結果) となる。
+    結果キャッシュにヒットした場合は "complete" のみを返す。
     """
     label = input_node_data.get('label')
     extend_qid = input_node_data.get('extend_query', [])
@@ -438,83 +1329,78 @@ def find_temporal_relation(input_node_data: dict) -> dict:
     if not label:
         error_msg = "入力ノードに有効なラベルが含まれていないため、処理を中断しました。"
         logging.error(f"Logic Error: {error_msg} (input_node_data: {input_node_data})")
-        return {
-            "future_map": {"nodes": [], "edges": []},
-            "past_map": {"nodes": [], "edges": []},
-            "error": error_msg
-        }
+        yield {"stage": "error", "error": error_msg, "result": _error_result(error_msg)}
+        return
     # --- ▲▲▲ 修正ここまで ▲▲▲ ---
     
     logging.info(f"Logic: Calculating temporal relation for '{label}' (Year: {year})")
+    base_node_id = input_node_data.get('id') or input_node_data.get('apiNodeId')
+    base_node_id_str = str(base_node_id) if base_node_id else None
 
     try:
-        # 1. マスタデータ読み込みと前処理
-        df_gakumon = safe_load_csv(Config.GAKUMON_CSV_PATH)
-        df_subject = safe_load_csv(Config.SUBJECT_CSV_PATH)
-        if df_gakumon is None or df_subject is None:
-            raise FileNotFoundError("学問または科目のマスタファイルが見つかりません。")
+        # 1. データのスナップショット取得 (マスタデータはプロセス内で一度だけ読み込み・前処理済み)
+        #    処理の途中でデータが再読み込みされても、このリクエストは最後まで同じスナップショットを使う
+        with stage_timing.stage("data_snapshot"): snapshot = get_data_snapshot()
+
+        with stage_timing.stage("result_cache"):
+            cache_key = temporal_result_cache_key(label, sentence, extend_qid, year, _result_data_version(snapshot)) if Config.RESULT_CACHE_ENABLED else None
+            result = temporal_result_cache.get(cache_key) if cache_key else None
+        if cache_key: stage_timing.count_cache("result", hits=result is not None, misses=result is None)
+        if result is not None:
+            logging.info(f"結果キャッシュから返します: '{label}' (Year: {year})")
+        else:
+            for event in _iter_temporal_stages(snapshot, label, sentence, extend_qid, year):
+                if event["stage"] == "complete": result = event["result"]; break
+                if event["stage"] == "subgraph": event = {**event, "nodes": _exclude_node(event["nodes"], base_node_id_str)}
+                yield event
+            if cache_key:
+                with stage_timing.stage("result_cache"): temporal_result_cache.set(cache_key, result)
 
-        df_gakumon = preprocess_master_data(df_gakumon)
-        df_subject = preprocess_master_data(df_subject)
-        
-        # 2. 入力ノードの特徴量生成
-        input_node_feature = create_input_node_features(label, sentence, extend_qid)
-
-        # 3. 最も類似した学問分野を特定
-        most_similar_field = find_most_similar_academic_field(input_node_feature, df_gakumon)
-        if most_similar_field is None:
-            raise ValueError("類似する学問分野を特定できませんでした。")
-
-        # 4. 未来 (発展) の関連マップ生成
-        logging.info("\n--- 年次の高い(発展)科目群のマップ生成を開始 ---")
-        top_future_subjects = find_top_related_subjects(input_node_feature, most_similar_field, df_subject, year, operator.gt)
-        future_nodes_df, future_edges_df = generate_final_map(input_node_feature, top_future_subjects)
-
-        # 5. 過去 (基礎) の関連マップ生成
-        logging.info("\n--- 年次の低い(基礎)科目群のマップ生成を開始 ---")
-        top_past_subjects = find_top_related_subjects(input_node_feature, most_similar_field, df_subject, year, operator.lt)
-        past_nodes_df, past_edges_df = generate_final_map(input_node_feature, top_past_subjects)
-   
-        # 6. 基準ノードの重複を排除
-        base_node_id = input_node_data.get('id') or input_node_data.get('apiNodeId')
-        if base_node_id:
-            base_node_id_str = str(base_node_id)
+        # 8. 基準ノードの重複を排除
+        if base_node_id_str:
             logging.info(f"結果から基準ノード (ID: {base_node_id_str}) を除外します。")
-            if 'future_nodes_df' in locals() and not future_nodes_df.empty and 'id' in future_nodes_df.columns:
-                future_nodes_df = future_nodes_df[future_nodes_df['id'].astype(str) != base_node_id_str].copy()
-            if 'past_nodes_df' in locals() and not past_nodes_df.empty and 'id' in past_nodes_df.columns:
-                past_nodes_df = past_nodes_df[past_nodes_df['id'].astype(str) != base_node_id_str].copy()
-        # --- ▼▼▼ ここからが修正箇所 ▼▼▼ ---
-        # 7. JSONシリアライズのためのデータサニタイズ
-        # NaN (Not a Number) はJSONに変換できないため、None (JavaScript側でnullになる) に置換する
-        if 'future_nodes_df' in locals() and not future_nodes_df.empty:
-            future_nodes_df = future_nodes_df.replace({np.nan: None})
-        if 'past_nodes_df' in locals() and not past_nodes_df.empty:
-            past_nodes_df = past_nodes_df.replace({np.nan: None})
-        # --- ▲▲▲ 修正ここまで ▲▲▲ ---
-        # 7. 結果をJSONシリアライズ可能な辞書形式に整形して返す
-        return {
-            "future_map": {
-                "nodes": future_nodes_df.to_dict('records') if 'future_nodes_df' in locals() else [],
-                "edges": future_edges_df.to_dict('records') if 'future_edges_df' in locals() else []
-            },
-            "past_map": {
-                "nodes": past_nodes_df.to_dict('records') if 'past_nodes_df' in locals() else [],
-                "edges": past_edges_df.to_dict('records') if 'past_edges_df' in locals() else []
-            }
-        }
+            for map_key in ("future_map", "past_map"):
+                result[map_key] = {**result[map_key], "nodes": _exclude_node(result[map_key]["nodes"], base_node_id_str)}
+        yield {"stage": "complete", "result": result}
     
     except (FileNotFoundError, ValueError) as e:
         logging.error(f"Logic Error: {e}", exc_info=True)
-        return {
-            "future_map": {"nodes": [], "edges": []},
-            "past_map": {"nodes": [], "edges": []},
-            "error": str(e)
-        }
+        yield {"stage": "error", "error": str(e), "result": _error_result(str(e))}
     except Exception as e:
         logging.error(f"Logic Error: An unexpected error occurred for '{label}': {e}", exc_info=True)
-        return {
-            "future_map": {"nodes": [], "edges": []},
-            "past_map": {"nodes": [], "edges": []},
-            "error": "An unexpected error occurred."
-        }
+        yield {"stage": "error", "error": "An unexpected error occurred.", "result": _error_result("An unexpected error occurred.")}
+
+def find_temporal_relation(input_node_data: dict) -> dict:
+    """
+    入力データに基づいて時間的関係性を持つ科目を特定し、
+    未来(発展)と過去(基礎)の知識マップを辞書形式で返す。
+    同じ入力 (正規化後) とデータのバージョンに対する結果は共有キャッシュから返す。
+    各段階の所要時間とキャッシュのヒット/ミス数は stage_timing で集計する (呼び出し元が集計中でなければここで1リクエスト分とする)。
+    """
+    with stage_timing.collect() as timings:
+        with stage_timing.stage("total"):
+            for event in stream_temporal_relation(input_node_data): pass
+        logging.info(f"段階ごとの処理時間 ('{input_node_data.get('label')}'): {timings.server_timing()}")
+    return event["result"]
+
+# =============================================================================
+# 非同期ジョブ (投入したら即座にジョブIDを返し、結果は問い合わせで取得する)
+# =============================================================================
+temporal_jobs = JobManager(
+    SqliteTTLCache(Config.CACHE_DB_PATH, "temporal_jobs", Config.JOB_RESULT_TTL),
+    max_workers=Config.JOB_MAX_WORKERS, running_ttl=Config.JOB_RUNNING_TTL, result_ttl=Config.JOB_RESULT_TTL, failed_ttl=Config.JOB_FAILED_TTL
+)
+
+def temporal_request_key(input_node_data: dict) -> str:
+    """同じ結果になるリクエスト (正規化後の入力・データのバージョン・除外する基準ノード) に共通のID。"""
+    data_version = _result_data_version(get_data_snapshot())
+    cache_key = temporal_result_cache_key(input_node_data.get('label'), input_node_data.get('sentence', ''), input_node_data.get('extend_query', []), input_node_data.get('year', 3), data_version)
+    base_node_id = input_node_data.get('id') or input_node_data.get('apiNodeId') or ''
+    return hashlib.sha256(f"{cache_key}:{base_node_id}".encode("utf-8")).hexdigest()[:32]
+
+def submit_temporal_relation_job(input_node_data: dict) -> dict:
+    """find_temporal_relation をジョブとして投入する。同じ入力のジョブが実行中・完了済みであればその状態を返す。"""
+    return temporal_jobs.submit(temporal_request_key(input_node_data), find_temporal_relation, dict(input_node_data))
+
+def get_temporal_relation_job(job_id: str) -> dict | None:
+    return temporal_jobs.get(job_id)